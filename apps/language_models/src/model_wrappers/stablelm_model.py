@@ -13,3 +13,66 @@ class StableLMModel(torch.nn.Module):
         }
         output = self.model(**combine_input_dict)
         return output.logits
+
+
+class StableLMPrefill(torch.nn.Module):
+    # Runs the prompt and returns the logits followed by the key/value cache
+    # of every layer, padded to `max_sequence_len` slots so that it can be
+    # handed as is to StableLMDecode.
+    def __init__(self, model, max_sequence_len):
+        super().__init__()
+        self.model = model
+        self.max_sequence_len = max_sequence_len
+
+    def forward(self, input_ids, attention_mask):
+        output = self.model(
+            input_ids=input_ids, attention_mask=attention_mask, use_cache=True
+        )
+        pad = self.max_sequence_len - input_ids.shape[1]
+        return_vals = [output.logits]
+        for key, value in output.past_key_values:
+            return_vals.append(torch.nn.functional.pad(key, (0, 0, 0, pad)))
+            return_vals.append(torch.nn.functional.pad(value, (0, 0, 0, pad)))
+        return tuple(return_vals)
+
+
+class StableLMDecode(torch.nn.Module):
+    # Runs one token at `position_ids` against a fixed size key/value cache.
+    # Slots before the position are attended to, the rest are masked out,
+    # and the new key/value is written to the slot of the position so every
+    # shape stays static across steps.
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, position_ids, *past_key_values):
+        cache_len = past_key_values[0].shape[2]
+        slots = torch.arange(cache_len).reshape(1, cache_len)
+        attention_mask = torch.cat(
+            [
+                (slots < position_ids).to(torch.int64),
+                torch.ones_like(position_ids),
+            ],
+            dim=1,
+        )
+        past = tuple(zip(past_key_values[0::2], past_key_values[1::2]))
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        one_hot = (
+            (slots == position_ids)
+            .to(past_key_values[0].dtype)
+            .reshape(1, 1, cache_len, 1)
+        )
+        return_vals = [output.logits]
+        for key, value in output.past_key_values:
+            for present in (key, value):
+                return_vals.append(
+                    present[:, :, :-1, :] * (1 - one_hot)
+                    + present[:, :, -1:, :] * one_hot
+                )
+        return tuple(return_vals)
@@ -237,3 +237,97 @@ class SecondVicuna(torch.nn.Module):
             return_vals.append(item[0])
             return_vals.append(item[1])
         return tuple(return_vals)
+
+
+class PaddedFirstVicuna(torch.nn.Module):
+    # FirstVicuna returning the past key values padded to
+    # `max_sequence_length` slots, the layout of a BatchedSecondVicuna slot.
+    def __init__(self, model_path, max_sequence_length):
+        super().__init__()
+        kwargs = {"torch_dtype": torch.float32}
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path, low_cpu_mem_usage=True, **kwargs
+        )
+        self.max_sequence_length = max_sequence_length
+
+    def forward(self, input_ids, attention_mask):
+        op = self.model(
+            input_ids=input_ids, attention_mask=attention_mask, use_cache=True
+        )
+        pad = self.max_sequence_length - input_ids.shape[1]
+        return_vals = []
+        return_vals.append(op.logits)
+        for item in op.past_key_values:
+            return_vals.append(
+                torch.nn.functional.pad(item[0], (0, 0, 0, pad))
+            )
+            return_vals.append(
+                torch.nn.functional.pad(item[1], (0, 0, 0, pad))
+            )
+        return tuple(return_vals)
+
+
+class BatchedSecondVicuna(torch.nn.Module):
+    # Decodes one token for each of the batch rows (KV slots) at the row's
+    # own position. Cache slots before the position are attended to, the
+    # rest are masked, and the new key/value is written to the slot of the
+    # position, so the shapes never change between steps. The logits are
+    # returned as [1, batch, vocab] so a row is sampled like a position.
+    def __init__(self, model_path):
+        super().__init__()
+        kwargs = {"torch_dtype": torch.float32}
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path, low_cpu_mem_usage=True, **kwargs
+        )
+
+    def forward(self, input_ids, position_ids, *past_key_values):
+        cache_len = past_key_values[0].shape[2]
+        slots = torch.arange(cache_len).reshape(1, cache_len)
+        attention_mask = torch.cat(
+            [
+                (slots < position_ids).to(torch.int64),
+                torch.ones_like(position_ids),
+            ],
+            dim=1,
+        )
+        past = tuple(zip(past_key_values[0::2], past_key_values[1::2]))
+        op = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        one_hot = (
+            (slots == position_ids)
+            .to(past_key_values[0].dtype)
+            .reshape(-1, 1, cache_len, 1)
+        )
+        return_vals = []
+        return_vals.append(op.logits.transpose(0, 1))
+        for item in op.past_key_values:
+            for present in item:
+                return_vals.append(
+                    present[:, :, :-1, :] * (1 - one_hot)
+                    + present[:, :, -1:, :] * one_hot
+                )
+        return tuple(return_vals)
+
+
+class KVSlotInsert(torch.nn.Module):
+    # Copies the single sequence caches (second half of the inputs) into
+    # row `slot` of the batched caches (first half).
+    def forward(self, slot, *caches):
+        num_caches = len(caches) // 2
+        batch_size = caches[0].shape[0]
+        one_hot = (
+            (torch.arange(batch_size) == slot)
+            .to(caches[0].dtype)
+            .reshape(batch_size, 1, 1, 1)
+        )
+        return tuple(
+            batched * (1 - one_hot) + single * one_hot
+            for batched, single in zip(
+                caches[:num_caches], caches[num_caches:]
+            )
+        )
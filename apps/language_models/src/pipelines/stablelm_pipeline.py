@@ -1,15 +1,18 @@
+import numpy as np
 import torch
-import torch_mlir
-from transformers import AutoTokenizer, StoppingCriteria, AutoModelForCausalLM
-from io import BytesIO
-from pathlib import Path
-from apps.language_models.utils import (
-    get_torch_mlir_module_bytecode,
-    get_vmfb_from_path,
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    StoppingCriteria,
+    AutoModelForCausalLM,
 )
+from apps.language_models.utils import compile_torch_module
 from apps.language_models.src.pipelines.SharkLLMBase import SharkLLMBase
+from shark.shark_bucketed_inference import SharkBucketedInference
+from shark.shark_sampler import SharkSampler
 from apps.language_models.src.model_wrappers.stablelm_model import (
-    StableLMModel,
+    StableLMDecode,
+    StableLMPrefill,
 )
 
 
@@ -32,12 +35,26 @@ class SharkStableLM(SharkLLMBase):
         max_num_tokens=512,
         device="cuda",
         precision="fp32",
+        seq_len_buckets=(32, 64, 128, 256),
+        temperature=0.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
     ) -> None:
         super().__init__(model_name, hf_model_path, max_num_tokens)
-        self.max_sequence_len = 256
+        self.seq_len_buckets = sorted(seq_len_buckets)
+        self.max_sequence_len = self.seq_len_buckets[-1]
         self.device = device
         self.precision = precision
         self.tokenizer = self.get_tokenizer()
+        self.sampler = SharkSampler(
+            AutoConfig.from_pretrained(self.hf_model_path).vocab_size,
+            device=self.device,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
         self.shark_model = self.compile()
 
     def shouldStop(self, tokens):
@@ -53,69 +70,71 @@ class SharkStableLM(SharkLLMBase):
         )
         return model
 
-    def get_model_inputs(self):
-        input_ids = torch.randint(3, (1, self.max_sequence_len))
-        attention_mask = torch.randint(3, (1, self.max_sequence_len))
+    def get_model_inputs(self, seq_len):
+        input_ids = torch.randint(3, (1, seq_len))
+        attention_mask = torch.randint(3, (1, seq_len))
         return input_ids, attention_mask
 
-    def compile(self):
-        tmp_model_name = (
-            f"stableLM_linalg_{self.precision}_seqLen{self.max_sequence_len}"
+    def get_decode_inputs(self):
+        config = AutoConfig.from_pretrained(self.hf_model_path)
+        head_dim = config.hidden_size // config.num_attention_heads
+        input_ids = torch.zeros([1, 1], dtype=torch.int64)
+        position_ids = torch.zeros([1, 1], dtype=torch.int64)
+        pkv = tuple(
+            torch.zeros(
+                [
+                    1,
+                    config.num_attention_heads,
+                    self.max_sequence_len,
+                    head_dim,
+                ],
+                dtype=torch.float32,
+            )
+            for _ in range(2 * config.num_hidden_layers)
         )
+        return (input_ids, position_ids) + pkv
 
-        # device = "cuda"  # "cpu"
-        # TODO: vmfb and mlir name should include precision and device
-        model_vmfb_name = None
-        vmfb_path = (
-            Path(tmp_model_name + f"_{self.device}.vmfb")
-            if model_vmfb_name is None
-            else Path(model_vmfb_name)
-        )
-        shark_module = get_vmfb_from_path(
-            vmfb_path, self.device, mlir_dialect="tm_tensor"
+    def compile(self):
+        # The prompt is run by one prefill module per sequence length bucket,
+        # compiled the first time a prompt of that length shows up. The
+        # tokens after it are run one at a time by the decode module.
+        self.decode_model = None
+        return SharkBucketedInference(
+            self.compile_prefill,
+            self.seq_len_buckets,
+            dynamic_dims=(1, 1),
+            pad_values=(self.tokenizer.pad_token_id, 0),
+            device=self.device,
+            mlir_dialect="tm_tensor",
         )
-        if shark_module is not None:
-            return shark_module
 
-        mlir_path = Path(tmp_model_name + ".mlir")
-        print(
-            f"[DEBUG] mlir path {mlir_path} {'exists' if mlir_path.exists() else 'does not exist'}"
-        )
-        if mlir_path.exists():
-            with open(mlir_path, "rb") as f:
-                bytecode = f.read()
-        else:
-            model = StableLMModel(self.get_src_model())
-            model_inputs = self.get_model_inputs()
-            ts_graph = get_torch_mlir_module_bytecode(model, model_inputs)
-            module = torch_mlir.compile(
-                ts_graph,
-                [*model_inputs],
-                torch_mlir.OutputType.LINALG_ON_TENSORS,
-                use_tracing=False,
-                verbose=False,
-            )
-            bytecode_stream = BytesIO()
-            module.operation.write_bytecode(bytecode_stream)
-            bytecode = bytecode_stream.getvalue()
-        f_ = open(tmp_model_name + ".mlir", "wb")
-        f_.write(bytecode)
-        print("Saved mlir")
-        f_.close()
-
-        from shark.shark_inference import SharkInference
-
-        shark_module = SharkInference(
-            mlir_module=bytecode, device=self.device, mlir_dialect="tm_tensor"
+    def compile_prefill(self, seq_len):
+        return self.compile_module(
+            f"stableLM_prefill_linalg_{self.precision}_seqLen{seq_len}"
+            f"_maxLen{self.max_sequence_len}",
+            lambda: StableLMPrefill(
+                self.get_src_model(), self.max_sequence_len
+            ),
+            lambda: self.get_model_inputs(seq_len),
         )
-        shark_module.compile()
 
-        path = shark_module.save_module(
-            vmfb_path.parent.absolute(), vmfb_path.stem
+    def compile_decode(self):
+        return self.compile_module(
+            f"stableLM_decode_linalg_{self.precision}"
+            f"_maxLen{self.max_sequence_len}",
+            lambda: StableLMDecode(self.get_src_model()),
+            self.get_decode_inputs,
         )
-        print("Saved vmfb at ", str(path))
 
-        return shark_module
+    def get_decode_model(self):
+        if self.decode_model is None:
+            self.decode_model = self.compile_decode()
+        return self.decode_model
+
+    def compile_module(self, tmp_model_name, get_model, get_model_inputs):
+        return compile_torch_module(
+            tmp_model_name, get_model, get_model_inputs, self.device
+        )
 
     def get_tokenizer(self):
         tok = AutoTokenizer.from_pretrained(self.hf_model_path)
@@ -125,9 +144,16 @@ class SharkStableLM(SharkLLMBase):
 
     def generate(self, prompt):
         words_list = []
+        # The prompt is tokenized once, generated tokens are appended to it.
+        input_ids = self.tokenizer(
+            prompt, max_length=self.max_sequence_len, truncation=True
+        ).input_ids
+        self.sampler.reset(input_ids)
+        pkv = None
         for i in range(self.max_num_tokens):
             params = {
-                "new_text": prompt,
+                "input_ids": input_ids,
+                "pkv": pkv,
             }
 
             generated_token_op = self.generate_new_token(params)
@@ -142,28 +168,42 @@ class SharkStableLM(SharkLLMBase):
             words_list.append(detok)
             if detok == "":
                 break
-            prompt = prompt + detok
+            input_ids = input_ids + [int(generated_token_op["new_token"])]
+            pkv = generated_token_op["pkv"]
+            if len(input_ids) >= self.max_sequence_len:
+                # The key/value cache is full.
+                break
         return words_list
 
     def generate_new_token(self, params):
-        new_text = params["new_text"]
-        model_inputs = self.tokenizer(
-            [new_text],
-            padding="max_length",
-            max_length=self.max_sequence_len,
-            truncation=True,
-            return_tensors="pt",
-        )
-        sum_attentionmask = torch.sum(model_inputs.attention_mask)
-        output = self.shark_model(
-            "forward", [model_inputs.input_ids, model_inputs.attention_mask]
-        )
-        output = torch.from_numpy(output)
-        next_toks = torch.topk(output, 1)
+        # Without a cache all the ids are run through the prefill module,
+        # otherwise only the last one is run through the decode module. The
+        # cache and the logits stay on the device, only the sampled token is
+        # copied back.
+        input_ids = params["input_ids"]
+        pkv = params["pkv"]
+        if pkv is None:
+            output = self.shark_model(
+                "forward",
+                [
+                    torch.tensor([input_ids], dtype=torch.int64),
+                    torch.ones([1, len(input_ids)], dtype=torch.int64),
+                ],
+                send_to_host=False,
+            )
+            new_token = self.sampler(output[0], len(input_ids) - 1)
+        else:
+            token = np.array([[input_ids[-1]]], dtype=np.int64)
+            position = np.array([[len(input_ids) - 1]], dtype=np.int64)
+            output = self.get_decode_model()(
+                "forward",
+                (token, position) + tuple(pkv),
+                send_to_host=False,
+            )
+            new_token = self.sampler(output[0])
         stop_generation = False
-        if self.shouldStop(next_toks.indices):
+        if self.shouldStop([[new_token]]):
             stop_generation = True
-        new_token = next_toks.indices[0][int(sum_attentionmask) - 1]
         detok = self.tokenizer.decode(
             new_token,
             skip_special_tokens=True,
@@ -172,6 +212,7 @@ class SharkStableLM(SharkLLMBase):
             "new_token": new_token,
             "detok": detok,
             "stop_generation": stop_generation,
+            "pkv": output[1:],
         }
         return ret_dict
 
@@ -0,0 +1,345 @@
+from apps.language_models.src.model_wrappers.vicuna_model import (
+    BatchedSecondVicuna,
+    KVSlotInsert,
+    PaddedFirstVicuna,
+)
+from apps.language_models.utils import compile_torch_module
+from concurrent.futures import Future
+from shark.shark_bucketed_inference import SharkBucketedInference
+from shark.shark_sampler import SharkSampler
+from transformers import AutoConfig, AutoTokenizer
+
+import collections
+import threading
+import time
+import numpy as np
+import torch
+
+
+class VicunaSequence:
+    def __init__(self, input_ids, max_new_tokens, callback):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.callback = callback
+        self.future = Future()
+        self.tokens = []
+        self.slot = None
+        # Cache slot the next decoded token is written to.
+        self.position = len(input_ids)
+        self.submit_time = time.time()
+
+
+class VicunaBatchEngine:
+    """
+    Continuous batching of many Vicuna conversations on one device.
+
+    ...
+
+    The key/value cache is a pool of `num_slots` rows of
+    `max_sequence_length` positions living on the device. Between two decode
+    steps, waiting prompts are prefilled into the free rows; every decode
+    step then generates one token for all the occupied rows at once, each
+    at its own position, and a sequence leaves its row as soon as it is
+    finished so the row can be reused at the next step.
+
+    Attributes
+    ----------
+    hf_model_path : str
+        HuggingFace model the modules are built from.
+    device : str
+        device running the modules.
+    num_slots : int
+        batch size of the decode module, i.e. how many conversations are
+        decoded together.
+    max_sequence_length : int
+        prompt plus generated tokens a slot can hold.
+    prefill_buckets : tuple
+        prompt lengths the prefill module is compiled for.
+
+    Methods
+    -------
+    submit(prompt, max_new_tokens=512, callback=None):
+        Queues a prompt and returns a future of the generated text.
+        `callback` is called with the text of every generated token.
+    metrics():
+        Returns slot occupancy and throughput counters.
+    close():
+        Finishes the queued prompts and stops the scheduler thread.
+    """
+
+    def __init__(
+        self,
+        hf_model_path="TheBloke/vicuna-7B-1.1-HF",
+        device="cuda",
+        precision="fp32",
+        num_slots=8,
+        max_sequence_length=512,
+        prefill_buckets=(64, 128, 256, 512),
+        eos_token_id=2,
+        temperature=0.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
+    ):
+        self.hf_model_path = hf_model_path
+        self.device = device
+        self.precision = precision
+        self.num_slots = num_slots
+        self.max_sequence_length = max_sequence_length
+        self.prefill_buckets = tuple(
+            b for b in sorted(prefill_buckets) if b <= max_sequence_length
+        )
+        self.eos_token_id = eos_token_id
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            hf_model_path, use_fast=False
+        )
+        self.config = AutoConfig.from_pretrained(hf_model_path)
+
+        self.prefill_model = SharkBucketedInference(
+            self.compile_prefill,
+            self.prefill_buckets,
+            dynamic_dims=(1, 1),
+            device=device,
+            mlir_dialect="tm_tensor",
+        )
+        self.decode_model = self.compile_decode()
+        self.insert_model = self.compile_insert()
+
+        # One sampler per slot for the per sequence state (seen tokens),
+        # all running the same compiled sampling module.
+        self.samplers = [
+            SharkSampler(
+                self.config.vocab_size,
+                device=device,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+            )
+            for _ in range(num_slots)
+        ]
+        for sampler in self.samplers[1:]:
+            sampler.shark_module = self.samplers[0].get_shark_module()
+
+        self.cache = tuple(
+            self.decode_model.to_device(np.zeros(shape, dtype=np.float32))
+            for shape in self.get_cache_shapes(num_slots)
+        )
+        self.slots = [None] * num_slots
+        self._waiting = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            "requests": 0,
+            "finished": 0,
+            "generated_tokens": 0,
+            "decode_steps": 0,
+            "occupied_slot_steps": 0,
+            "queue_wait_ms_sum": 0.0,
+        }
+        self._start_time = time.time()
+        self._thread = threading.Thread(
+            target=self._schedule, name="vicuna-batch-engine", daemon=True
+        )
+        self._thread.start()
+
+    def get_cache_shapes(self, batch_size):
+        head_dim = self.config.hidden_size // self.config.num_attention_heads
+        shape = [
+            batch_size,
+            self.config.num_attention_heads,
+            self.max_sequence_length,
+            head_dim,
+        ]
+        return [shape] * (2 * self.config.num_hidden_layers)
+
+    def compile_prefill(self, seq_len):
+        return compile_torch_module(
+            f"vicuna_prefill_{self.precision}_seqLen{seq_len}"
+            f"_maxLen{self.max_sequence_length}",
+            lambda: PaddedFirstVicuna(
+                self.hf_model_path, self.max_sequence_length
+            ),
+            lambda: (
+                torch.zeros([1, seq_len], dtype=torch.int64),
+                torch.ones([1, seq_len], dtype=torch.int64),
+            ),
+            self.device,
+        )
+
+    def compile_decode(self):
+        return compile_torch_module(
+            f"vicuna_decode_{self.precision}_batch{self.num_slots}"
+            f"_maxLen{self.max_sequence_length}",
+            lambda: BatchedSecondVicuna(self.hf_model_path),
+            lambda: (
+                torch.zeros([self.num_slots, 1], dtype=torch.int64),
+                torch.zeros([self.num_slots, 1], dtype=torch.int64),
+            )
+            + tuple(
+                torch.zeros(shape)
+                for shape in self.get_cache_shapes(self.num_slots)
+            ),
+            self.device,
+        )
+
+    def compile_insert(self):
+        return compile_torch_module(
+            f"vicuna_kv_insert_{self.precision}_batch{self.num_slots}"
+            f"_maxLen{self.max_sequence_length}",
+            KVSlotInsert,
+            lambda: (torch.zeros([1], dtype=torch.int64),)
+            + tuple(
+                torch.zeros(shape)
+                for shape in self.get_cache_shapes(self.num_slots)
+            )
+            + tuple(torch.zeros(shape) for shape in self.get_cache_shapes(1)),
+            self.device,
+        )
+
+    def submit(self, prompt, max_new_tokens=512, callback=None):
+        input_ids = self.tokenizer(prompt).input_ids
+        if len(input_ids) > self.prefill_buckets[-1]:
+            raise ValueError(
+                f"Prompt of {len(input_ids)} tokens is longer than the "
+                f"largest prefill bucket {self.prefill_buckets[-1]}."
+            )
+        sequence = VicunaSequence(input_ids, max_new_tokens, callback)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("VicunaBatchEngine is closed.")
+            self._waiting.append(sequence)
+            self._metrics["requests"] += 1
+            self._cond.notify_all()
+        return sequence.future
+
+    def _active(self):
+        return [seq for seq in self.slots if seq is not None]
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while not self._waiting and not self._active():
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                admitted = []
+                for slot in range(self.num_slots):
+                    if not self._waiting:
+                        break
+                    if self.slots[slot] is None:
+                        sequence = self._waiting.popleft()
+                        sequence.slot = slot
+                        self.slots[slot] = sequence
+                        admitted.append(sequence)
+
+                self._metrics["queue_wait_ms_sum"] += sum(
+                    (time.time() - sequence.submit_time) * 1000
+                    for sequence in admitted
+                )
+
+            for sequence in admitted:
+                try:
+                    self._prefill(sequence)
+                except Exception as e:
+                    self._finish(sequence, e)
+            if self._active():
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    for sequence in self._active():
+                        self._finish(sequence, e)
+
+    def _prefill(self, sequence):
+        input_ids = sequence.input_ids
+        output = self.prefill_model(
+            "forward",
+            (
+                np.array([input_ids], dtype=np.int64),
+                np.ones([1, len(input_ids)], dtype=np.int64),
+            ),
+            send_to_host=False,
+        )
+        slot = np.array([sequence.slot], dtype=np.int64)
+        self.cache = tuple(
+            self.insert_model(
+                "forward",
+                (slot,) + self.cache + tuple(output[1:]),
+                send_to_host=False,
+            )
+        )
+        sampler = self.samplers[sequence.slot]
+        sampler.reset(input_ids)
+        self._append(sequence, sampler(output[0], len(input_ids) - 1))
+
+    def _decode_step(self):
+        tokens = np.zeros([self.num_slots, 1], dtype=np.int64)
+        positions = np.zeros([self.num_slots, 1], dtype=np.int64)
+        active = self._active()
+        for sequence in active:
+            tokens[sequence.slot, 0] = sequence.tokens[-1]
+            positions[sequence.slot, 0] = sequence.position
+        # Free rows decode a dummy token into their own row, which is
+        # overwritten when a sequence is admitted to it.
+        output = self.decode_model(
+            "forward", (tokens, positions) + self.cache, send_to_host=False
+        )
+        self.cache = tuple(output[1:])
+        self._metrics["decode_steps"] += 1
+        self._metrics["occupied_slot_steps"] += len(active)
+        for sequence in active:
+            sequence.position += 1
+            token = self.samplers[sequence.slot](output[0], sequence.slot)
+            self._append(sequence, token)
+
+    def _append(self, sequence, token):
+        if token == self.eos_token_id:
+            self._finish(sequence)
+            return
+        sequence.tokens.append(token)
+        self._metrics["generated_tokens"] += 1
+        if sequence.callback is not None:
+            sequence.callback(self.tokenizer.decode(token))
+        if (
+            len(sequence.tokens) >= sequence.max_new_tokens
+            or sequence.position >= self.max_sequence_length
+        ):
+            self._finish(sequence)
+
+    def _finish(self, sequence, exception=None):
+        # Evicted right away: the slot can take a new prompt before the
+        # next decode step.
+        with self._cond:
+            self.slots[sequence.slot] = None
+            self._metrics["finished"] += 1
+        if exception is not None:
+            sequence.future.set_exception(exception)
+        else:
+            sequence.future.set_result(self.tokenizer.decode(sequence.tokens))
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["waiting"] = len(self._waiting)
+            metrics["active"] = len(self._active())
+        steps = metrics["decode_steps"]
+        metrics["mean_slot_occupancy"] = (
+            metrics["occupied_slot_steps"] / (steps * self.num_slots)
+            if steps
+            else 0.0
+        )
+        elapsed = time.time() - self._start_time
+        metrics["tokens_per_second"] = (
+            metrics["generated_tokens"] / elapsed if elapsed else 0.0
+        )
+        admitted = metrics["requests"] - metrics["waiting"]
+        metrics["mean_queue_wait_ms"] = (
+            metrics["queue_wait_ms_sum"] / admitted if admitted else 0.0
+        )
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -8,8 +8,10 @@ from io import BytesIO
 from pathlib import Path
 from shark.shark_downloader import download_public_file
 from shark.shark_inference import SharkInference
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from shark.shark_sampler import SharkSampler
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
 
+import numpy as np
 import re
 import torch
 import torch_mlir
@@ -26,6 +28,10 @@ class Vicuna(SharkLLMBase):
         precision="fp32",
         first_vicuna_vmfb_path=Path("first_vicuna.vmfb"),
         second_vicuna_vmfb_path=Path("second_vicuna.vmfb"),
+        temperature=0.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
     ) -> None:
         super().__init__(model_name, hf_model_path, max_num_tokens)
         self.max_sequence_length = 256
@@ -34,6 +40,14 @@ class Vicuna(SharkLLMBase):
         self.first_vicuna_vmfb_path = first_vicuna_vmfb_path
         self.second_vicuna_vmfb_path = second_vicuna_vmfb_path
         self.tokenizer = self.get_tokenizer()
+        self.sampler = SharkSampler(
+            AutoConfig.from_pretrained(self.hf_model_path).vocab_size,
+            device=self.device,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
         self.shark_model = self.compile()
 
     def get_tokenizer(self):
@@ -191,10 +205,10 @@ class Vicuna(SharkLLMBase):
             secondVicunaCompileInput = list(secondVicunaCompileInput)
             for i in range(len(secondVicunaCompileInput)):
                 if i != 0:
-                    secondVicunaCompileInput[
-                        i
-                    ] = torch_mlir.TensorPlaceholder.like(
-                        secondVicunaCompileInput[i], dynamic_axes=[2]
+                    secondVicunaCompileInput[i] = (
+                        torch_mlir.TensorPlaceholder.like(
+                            secondVicunaCompileInput[i], dynamic_axes=[2]
+                        )
                     )
             secondVicunaCompileInput = tuple(secondVicunaCompileInput)
             module = torch_mlir.compile(
@@ -330,7 +344,6 @@ class Vicuna(SharkLLMBase):
         generated_token_op = self.generate_new_token(params=params)
 
         token = generated_token_op["token"]
-        logits = generated_token_op["logits"]
         pkv = generated_token_op["pkv"]
         detok = generated_token_op["detok"]
 
@@ -347,7 +360,7 @@ class Vicuna(SharkLLMBase):
             params = {
                 "prompt": None,
                 "is_first": False,
-                "logits": logits,
+                "token": token,
                 "pkv": pkv,
                 "sv": sec_vic,
             }
@@ -355,7 +368,6 @@ class Vicuna(SharkLLMBase):
             generated_token_op = self.generate_new_token(params=params)
 
             token = generated_token_op["token"]
-            logits = generated_token_op["logits"]
             pkv = generated_token_op["pkv"]
             detok = generated_token_op["detok"]
 
@@ -380,49 +392,58 @@ class Vicuna(SharkLLMBase):
         return res_str
 
     def generate_new_token(self, params):
+        # The past key values and the logits stay on the device as returned
+        # by the modules (send_to_host=False); the pkv are fed back as is and
+        # only the token sampled from the logits is copied to the host.
         def forward_first(first_vic, prompt, cache_outputs=False):
             input_ids = self.tokenizer(prompt).input_ids
             input_id_len = len(input_ids)
-            input_ids = torch.tensor(input_ids)
+            self.sampler.reset(input_ids)
+            input_ids = np.array(input_ids, dtype=np.int64)
             input_ids = input_ids.reshape([1, input_id_len])
             firstVicunaInput = (input_ids,)
             assert first_vic is not None
-            output_first_vicuna = first_vic("forward", firstVicunaInput)
-            output_first_vicuna_tensor = torch.tensor(output_first_vicuna[1:])
-            logits_first_vicuna = torch.tensor(output_first_vicuna[0])
+            output_first_vicuna = first_vic(
+                "forward", firstVicunaInput, send_to_host=False
+            )
+            pkv = tuple(output_first_vicuna[1:])
+            logits = output_first_vicuna[0]
             if cache_outputs:
                 torch.save(
-                    logits_first_vicuna, "logits_first_vicuna_tensor.pt"
+                    torch.from_numpy(logits.to_host()),
+                    "logits_first_vicuna_tensor.pt",
                 )
                 torch.save(
-                    output_first_vicuna_tensor, "output_first_vicuna_tensor.pt"
+                    torch.tensor(np.array([x.to_host() for x in pkv])),
+                    "output_first_vicuna_tensor.pt",
                 )
-            token = torch.argmax(
-                torch.tensor(logits_first_vicuna)[:, -1, :], dim=1
-            )
-            return token, logits_first_vicuna, output_first_vicuna_tensor
+            token = self.sampler(logits)
+            return token, logits, pkv
 
         def forward_second(sec_vic, inputs=None, load_inputs=False):
             if inputs is not None:
-                logits = inputs[0]
+                token = inputs[0]
                 pkv = inputs[1:]
             elif load_inputs:
                 pkv = torch.load("output_first_vicuna_tensor.pt")
-                pkv = tuple(torch.tensor(x) for x in pkv)
-                logits = torch.load("logits_first_vicuna_tensor.pt")
+                pkv = tuple(sec_vic.to_device(x) for x in pkv)
+                token = self.sampler(
+                    torch.load("logits_first_vicuna_tensor.pt")
+                )
             else:
                 print(
                     "Either inputs must be given, or load_inputs must be true"
                 )
                 return None
-            token = torch.argmax(torch.tensor(logits)[:, -1, :], dim=1)
-            token = token.to(torch.int64).reshape([1, 1])
+            token = np.array([[token]], dtype=np.int64)
             secondVicunaInput = (token,) + tuple(pkv)
 
-            secondVicunaOutput = sec_vic("forward", secondVicunaInput)
-            new_pkv = secondVicunaOutput[1:]
+            secondVicunaOutput = sec_vic(
+                "forward", secondVicunaInput, send_to_host=False
+            )
+            new_pkv = tuple(secondVicunaOutput[1:])
             new_logits = secondVicunaOutput[0]
-            new_token = torch.argmax(torch.tensor(new_logits)[:, -1, :], dim=1)
+            new_token = self.sampler(new_logits)
             return new_token, new_logits, new_pkv
 
         is_first = params["is_first"]
@@ -436,9 +457,9 @@ class Vicuna(SharkLLMBase):
                 cache_outputs=False,
             )
         else:
-            _logits = params["logits"]
+            _token = params["token"]
             _pkv = params["pkv"]
-            inputs = (_logits,) + tuple(_pkv)
+            inputs = (_token,) + tuple(_pkv)
             sv = params["sv"]
             token, logits, pkv = forward_second(
                 sv,  # self.shark_model[1],
@@ -9,8 +9,10 @@ from apps.language_models.src.pipelines.SharkLLMBase import SharkLLMBase
 from apps.language_models.utils import get_torch_mlir_module_bytecode
 from io import BytesIO
 from pathlib import Path
-from shark.shark_inference import SharkInference
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from shark.iree_utils.layer_compile import LayerCompiler, save_compiled_layer
+from shark.shark_sharding import load_layer_module
+from shark.shark_sampler import SharkSampler
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
 from tqdm import tqdm
 from torch_mlir import TensorPlaceholder
 
@@ -29,12 +31,24 @@ class Vicuna(SharkLLMBase):
         max_num_tokens=512,
         device="cuda",
         precision="fp32",
+        temperature=0.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
     ) -> None:
         super().__init__(model_name, hf_model_path, max_num_tokens)
         self.max_sequence_length = 256
         self.device = device
         self.precision = precision
         self.tokenizer = self.get_tokenizer()
+        self.sampler = SharkSampler(
+            AutoConfig.from_pretrained(self.hf_model_path).vocab_size,
+            device=self.device,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
         self.shark_model = self.compile()
 
     def get_tokenizer(self):
@@ -124,6 +138,19 @@ class Vicuna(SharkLLMBase):
 
     def compile_to_vmfb(self, inputs, layers, is_first=True):
         mlirs, modules = [], []
+        suffix = "0" if is_first else "1"
+        # Layers differing only in their weights share one compile, run in
+        # worker processes while the next layers are imported.
+        compiler = LayerCompiler(
+            "cpu",
+            "tm_tensor",
+            extra_args=[
+                "--iree-hal-dump-executable-sources-to=ies",
+                "--iree-vm-target-truncate-unsupported-floats",
+                "--iree-codegen-check-ir-before-llvm-conversion=false",
+                "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
+            ],
+        )
         for idx, layer in tqdm(enumerate(layers), desc="Getting mlirs"):
             if is_first:
                 mlir_path = Path(f"{idx}_0.mlir")
@@ -228,64 +255,18 @@ class Vicuna(SharkLLMBase):
                 f_.write(bytecode)
                 f_.close()
             mlirs.append(bytecode)
+            print(f"Compiling layer {idx} vmfb")
+            compiler.add(f"{idx}_{suffix}", bytecode)
 
-        for idx, layer in tqdm(enumerate(layers), desc="compiling modules"):
-            if is_first:
-                vmfb_path = Path(f"{idx}_0.vmfb")
-                if idx < 25:
-                    device = "cpu"
-                else:
-                    device = "cpu"
-                if vmfb_path.exists():
-                    # print(f"Found layer {idx} vmfb")
-                    module = SharkInference(
-                        None, device=device, mlir_dialect="tm_tensor"
-                    )
-                    module.load_module(vmfb_path)
-                else:
-                    print(f"Compiling layer {idx} vmfb")
-                    module = SharkInference(
-                        mlirs[idx], device=device, mlir_dialect="tm_tensor"
-                    )
-                    module.save_module(
-                        module_name=f"{idx}_0",
-                        extra_args=[
-                            "--iree-hal-dump-executable-sources-to=ies",
-                            "--iree-vm-target-truncate-unsupported-floats",
-                            "--iree-codegen-check-ir-before-llvm-conversion=false",
-                            "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
-                        ],
-                    )
-                    module.load_module(vmfb_path)
-                modules.append(module)
-            else:
-                vmfb_path = Path(f"{idx}_1.vmfb")
-                if idx < 25:
-                    device = "cpu"
-                else:
-                    device = "cpu"
-                if vmfb_path.exists():
-                    # print(f"Found layer {idx} vmfb")
-                    module = SharkInference(
-                        None, device=device, mlir_dialect="tm_tensor"
-                    )
-                    module.load_module(vmfb_path)
-                else:
-                    print(f"Compiling layer {idx} vmfb")
-                    module = SharkInference(
-                        mlirs[idx], device=device, mlir_dialect="tm_tensor"
-                    )
-                    module.save_module(
-                        module_name=f"{idx}_1",
-                        extra_args=[
-                            "--iree-hal-dump-executable-sources-to=ies",
-                            "--iree-vm-target-truncate-unsupported-floats",
-                            "--iree-codegen-check-ir-before-llvm-conversion=false",
-                            "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
-                        ],
-                    )
-                    module.load_module(vmfb_path)
-                modules.append(module)
+        for name, compiled_layer in compiler.compile().items():
+            save_compiled_layer(Path(f"{name}.vmfb"), compiled_layer)
+
+        for idx, layer in tqdm(enumerate(layers), desc="loading modules"):
+            modules.append(
+                load_layer_module(
+                    Path(f"{idx}_{suffix}.vmfb"), "cpu", "tm_tensor"
+                )
+            )
 
         return mlirs, modules
 
@@ -370,6 +351,7 @@ class Vicuna(SharkLLMBase):
             prompt = params["prompt"]
             input_ids = self.tokenizer(prompt).input_ids
             input_id_len = len(input_ids)
+            self.sampler.reset(input_ids)
             input_ids = torch.tensor(input_ids)
             input_ids = input_ids.reshape([1, input_id_len])
             output = self.shark_model.forward(input_ids, is_first=is_first)
@@ -386,7 +368,9 @@ class Vicuna(SharkLLMBase):
 
         _logits = output["logits"]
         _past_key_values = output["past_key_values"]
-        _token = int(torch.argmax(_logits[:, -1, :], dim=1)[0])
+        # The lm_head of the sharded model runs in torch, so the logits are
+        # already on the host and the sampler runs eagerly.
+        _token = self.sampler(_logits)
         _detok = self.tokenizer.decode(_token)
 
         ret_dict = {
@@ -0,0 +1,202 @@
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from apps.language_models.src.pipelines import vicuna_batch_engine
+from apps.language_models.src.pipelines.vicuna_batch_engine import (
+    VicunaBatchEngine,
+)
+
+# The fake model generates the previous token + 1. The cache has one layer,
+# one head and a head dim of 1, storing the token at each position.
+EOS = 10
+CONFIG = types.SimpleNamespace(
+    vocab_size=32, hidden_size=1, num_attention_heads=1, num_hidden_layers=1
+)
+
+
+class FakeTokenizer:
+    def __call__(self, prompt):
+        return types.SimpleNamespace(
+            input_ids=[int(t) for t in prompt.split()]
+        )
+
+    def decode(self, tokens):
+        if isinstance(tokens, list):
+            return " ".join(str(t) for t in tokens)
+        return str(tokens)
+
+
+class FakePrefill:
+    # Stands in for SharkBucketedInference: returns the "logits", here the
+    # next token at the last position, and the cache of the prompt.
+    def __init__(self, max_sequence_length):
+        self.max_sequence_length = max_sequence_length
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        input_ids = inputs[0][0]
+        logits = np.append(input_ids[1:], input_ids[-1] + 1)
+        cache = np.zeros([1, 1, self.max_sequence_length, 1], np.float32)
+        cache[0, 0, : len(input_ids), 0] = input_ids
+        return [logits, cache, cache.copy()]
+
+
+class FakeInsert:
+    def __init__(self):
+        self.slots = []
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        slot = int(inputs[0][0])
+        num_layers = (len(inputs) - 1) // 2
+        cache, new = inputs[1 : 1 + num_layers], inputs[1 + num_layers :]
+        self.slots.append((int(new[0][0, 0, 0, 0]), slot))
+        outputs = []
+        for rows, row in zip(cache, new):
+            rows = rows.copy()
+            rows[slot] = row[0]
+            outputs.append(rows)
+        return outputs
+
+
+class FakeDecode:
+    def __init__(self, error=None):
+        self.error = error
+
+    def to_device(self, array):
+        return array
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        if self.error is not None:
+            raise self.error
+        tokens, positions, *cache = inputs
+        cache = [rows.copy() for rows in cache]
+        for row in range(len(tokens)):
+            cache[0][row, 0, positions[row, 0], 0] = tokens[row, 0]
+        return [tokens[:, 0] + 1] + cache
+
+
+class FakeSampler:
+    # Picks the "logits" of the sequence, see FakePrefill and FakeDecode.
+    def __init__(self, vocab_size, **kwargs):
+        self.shark_module = None
+
+    def get_shark_module(self):
+        return self.shark_module
+
+    def reset(self, input_ids):
+        pass
+
+    def __call__(self, logits, index):
+        return int(logits[index])
+
+
+class VicunaBatchEngineTest(unittest.TestCase):
+    def make_engine(self, num_slots=2, max_sequence_length=16, error=None):
+        self.insert = FakeInsert()
+        patches = [
+            mock.patch.object(
+                vicuna_batch_engine.AutoTokenizer,
+                "from_pretrained",
+                lambda *args, **kwargs: FakeTokenizer(),
+            ),
+            mock.patch.object(
+                vicuna_batch_engine.AutoConfig,
+                "from_pretrained",
+                lambda *args, **kwargs: CONFIG,
+            ),
+            mock.patch.object(
+                vicuna_batch_engine,
+                "SharkBucketedInference",
+                lambda *args, **kwargs: FakePrefill(max_sequence_length),
+            ),
+            mock.patch.object(
+                vicuna_batch_engine, "SharkSampler", FakeSampler
+            ),
+            mock.patch.object(
+                VicunaBatchEngine,
+                "compile_decode",
+                lambda self: FakeDecode(error),
+            ),
+            mock.patch.object(
+                VicunaBatchEngine, "compile_insert", lambda engine: self.insert
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+        try:
+            engine = VicunaBatchEngine(
+                device="cpu",
+                num_slots=num_slots,
+                max_sequence_length=max_sequence_length,
+                prefill_buckets=(4, 8),
+                eos_token_id=EOS,
+            )
+        finally:
+            for patch in patches:
+                patch.stop()
+        self.addCleanup(engine.close)
+        return engine
+
+    def test_eos_and_max_tokens(self):
+        engine = self.make_engine()
+        streamed = []
+        eos = engine.submit("6 7", callback=streamed.append)
+        max_tokens = engine.submit("20", max_new_tokens=3)
+        self.assertEqual(eos.result(timeout=5), "8 9")
+        self.assertEqual(streamed, ["8", "9"])
+        self.assertEqual(max_tokens.result(timeout=5), "21 22 23")
+
+    def test_max_sequence_length(self):
+        engine = self.make_engine(max_sequence_length=4)
+        # The 2 prompt tokens and the first 2 generated, fed back, fill the
+        # 4 cache positions; the token decoded from the last one ends it.
+        self.assertEqual(engine.submit("11 12").result(timeout=5), "13 14 15")
+
+    def test_admission_and_kv_insertion(self):
+        engine = self.make_engine(num_slots=2)
+        # Submitted together: the third prompt waits for a free slot and
+        # takes the one of the first, which finishes at its prefill.
+        with engine._cond:
+            futures = [
+                engine.submit("1", max_new_tokens=1),
+                engine.submit("3", max_new_tokens=4),
+                engine.submit("12", max_new_tokens=2),
+            ]
+        results = [future.result(timeout=5) for future in futures]
+        self.assertEqual(results, ["2", "4 5 6 7", "13 14"])
+        self.assertEqual(self.insert.slots, [(1, 0), (3, 1), (12, 0)])
+        # Each slot holds the prompt of its last sequence, then the tokens
+        # fed back by the decode steps. Slot 0 was free during the last
+        # step, which wrote a dummy token at its position 0.
+        np.testing.assert_array_equal(
+            engine.cache[0][1, 0, :4, 0], [3, 4, 5, 6]
+        )
+        self.assertEqual(engine.cache[0][0, 0, 1, 0], 13)
+        self.assertEqual(engine.slots, [None, None])
+
+    def test_decode_error(self):
+        engine = self.make_engine(error=RuntimeError("decode failed"))
+        future = engine.submit("3")
+        with self.assertRaisesRegex(RuntimeError, "decode failed"):
+            future.result(timeout=5)
+        self.assertEqual(engine.slots, [None, None])
+
+    def test_metrics(self):
+        engine = self.make_engine(num_slots=2)
+        engine.submit("3", max_new_tokens=3).result(timeout=5)
+        metrics = engine.metrics()
+        self.assertEqual(metrics["requests"], 1)
+        self.assertEqual(metrics["finished"], 1)
+        self.assertEqual(metrics["generated_tokens"], 3)
+        # The prefill generates the first token, two decode steps the rest,
+        # with one of the two slots occupied.
+        self.assertEqual(metrics["decode_steps"], 2)
+        self.assertAlmostEqual(metrics["mean_slot_occupancy"], 0.5)
+        self.assertEqual(metrics["waiting"], 0)
+        self.assertEqual(metrics["active"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
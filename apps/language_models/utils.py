@@ -1,6 +1,7 @@
 import torch
 from torch.fx.experimental.proxy_tensor import make_fx
 from torch._decomp import get_decompositions
+from io import BytesIO
 from typing import List
 from pathlib import Path
 
@@ -138,3 +139,63 @@ def get_vmfb_from_path(vmfb_path, device, mlir_dialect):
     shark_module.load_module(vmfb_path)
     print("Successfully loaded vmfb")
     return shark_module
+
+
+# Imports the torch module returned by `get_model` with the inputs returned by
+# `get_model_inputs` and compiles it, reusing the .mlir and .vmfb saved under
+# `tmp_model_name` by an earlier run if they exist.
+def compile_torch_module(
+    tmp_model_name,
+    get_model,
+    get_model_inputs,
+    device,
+    mlir_dialect="tm_tensor",
+):
+    import torch_mlir
+    from shark.shark_inference import SharkInference
+
+    # TODO: vmfb and mlir name should include precision and device
+    vmfb_path = Path(tmp_model_name + f"_{device}.vmfb")
+    shark_module = get_vmfb_from_path(
+        vmfb_path, device, mlir_dialect=mlir_dialect
+    )
+    if shark_module is not None:
+        return shark_module
+
+    mlir_path = Path(tmp_model_name + ".mlir")
+    print(
+        f"[DEBUG] mlir path {mlir_path} {'exists' if mlir_path.exists() else 'does not exist'}"
+    )
+    if mlir_path.exists():
+        with open(mlir_path, "rb") as f:
+            bytecode = f.read()
+    else:
+        model = get_model()
+        model_inputs = get_model_inputs()
+        ts_graph = get_torch_mlir_module_bytecode(model, model_inputs)
+        module = torch_mlir.compile(
+            ts_graph,
+            [*model_inputs],
+            torch_mlir.OutputType.LINALG_ON_TENSORS,
+            use_tracing=False,
+            verbose=False,
+        )
+        bytecode_stream = BytesIO()
+        module.operation.write_bytecode(bytecode_stream)
+        bytecode = bytecode_stream.getvalue()
+    f_ = open(tmp_model_name + ".mlir", "wb")
+    f_.write(bytecode)
+    print("Saved mlir")
+    f_.close()
+
+    shark_module = SharkInference(
+        mlir_module=bytecode, device=device, mlir_dialect=mlir_dialect
+    )
+    shark_module.compile()
+
+    path = shark_module.save_module(
+        vmfb_path.parent.absolute(), vmfb_path.stem
+    )
+    print("Saved vmfb at ", str(path))
+
+    return shark_module
@@ -47,6 +47,9 @@ sheds_list = [
     "EulerDiscrete",
     "EulerAncestralDiscrete",
     "SharkEulerDiscrete",
+    "SharkEulerAncestralDiscrete",
+    "SharkDPMSolverMultistep",
+    "SharkDDIM",
 ]
 
 
@@ -30,13 +30,12 @@ if __name__ == "__main__":
     schedulers = get_schedulers(args.hf_model_id)
 
     scheduler_obj = schedulers[args.scheduler]
-    image = (
-        Image.open(args.img_path)
-        .convert("RGB")
-        .resize((args.height, args.width))
-    )
+    # The models are compiled for one tile, the image is upscaled by tiles
+    # whatever its size.
+    args.height = args.upscaler_tile_size
+    args.width = args.upscaler_tile_size
+    image = Image.open(args.img_path).convert("RGB")
     seed = utils.sanitize_seed(args.seed)
-    # Adjust for height and width based on model
 
     upscaler_obj = UpscalerPipeline.from_pretrained(
         scheduler_obj,
@@ -73,13 +72,14 @@ if __name__ == "__main__":
         dtype,
         args.use_base_vae,
         cpu_scheduling,
+        args.upscaler_tile_overlap,
     )
     total_time = time.time() - start_time
     text_output = f"prompt={args.prompts}"
     text_output += f"\nnegative prompt={args.negative_prompts}"
     text_output += f"\nmodel_id={args.hf_model_id}, ckpt_loc={args.ckpt_loc}"
     text_output += f"\nscheduler={args.scheduler}, device={args.device}"
-    text_output += f"\nsteps={args.steps}, noise_level={args.noise_level}, guidance_scale={args.guidance_scale}, seed={seed}, size={args.height}x{args.width}"
+    text_output += f"\nsteps={args.steps}, noise_level={args.noise_level}, guidance_scale={args.guidance_scale}, seed={seed}, size={image.size[0]}x{image.size[1]}"
     text_output += (
         f", batch size={args.batch_size}, max_length={args.max_length}"
     )
@@ -14,5 +14,6 @@ from apps.stable_diffusion.src.pipelines import (
     OutpaintPipeline,
     StencilPipeline,
     UpscalerPipeline,
+    Text2ImageBatchScheduler,
 )
 from apps.stable_diffusion.src.schedulers import get_schedulers
@@ -21,6 +21,7 @@ from apps.stable_diffusion.src.utils import (
     get_extended_name,
     get_stencil_model_id,
     update_lora_weight,
+    synchronous_compile,
 )
 
 
@@ -62,6 +63,33 @@ def check_compilation(model, model_name):
         raise Exception(f"Could not compile {model_name}. Please create an issue with the detailed log at https://github.com/nod-ai/SHARK/issues")
 
 
+class UnetKStepModel(torch.nn.Module):
+    """
+    Runs `steps_per_call` denoising steps of a guided unet and a stateless
+    scheduler in one module. The schedule comes in as tensors, per step the
+    timestep, the input scale and the (sample, noise_pred) coefficients of
+    the scheduler update, so one compile serves any number of steps.
+    """
+
+    def __init__(self, unet, steps_per_call):
+        super().__init__()
+        self.unet = unet
+        self.steps_per_call = steps_per_call
+
+    def forward(
+        self, latent, text_embedding, guidance_scale, timesteps, scales, coeffs
+    ):
+        for i in range(self.steps_per_call):
+            noise_pred = self.unet(
+                latent * scales[i],
+                timesteps[i : i + 1],
+                text_embedding,
+                guidance_scale,
+            )
+            latent = coeffs[i, 0] * latent + coeffs[i, 1] * noise_pred
+        return latent
+
+
 class SharkifyStableDiffusionModel:
     def __init__(
         self,
@@ -163,7 +191,7 @@ class SharkifyStableDiffusionModel:
 
     def get_extended_name_for_all_model(self):
         model_name = {}
-        sub_model_list = ["clip", "unet", "stencil_unet", "vae", "vae_encode", "stencil_adaptor"]
+        sub_model_list = ["clip", "unet", "upscaler_unet", "stencil_unet", "vae", "vae_encode", "stencil_adaptor"]
         index = 0
         for model in sub_model_list:
             sub_model = model
@@ -210,7 +238,7 @@ class SharkifyStableDiffusionModel:
             input_map.append(tensor)
         return input_map
     
-    def get_vae_encode(self):
+    def get_vae_encode(self, tile_size=0):
         class VaeEncodeModel(torch.nn.Module):
             def __init__(self, model_id=self.model_id, low_cpu_mem_usage=False):
                 super().__init__()
@@ -227,12 +255,15 @@ class SharkifyStableDiffusionModel:
         vae_encode = VaeEncodeModel()
         inputs = tuple(self.inputs["vae_encode"])
         is_f16 = True if not self.is_upscaler and self.precision == "fp16" else False
+        extended_model_name = self.model_name["vae_encode"]
+        if tile_size:
+            extended_model_name += f"_tile{tile_size}x{inputs[0].shape[0]}"
         shark_vae_encode, vae_encode_mlir = compile_through_fx(
             vae_encode,
             inputs,
             is_f16=is_f16,
             use_tuned=self.use_tuned,
-            extended_model_name=self.model_name["vae_encode"],
+            extended_model_name=extended_model_name,
             extra_args=get_opt_flags("vae", precision=self.precision),
             base_model_id=self.base_model_id,
             model_name="vae_encode",
@@ -241,7 +272,7 @@ class SharkifyStableDiffusionModel:
         )
         return shark_vae_encode, vae_encode_mlir
 
-    def get_vae(self):
+    def get_vae(self, tile_size=0):
         class VaeModel(torch.nn.Module):
             def __init__(self, model_id=self.model_id, base_vae=self.base_vae, custom_vae=self.custom_vae, low_cpu_mem_usage=False):
                 super().__init__()
@@ -280,7 +311,10 @@ class SharkifyStableDiffusionModel:
         vae = VaeModel(low_cpu_mem_usage=self.low_cpu_mem_usage)
         inputs = tuple(self.inputs["vae"])
         is_f16 = True if not self.is_upscaler and self.precision == "fp16" else False
-        save_dir = os.path.join(self.sharktank_dir, self.model_name["vae"])
+        extended_model_name = self.model_name["vae"]
+        if tile_size:
+            extended_model_name += f"_tile{tile_size}x{inputs[0].shape[0]}"
+        save_dir = os.path.join(self.sharktank_dir, extended_model_name)
         if self.debug:
             os.makedirs(save_dir, exist_ok=True)
         shark_vae, vae_mlir = compile_through_fx(
@@ -288,7 +322,7 @@ class SharkifyStableDiffusionModel:
             inputs,
             is_f16=is_f16,
             use_tuned=self.use_tuned,
-            extended_model_name=self.model_name["vae"],
+            extended_model_name=extended_model_name,
             debug=self.debug,
             generate_vmfb=self.generate_vmfb,
             save_dir=save_dir,
@@ -415,7 +449,7 @@ class SharkifyStableDiffusionModel:
         )
         return shark_cnet, cnet_mlir
 
-    def get_unet(self):
+    def get_unet(self, steps_per_call=1, per_sample_guidance=False):
         class UnetModel(torch.nn.Module):
             def __init__(self, model_id=self.model_id, low_cpu_mem_usage=False, use_lora=self.use_lora):
                 super().__init__()
@@ -453,7 +487,27 @@ class SharkifyStableDiffusionModel:
         is_f16 = True if self.precision == "fp16" else False
         inputs = tuple(self.inputs["unet"])
         input_mask = [True, True, True, False]
-        save_dir = os.path.join(self.sharktank_dir, self.model_name["unet"])
+        extended_model_name = self.model_name["unet"]
+        if per_sample_guidance:
+            # One guidance scale per sample, broadcast over the noise preds.
+            latent, timestep, text_embedding, guidance_scale = inputs
+            guidance_scale = torch.ones(latent.shape[0], 1, 1, 1)
+            inputs = (latent, timestep, text_embedding, guidance_scale)
+            extended_model_name += "_per_sample_cfg"
+        if steps_per_call > 1:
+            unet = UnetKStepModel(unet, steps_per_call)
+            latent, timestep, text_embedding, guidance_scale = inputs
+            inputs = (
+                latent,
+                text_embedding,
+                guidance_scale,
+                timestep.repeat(steps_per_call),
+                torch.ones(steps_per_call),
+                torch.ones(steps_per_call, 2),
+            )
+            input_mask = [True, True, False, True, False, False]
+            extended_model_name += f"_{steps_per_call}steps"
+        save_dir = os.path.join(self.sharktank_dir, extended_model_name)
         if self.debug:
             os.makedirs(
                 save_dir,
@@ -462,7 +516,7 @@ class SharkifyStableDiffusionModel:
         shark_unet, unet_mlir = compile_through_fx(
             unet,
             inputs,
-            extended_model_name=self.model_name["unet"],
+            extended_model_name=extended_model_name,
             is_f16=is_f16,
             f16_input_mask=input_mask,
             use_tuned=self.use_tuned,
@@ -489,24 +543,32 @@ class SharkifyStableDiffusionModel:
                 self.in_channels = self.unet.in_channels
                 self.train(False)
 
-            def forward(self, latent, timestep, text_embedding, noise_level):
+            def forward(
+                self, latent, timestep, text_embedding, noise_level, guidance_scale,
+            ):
+                # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
+                latents = torch.cat([latent] * 2)
                 unet_out = self.unet.forward(
-                    latent,
+                    latents,
                     timestep,
                     text_embedding,
                     noise_level,
                     return_dict=False,
                 )[0]
-                return unet_out
+                noise_pred_uncond, noise_pred_text = unet_out.chunk(2)
+                noise_pred = noise_pred_uncond + guidance_scale * (
+                    noise_pred_text - noise_pred_uncond
+                )
+                return noise_pred
 
         unet = UnetModel(low_cpu_mem_usage=self.low_cpu_mem_usage)
         is_f16 = True if self.precision == "fp16" else False
         inputs = tuple(self.inputs["unet"])
-        input_mask = [True, True, True, False]
+        input_mask = [True, True, True, False, False]
         shark_unet, unet_mlir = compile_through_fx(
             unet,
             inputs,
-            extended_model_name=self.model_name["unet"],
+            extended_model_name=self.model_name["upscaler_unet"],
             is_f16=is_f16,
             f16_input_mask=input_mask,
             use_tuned=self.use_tuned,
@@ -579,7 +641,7 @@ class SharkifyStableDiffusionModel:
                 vae_dict = {k: v for k, v in vae_checkpoint.items() if k[0:4] != "loss" and k not in vae_ignore_keys}
                 return vae_dict
 
-    def compile_unet_variants(self, model):
+    def compile_unet_variants(self, model, steps_per_call=1, per_sample_guidance=False):
         if model == "unet":
             if self.is_upscaler:
                 return self.get_unet_upscaler()
@@ -588,14 +650,26 @@ class SharkifyStableDiffusionModel:
                 from apps.stable_diffusion.src.models.opt_params import get_unet
                 return get_unet()
             else:
-                return self.get_unet()
+                return self.get_unet(steps_per_call, per_sample_guidance)
         else:
             return self.get_controlled_unet()
 
-    def vae_encode(self):
+    # A `tile_size` compiles the module for batches of `tiles_per_call`
+    # square tiles of that many latent pixels instead of the full image, see
+    # run_tiled.
+    def vae_encode(self, tile_size=0, tiles_per_call=1):
         try:
             self.inputs["vae_encode"] = self.get_input_info_for(base_models["vae_encode"])
-            compiled_vae_encode, vae_encode_mlir = self.get_vae_encode()
+            if tile_size:
+                self.inputs["vae_encode"] = [
+                    torch.randn(
+                        self.batch_size * tiles_per_call,
+                        3,
+                        8 * tile_size,
+                        8 * tile_size,
+                    )
+                ]
+            compiled_vae_encode, vae_encode_mlir = self.get_vae_encode(tile_size)
 
             check_compilation(compiled_vae_encode, "Vae Encode")
             if self.return_mlir:
@@ -616,7 +690,9 @@ class SharkifyStableDiffusionModel:
         except Exception as e:
             sys.exit(e)
 
-    def unet(self):
+    # `steps_per_call` > 1 compiles the UnetKStepModel of the txt2img unet,
+    # `per_sample_guidance` takes a [batch_size, 1, 1, 1] guidance scale.
+    def unet(self, steps_per_call=1, per_sample_guidance=False):
         try:
             model = "stencil_unet" if self.use_stencil is not None else "unet"
             compiled_unet = None
@@ -624,14 +700,21 @@ class SharkifyStableDiffusionModel:
 
             if self.base_model_id != "":
                 self.inputs["unet"] = self.get_input_info_for(unet_inputs[self.base_model_id])
-                compiled_unet, unet_mlir = self.compile_unet_variants(model)
+                compiled_unet, unet_mlir = self.compile_unet_variants(
+                    model, steps_per_call, per_sample_guidance
+                )
             else:
                 for model_id in unet_inputs:
                     self.base_model_id = model_id
                     self.inputs["unet"] = self.get_input_info_for(unet_inputs[model_id])
 
                     try:
-                        compiled_unet, unet_mlir = self.compile_unet_variants(model)
+                        # The compile has to finish here to know whether
+                        # this configuration works.
+                        with synchronous_compile():
+                            compiled_unet, unet_mlir = self.compile_unet_variants(
+                                model, steps_per_call, per_sample_guidance
+                            )
                     except Exception as e:
                         print(e)
                         print("Retrying with a different base model configuration")
@@ -655,15 +738,24 @@ class SharkifyStableDiffusionModel:
         except Exception as e:
             sys.exit(e)
 
-    def vae(self):
+    def vae(self, tile_size=0, tiles_per_call=1):
         try:
             vae_input = base_models["vae"]["vae_upscaler"] if self.is_upscaler else base_models["vae"]["vae"]
             self.inputs["vae"] = self.get_input_info_for(vae_input)
+            if tile_size:
+                self.inputs["vae"] = [
+                    torch.randn(
+                        self.batch_size * tiles_per_call,
+                        4,
+                        tile_size,
+                        tile_size,
+                    )
+                ]
 
             is_base_vae = self.base_vae
             if self.is_upscaler:
                 self.base_vae = True
-            compiled_vae, vae_mlir = self.get_vae()
+            compiled_vae, vae_mlir = self.get_vae(tile_size)
             self.base_vae = is_base_vae
 
             check_compilation(compiled_vae, "Vae")
@@ -16,3 +16,6 @@ from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_stencil
 from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_upscaler import (
     UpscalerPipeline,
 )
+from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_batch import (
+    Text2ImageBatchScheduler,
+)
@@ -0,0 +1,307 @@
+import collections
+import contextlib
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_txt2img import (
+    Text2ImagePipeline,
+)
+from apps.stable_diffusion.src.schedulers import get_schedulers
+from apps.stable_diffusion.src.utils import (
+    args,
+    sanitize_seed,
+    set_init_device_flags,
+)
+
+
+# Requests with the same key can share a denoising loop.
+BatchKey = collections.namedtuple(
+    "BatchKey", ["model_id", "height", "width", "steps", "scheduler"]
+)
+
+
+class GenerationRequest:
+    def __init__(
+        self,
+        key,
+        prompt,
+        negative_prompt,
+        seed,
+        guidance_scale,
+        user="",
+        priority=0,
+    ):
+        self.key = key
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.guidance_scale = guidance_scale
+        self.user = user
+        self.priority = priority
+        self.future = Future()
+        self.submit_time = time.time()
+
+
+# Held while the args are set for a batch pipeline, see batch_args.
+_args_lock = threading.RLock()
+
+
+@contextlib.contextmanager
+def batch_args(model_id, height, width, batch_size):
+    """
+    Sets the model, resolution and batch size args of a batch pipeline, and
+    the device flags derived from them, then restores all the args. The
+    pipeline modules and the Shark schedulers read them while compiling and
+    running, so the load and the calls of a batch run inside.
+    """
+    with _args_lock:
+        saved_args = dict(vars(args))
+        try:
+            args.hf_model_id = model_id
+            args.height = height
+            args.width = width
+            args.batch_size = batch_size
+            set_init_device_flags()
+            yield
+        finally:
+            vars(args).update(saved_args)
+
+
+def load_text2img_pipeline(model_id, height, width, batch_size):
+    """
+    Returns a Text2ImagePipeline compiled for `batch_size` images of
+    `height` x `width` and the schedulers it can run, built from the
+    other command line args. Call it inside batch_args.
+    """
+    schedulers = get_schedulers(model_id)
+    pipe = Text2ImagePipeline.from_pretrained(
+        schedulers["SharkEulerDiscrete"],
+        args.import_mlir,
+        model_id,
+        args.ckpt_loc,
+        args.custom_vae,
+        args.precision,
+        args.max_length,
+        batch_size,
+        height,
+        width,
+        args.use_base_vae,
+        args.use_tuned,
+        low_cpu_mem_usage=args.low_cpu_mem_usage,
+        use_lora=args.use_lora,
+        ondemand=args.ondemand,
+    )
+    return pipe, schedulers
+
+
+class Text2ImageBatchScheduler:
+    """
+    Groups queued txt2img requests into batched unet invocations.
+
+    ...
+
+    Requests agreeing on the model, resolution, number of steps and
+    scheduler (their BatchKey) share one denoising loop of a pipeline
+    compiled for `batch_size` images. The scheduler thread takes the oldest
+    waiting request, waits up to `max_wait_ms` for more requests of its key
+    and runs up to `batch_size` of them at once; a partial batch is padded
+    with copies of its last request. Every sample keeps its own prompt,
+    negative prompt, seed and guidance scale, and gets the image a batch
+    size 1 call with the same inputs would.
+
+    Attributes
+    ----------
+    batch_size : int
+        number of images per unet call.
+    max_wait_ms : float
+        how long the oldest request waits for others to fill its batch.
+    load_pipeline : callable
+        (model_id, height, width, batch_size) -> (pipeline, schedulers),
+        see load_text2img_pipeline. Only the pipeline of the last key run
+        is kept loaded.
+    run_batch : callable
+        (fn, batch) -> fn(), runs the load and the call of a batch of
+        GenerationRequests, e.g. as a job of the web app's JobQueue. By
+        default the scheduler thread runs them itself.
+
+    Methods
+    -------
+    submit(prompt, negative_prompt="", seed=-1, guidance_scale=7.5,
+           steps=50, height=512, width=512, scheduler="SharkEulerDiscrete",
+           model_id=None, user="", priority=0):
+        Queues a request and returns a future of the (PIL image, seed)
+        pair.
+    metrics():
+        Returns batch occupancy and throughput counters.
+    close():
+        Finishes the queued requests and stops the scheduler thread.
+    """
+
+    def __init__(
+        self,
+        batch_size=4,
+        max_wait_ms=50,
+        load_pipeline=load_text2img_pipeline,
+        run_batch=None,
+    ):
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.load_pipeline = load_pipeline
+        self.run_batch = run_batch or (lambda fn, batch: fn())
+        self._pipe = None
+        self._pipe_key = None
+        self._schedulers = None
+        self._waiting = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            "requests": 0,
+            "finished": 0,
+            "batches": 0,
+            "padded_samples": 0,
+            "queue_wait_ms_sum": 0.0,
+        }
+        self._start_time = time.time()
+        self._thread = threading.Thread(
+            target=self._schedule, name="sd-batch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt,
+        negative_prompt="",
+        seed=-1,
+        guidance_scale=7.5,
+        steps=50,
+        height=512,
+        width=512,
+        scheduler="SharkEulerDiscrete",
+        model_id=None,
+        user="",
+        priority=0,
+    ):
+        key = BatchKey(
+            model_id or args.hf_model_id, height, width, steps, scheduler
+        )
+        request = GenerationRequest(
+            key,
+            prompt,
+            negative_prompt,
+            sanitize_seed(seed),
+            float(guidance_scale),
+            user,
+            priority,
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Text2ImageBatchScheduler is closed.")
+            self._waiting.append(request)
+            self._metrics["requests"] += 1
+            self._cond.notify_all()
+        return request.future
+
+    def _compatible(self, key):
+        return [r for r in self._waiting if r.key == key]
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                key = self._waiting[0].key
+                deadline = self._waiting[0].submit_time + (
+                    self.max_wait_ms / 1000
+                )
+                while (
+                    len(self._compatible(key)) < self.batch_size
+                    and not self._closed
+                ):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._compatible(key)[: self.batch_size]
+                for request in batch:
+                    self._waiting.remove(request)
+                self._metrics["queue_wait_ms_sum"] += sum(
+                    (time.time() - request.submit_time) * 1000
+                    for request in batch
+                )
+
+            try:
+                images = self.run_batch(lambda: self._run(key, batch), batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            else:
+                for request, image in zip(batch, images):
+                    request.future.set_result((image, request.seed))
+            with self._cond:
+                self._metrics["finished"] += len(batch)
+
+    def _get_pipeline(self, key):
+        pipe_key = (key.model_id, key.height, key.width)
+        if self._pipe_key != pipe_key:
+            # Free the modules of the previous key before compiling.
+            self._pipe = None
+            self._pipe, self._schedulers = self.load_pipeline(
+                key.model_id, key.height, key.width, self.batch_size
+            )
+            self._pipe_key = pipe_key
+        self._pipe.scheduler = self._schedulers[key.scheduler]
+        return self._pipe
+
+    def _run(self, key, batch):
+        samples = batch + [batch[-1]] * (self.batch_size - len(batch))
+        with batch_args(key.model_id, key.height, key.width, self.batch_size):
+            pipe = self._get_pipeline(key)
+            pipe.log = ""
+            images = pipe.generate_images_batch(
+                [r.prompt for r in samples],
+                [r.negative_prompt for r in samples],
+                [r.seed for r in samples],
+                [r.guidance_scale for r in samples],
+                key.height,
+                key.width,
+                key.steps,
+                args.max_length,
+                torch.float32 if args.precision == "fp32" else torch.half,
+                args.use_base_vae,
+                not key.scheduler.startswith("Shark"),
+            )
+        with self._cond:
+            self._metrics["batches"] += 1
+            self._metrics["padded_samples"] += len(samples) - len(batch)
+        return images[: len(batch)]
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["waiting"] = len(self._waiting)
+        batches = metrics["batches"]
+        metrics["mean_batch_occupancy"] = (
+            1 - metrics["padded_samples"] / (batches * self.batch_size)
+            if batches
+            else 0.0
+        )
+        elapsed = time.time() - self._start_time
+        metrics["images_per_second"] = (
+            metrics["finished"] / elapsed if elapsed else 0.0
+        )
+        admitted = metrics["requests"] - metrics["waiting"]
+        metrics["mean_queue_wait_ms"] = (
+            metrics["queue_wait_ms_sum"] / admitted if admitted else 0.0
+        )
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -24,6 +24,7 @@ from apps.stable_diffusion.src.models import (
     SharkifyStableDiffusionModel,
     get_vae_encode,
 )
+from apps.stable_diffusion.src.utils import args
 
 
 class Image2ImagePipeline(StableDiffusionPipeline):
@@ -51,6 +52,13 @@ class Image2ImagePipeline(StableDiffusionPipeline):
         if self.vae_encode is not None:
             return
 
+        if args.vae_tile_size:
+            # Tiled modules are not in the tank.
+            self.vae_encode = self.sd_model.vae_encode(
+                args.vae_tile_size, args.vae_tiles_per_call
+            )
+            return
+
         if self.import_mlir or self.use_lora:
             self.vae_encode = self.sd_model.vae_encode()
         else:
@@ -60,6 +68,10 @@ class Image2ImagePipeline(StableDiffusionPipeline):
                 print("download pipeline failed, falling back to import_mlir")
                 self.vae_encode = self.sd_model.vae_encode()
 
+    def load_all(self):
+        super().load_all()
+        self.load_vae_encode()
+
     def unload_vae_encode(self):
         del self.vae_encode
         self.vae_encode = None
@@ -111,7 +123,7 @@ class Image2ImagePipeline(StableDiffusionPipeline):
     def encode_image(self, input_image):
         self.load_vae_encode()
         vae_encode_start = time.time()
-        latents = self.vae_encode("forward", input_image)
+        latents = self.run_vae_encode(input_image[0])
         vae_inf_time = (time.time() - vae_encode_start) * 1000
         if self.ondemand:
             self.unload_vae_encode()
@@ -24,6 +24,7 @@ from apps.stable_diffusion.src.models import (
     SharkifyStableDiffusionModel,
     get_vae_encode,
 )
+from apps.stable_diffusion.src.utils import args
 
 
 class OutpaintPipeline(StableDiffusionPipeline):
@@ -51,6 +52,13 @@ class OutpaintPipeline(StableDiffusionPipeline):
         if self.vae_encode is not None:
             return
 
+        if args.vae_tile_size:
+            # Tiled modules are not in the tank.
+            self.vae_encode = self.sd_model.vae_encode(
+                args.vae_tile_size, args.vae_tiles_per_call
+            )
+            return
+
         if self.import_mlir or self.use_lora:
             self.vae_encode = self.sd_model.vae_encode()
         else:
@@ -60,6 +68,10 @@ class OutpaintPipeline(StableDiffusionPipeline):
                 print("download pipeline failed, falling back to import_mlir")
                 self.vae_encode = self.sd_model.vae_encode()
 
+    def load_all(self):
+        super().load_all()
+        self.load_vae_encode()
+
     def unload_vae_encode(self):
         del self.vae_encode
         self.vae_encode = None
@@ -145,7 +157,7 @@ class OutpaintPipeline(StableDiffusionPipeline):
 
         self.load_vae_encode()
         masked_image = masked_image.to(dtype)
-        masked_image_latents = self.vae_encode("forward", (masked_image,))
+        masked_image_latents = self.run_vae_encode(masked_image)
         masked_image_latents = torch.from_numpy(masked_image_latents)
         if self.ondemand:
             self.unload_vae_encode()
@@ -52,6 +52,10 @@ class StencilPipeline(StableDiffusionPipeline):
             return
         self.controlnet = self.sd_model.controlnet()
 
+    def load_all(self):
+        super().load_all()
+        self.load_controlnet()
+
     def unload_controlnet(self):
         del self.controlnet
         self.controlnet = None
@@ -96,11 +100,14 @@ class StencilPipeline(StableDiffusionPipeline):
         return_all_latents=False,
     ):
         step_time_sum = 0
-        latent_history = [latents]
+        latent_history = [latents] if return_all_latents else None
         text_embeddings = torch.from_numpy(text_embeddings).to(dtype)
-        text_embeddings_numpy = text_embeddings.detach().numpy()
         self.load_unet()
         self.load_controlnet()
+        # Upload the loop invariant inputs once instead of on every step.
+        text_embeddings_device = self.unet.to_device(text_embeddings)
+        guidance_scale_device = self.unet.to_device(guidance_scale)
+        controlnet_hint_device = self.controlnet.to_device(controlnet_hint)
         for i, t in tqdm(enumerate(total_timesteps)):
             step_start_time = time.time()
             timestep = torch.tensor([t]).to(dtype)
@@ -128,8 +135,8 @@ class StencilPipeline(StableDiffusionPipeline):
                 (
                     latent_model_input_1,
                     timestep,
-                    text_embeddings,
-                    controlnet_hint,
+                    text_embeddings_device,
+                    controlnet_hint_device,
                 ),
                 send_to_host=False,
             )
@@ -142,8 +149,8 @@ class StencilPipeline(StableDiffusionPipeline):
                 (
                     latent_model_input,
                     timestep,
-                    text_embeddings_numpy,
-                    guidance_scale,
+                    text_embeddings_device,
+                    guidance_scale_device,
                     control[0],
                     control[1],
                     control[2],
@@ -170,7 +177,9 @@ class StencilPipeline(StableDiffusionPipeline):
             else:
                 latents = self.scheduler.step(noise_pred, t, latents)
 
-            latent_history.append(latents)
+            if return_all_latents:
+                latent_history.append(latents)
+            self.on_step(i + 1, len(total_timesteps), latents)
             step_time = (time.time() - step_start_time) * 1000
             #  self.log += (
             #      f"\nstep = {i} | timestep = {t} | time = {step_time:.2f}ms"
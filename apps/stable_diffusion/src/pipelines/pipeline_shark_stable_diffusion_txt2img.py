@@ -142,3 +142,70 @@ class Text2ImagePipeline(StableDiffusionPipeline):
             self.unload_vae()
 
         return all_imgs
+
+    def generate_images_batch(
+        self,
+        prompts,
+        neg_prompts,
+        seeds,
+        guidance_scales,
+        height,
+        width,
+        num_inference_steps,
+        max_length,
+        dtype,
+        use_base_vae,
+        cpu_scheduling,
+    ):
+        """
+        Generates one image per sample of the compiled batch, each with its
+        own prompt, negative prompt, seed and guidance scale, in a single
+        denoising loop. A sample gets the same initial latents as a batch
+        size 1 `generate_images` call with its seed.
+        """
+        latents = []
+        for seed in seeds:
+            generator = torch.manual_seed(seed)
+            latents.append(
+                torch.randn(
+                    (1, 4, height // 8, width // 8),
+                    generator=generator,
+                    dtype=torch.float32,
+                )
+            )
+        self.scheduler.set_timesteps(num_inference_steps)
+        self.scheduler.is_scale_input_called = True
+        init_latents = (
+            torch.cat(latents).to(dtype) * self.scheduler.init_noise_sigma
+        )
+
+        text_embeddings = self.encode_prompts_weight(
+            list(prompts), list(neg_prompts), max_length
+        )
+
+        # Samples sharing a guidance scale run the usual unet, otherwise
+        # the one taking a scale per sample.
+        if len(set(guidance_scales)) == 1:
+            guidance_scale = torch.tensor(guidance_scales[0])
+        else:
+            guidance_scale = torch.tensor(guidance_scales).reshape(-1, 1, 1, 1)
+        guidance_scale = guidance_scale.to(torch.float32)
+
+        latents = self.produce_img_latents(
+            latents=init_latents,
+            text_embeddings=text_embeddings,
+            guidance_scale=guidance_scale,
+            total_timesteps=self.scheduler.timesteps,
+            dtype=dtype,
+            cpu_scheduling=cpu_scheduling,
+        )
+
+        self.load_vae()
+        all_imgs = self.decode_latents(
+            latents=latents,
+            use_base_vae=use_base_vae,
+            cpu_scheduling=cpu_scheduling,
+        )
+        if self.ondemand:
+            self.unload_vae()
+        return all_imgs
@@ -27,12 +27,14 @@ from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_utils i
 from apps.stable_diffusion.src.utils import (
     start_profiling,
     end_profiling,
+    run_tiled,
 )
+from shark.iree_utils.device_tensor import SharkDeviceTensor
 from PIL import Image
 from apps.stable_diffusion.src.models import SharkifyStableDiffusionModel
 
 
-def preprocess(image):
+def preprocess(image, multiple_of=64):
     if isinstance(image, torch.Tensor):
         return image
     elif isinstance(image, Image.Image):
@@ -41,8 +43,8 @@ def preprocess(image):
     if isinstance(image[0], Image.Image):
         w, h = image[0].size
         w, h = map(
-            lambda x: x - x % 64, (w, h)
-        )  # resize to integer multiple of 64
+            lambda x: x - x % multiple_of, (w, h)
+        )  # resize to integer multiple of `multiple_of`
 
         image = [np.array(i.resize((w, h)))[None, :] for i in image]
         image = np.concatenate(image, axis=0)
@@ -56,6 +58,9 @@ def preprocess(image):
 
 
 class UpscalerPipeline(StableDiffusionPipeline):
+    # The x4 upscaler has its own latent space.
+    has_latent_previews = False
+
     def __init__(
         self,
         scheduler: Union[
@@ -112,7 +117,7 @@ class UpscalerPipeline(StableDiffusionPipeline):
 
         profile_device = start_profiling(file_path="vae.rdc")
         vae_start = time.time()
-        images = self.vae("forward", (latents_numpy,))
+        images = self.run_vae(latents_numpy)
         vae_inf_time = (time.time() - vae_start) * 1000
         end_profiling(profile_device)
         self.log += f"\nVAE Inference time (ms): {vae_inf_time:.3f}"
@@ -125,31 +130,6 @@ class UpscalerPipeline(StableDiffusionPipeline):
         pil_images = [Image.fromarray(image) for image in images.numpy()]
         return pil_images
 
-    def prepare_latents(
-        self,
-        batch_size,
-        height,
-        width,
-        generator,
-        num_inference_steps,
-        dtype,
-    ):
-        latents = torch.randn(
-            (
-                batch_size,
-                4,
-                height,
-                width,
-            ),
-            generator=generator,
-            dtype=torch.float32,
-        ).to(dtype)
-
-        self.scheduler.set_timesteps(num_inference_steps)
-        self.scheduler.is_scale_input_called = True
-        latents = latents * self.scheduler.init_noise_sigma
-        return latents
-
     def produce_img_latents(
         self,
         latents,
@@ -164,18 +144,22 @@ class UpscalerPipeline(StableDiffusionPipeline):
         return_all_latents=False,
     ):
         step_time_sum = 0
-        latent_history = [latents]
+        latent_history = [latents] if return_all_latents else None
         text_embeddings = torch.from_numpy(text_embeddings).to(dtype)
-        text_embeddings_numpy = text_embeddings.detach().numpy()
-        self.status = SD_STATE_IDLE
         self.load_unet()
+        # Upload the loop invariant inputs once instead of on every step.
+        text_embeddings_device = self.unet.to_device(text_embeddings)
+        noise_level_device = self.unet.to_device(noise_level)
+        guidance_scale_device = self.unet.to_device(guidance_scale)
         for i, t in tqdm(enumerate(total_timesteps)):
             step_start_time = time.time()
-            latent_model_input = torch.cat([latents] * 2)
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, t
-            )
-            latent_model_input = torch.cat([latent_model_input, image], dim=1)
+            # The unet duplicates the latents for classifier-free guidance
+            # and returns the guided noise prediction.
+            latent_model_input = self.scheduler.scale_model_input(latents, t)
+            latent_model_input = torch.cat(
+                [torch.from_numpy(np.asarray(latent_model_input)), image],
+                dim=1,
+            ).to(dtype)
             timestep = torch.tensor([t]).to(dtype).detach().numpy()
             if cpu_scheduling:
                 latent_model_input = latent_model_input.detach().numpy()
@@ -187,18 +171,16 @@ class UpscalerPipeline(StableDiffusionPipeline):
                 (
                     latent_model_input,
                     timestep,
-                    text_embeddings_numpy,
-                    noise_level,
+                    text_embeddings_device,
+                    noise_level_device,
+                    guidance_scale_device,
                 ),
+                send_to_host=False,
             )
             end_profiling(profile_device)
-            noise_pred = torch.from_numpy(noise_pred)
-            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + guidance_scale * (
-                noise_pred_text - noise_pred_uncond
-            )
 
             if cpu_scheduling:
+                noise_pred = torch.from_numpy(noise_pred.to_host())
                 latents = self.scheduler.step(
                     noise_pred, t, latents, **extra_step_kwargs
                 ).prev_sample
@@ -207,7 +189,9 @@ class UpscalerPipeline(StableDiffusionPipeline):
                     noise_pred, t, latents, **extra_step_kwargs
                 )
 
-            latent_history.append(latents)
+            if return_all_latents:
+                latent_history.append(latents)
+            self.on_step(i + 1, len(total_timesteps), latents)
             step_time = (time.time() - step_start_time) * 1000
             #  self.log += (
             #      f"\nstep = {i} | timestep = {t} | time = {step_time:.2f}ms"
@@ -227,6 +211,58 @@ class UpscalerPipeline(StableDiffusionPipeline):
         all_latents = torch.cat(latent_history, dim=0)
         return all_latents
 
+    def upscale_tiles(
+        self,
+        tiles,
+        text_embeddings,
+        guidance_scale,
+        noise_level,
+        num_inference_steps,
+        dtype,
+        cpu_scheduling,
+        extra_step_kwargs,
+    ):
+        """
+        Runs the denoising loop and the VAE on a batch of tiles, i.e. one
+        call of the compiled unet shape per step. `tiles` stacks the noised
+        low res image (3 channels) and the initial noise (4 channels) of
+        each tile. Returns the decoded tiles, 4x larger.
+        """
+        n, _, height, width = tiles.shape
+        if self.status == SD_STATE_CANCEL:
+            return np.zeros((n, 3, 4 * height, 4 * width), dtype=np.float32)
+
+        tiles = torch.from_numpy(tiles)
+        image = tiles[:, :3].to(dtype)
+        self.scheduler.set_timesteps(num_inference_steps)
+        self.scheduler.is_scale_input_called = True
+        latents = (tiles[:, 3:] * self.scheduler.init_noise_sigma).to(dtype)
+        latents = self.produce_img_latents(
+            latents=latents,
+            image=image,
+            text_embeddings=text_embeddings,
+            guidance_scale=guidance_scale,
+            noise_level=noise_level,
+            total_timesteps=self.scheduler.timesteps,
+            dtype=dtype,
+            cpu_scheduling=cpu_scheduling,
+            extra_step_kwargs=extra_step_kwargs,
+        )
+        if isinstance(latents, SharkDeviceTensor):
+            latents = torch.from_numpy(latents.to_host())
+
+        latents = 1 / 0.08333 * (latents.float())
+        self.load_vae()
+        profile_device = start_profiling(file_path="vae.rdc")
+        vae_start = time.time()
+        images = self.run_vae(latents.detach().numpy())
+        vae_inf_time = (time.time() - vae_start) * 1000
+        end_profiling(profile_device)
+        self.log += f"\nVAE Inference time (ms): {vae_inf_time:.3f}"
+        if self.ondemand:
+            self.unload_vae()
+        return images
+
     def generate_images(
         self,
         prompts,
@@ -243,6 +279,7 @@ class UpscalerPipeline(StableDiffusionPipeline):
         dtype,
         use_base_vae,
         cpu_scheduling,
+        tile_overlap=None,
     ):
         # prompts and negative prompts must be a list.
         if isinstance(prompts, str):
@@ -267,8 +304,20 @@ class UpscalerPipeline(StableDiffusionPipeline):
             prompts, neg_prompts, max_length
         )
 
-        # 4. Preprocess image
-        image = preprocess(image).to(dtype)
+        # 4. Preprocess image, any size works as it is upscaled by tiles.
+        image = preprocess(image, multiple_of=8).to(dtype)
+        if height != width:
+            raise ValueError(
+                f"The upscaler runs on square tiles, got {height}x{width}."
+            )
+        if batch_size % image.shape[0] != 0:
+            raise ValueError(
+                f"Batch size {batch_size} must be a multiple of the number "
+                f"of images {image.shape[0]}."
+            )
+        tiles_per_call = batch_size // image.shape[0]
+        if tile_overlap is None:
+            tile_overlap = height // 8
 
         # 5. Add noise to image
         noise_level = torch.tensor([noise_level], dtype=torch.long)
@@ -277,50 +326,50 @@ class UpscalerPipeline(StableDiffusionPipeline):
             generator=generator,
         ).to(dtype)
         image = self.low_res_scheduler.add_noise(image, noise, noise_level)
-        image = torch.cat([image] * 2)
-        noise_level = torch.cat([noise_level] * image.shape[0])
-
-        height, width = image.shape[2:]
-        # Get initial latents
-        init_latents = self.prepare_latents(
-            batch_size=batch_size,
-            height=height,
-            width=width,
+        # One noise level for each of the uncond and text halves of the unet
+        # batch, the image itself is duplicated inside the unet.
+        noise_level = torch.cat([noise_level] * 2 * batch_size)
+
+        # The initial latents are drawn for the whole image, so overlapping
+        # tiles start from the same noise.
+        init_noise = torch.randn(
+            (image.shape[0], 4) + tuple(image.shape[2:]),
             generator=generator,
-            num_inference_steps=num_inference_steps,
-            dtype=dtype,
+            dtype=torch.float32,
         )
 
         eta = 0.0
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
         # guidance scale as a float32 tensor.
-        #  guidance_scale = torch.tensor(guidance_scale).to(torch.float32)
+        guidance_scale = torch.tensor(guidance_scale).to(torch.float32)
 
-        # Get Image latents
-        latents = self.produce_img_latents(
-            latents=init_latents,
-            image=image,
-            text_embeddings=text_embeddings,
-            guidance_scale=guidance_scale,
-            noise_level=noise_level,
-            total_timesteps=self.scheduler.timesteps,
-            dtype=dtype,
-            cpu_scheduling=cpu_scheduling,
-            extra_step_kwargs=extra_step_kwargs,
+        # Upscale batches of `tiles_per_call` tiles of every image through
+        # the unet and the VAE compiled for a `height` x `width` input, and
+        # blend the outputs.
+        self.status = SD_STATE_IDLE
+        tiles_start = time.time()
+        images = run_tiled(
+            lambda tiles: self.upscale_tiles(
+                tiles,
+                text_embeddings,
+                guidance_scale,
+                noise_level,
+                num_inference_steps,
+                dtype,
+                cpu_scheduling,
+                extra_step_kwargs,
+            ),
+            torch.cat([image.float(), init_noise], dim=1).numpy(),
+            height,
+            tile_overlap,
+            tiles_per_call,
         )
-
-        # Img latents -> PIL images
-        all_imgs = []
-        self.load_vae()
-        for i in tqdm(range(0, latents.shape[0], batch_size)):
-            imgs = self.decode_latents(
-                latents=latents[i : i + batch_size],
-                use_base_vae=use_base_vae,
-                cpu_scheduling=cpu_scheduling,
-            )
-            all_imgs.extend(imgs)
-        if self.ondemand:
-            self.unload_vae()
-
-        return all_imgs
+        tiles_time = time.time() - tiles_start
+        self.log += f"\nTiled upscale time: {tiles_time:.3f}sec"
+
+        # Upscaled images -> PIL images
+        images = (images * 255.0).round().clip(0, 255).astype(np.uint8)
+        return [
+            Image.fromarray(image) for image in images.transpose(0, 2, 3, 1)
+        ]
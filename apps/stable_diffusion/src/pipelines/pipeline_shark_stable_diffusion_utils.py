@@ -17,7 +17,10 @@ from diffusers import (
     DEISMultistepScheduler,
 )
 from shark.shark_inference import SharkInference
-from apps.stable_diffusion.src.schedulers import SharkEulerDiscreteScheduler
+from apps.stable_diffusion.src.schedulers import (
+    SharkEulerDiscreteScheduler,
+    get_loop_coefficients,
+)
 from apps.stable_diffusion.src.models import (
     SharkifyStableDiffusionModel,
     get_vae,
@@ -28,6 +31,12 @@ from apps.stable_diffusion.src.models import (
 from apps.stable_diffusion.src.utils import (
     start_profiling,
     end_profiling,
+    args,
+    parallel_compile,
+    get_clip_identity,
+    get_prompt_embedding_cache,
+    run_tiled,
+    latents_to_preview,
 )
 import sys
 
@@ -36,6 +45,9 @@ SD_STATE_CANCEL = "cancel"
 
 
 class StableDiffusionPipeline:
+    # Whether the latents are those of the SD VAE, see latents_to_preview.
+    has_latent_previews = True
+
     def __init__(
         self,
         scheduler: Union[
@@ -57,15 +69,23 @@ class StableDiffusionPipeline:
         self.vae = None
         self.text_encoder = None
         self.unet = None
+        self.unet_ksteps = None
+        self.unet_per_sample_cfg = None
         self.model_max_length = 77
         self.scheduler = scheduler
         # TODO: Implement using logging python utility.
         self.log = ""
         self.status = SD_STATE_IDLE
+        # Called with (step, PIL images) every `args.preview_every` steps.
+        self.preview_callback = None
+        # Called with (step, total_steps) after every step, may raise to
+        # stop the generation there.
+        self.step_callback = None
         self.sd_model = sd_model
         self.import_mlir = import_mlir
         self.use_lora = use_lora
         self.ondemand = ondemand
+        self.clip_identity = None
         # TODO: Find a better workaround for fetching base_model_id early enough for CLIPTokenizer.
         try:
             self.tokenizer = get_tokenizer()
@@ -78,6 +98,18 @@ class StableDiffusionPipeline:
         if self.text_encoder is not None:
             return
 
+        # Embeddings cached for a previous version of the text encoder
+        # weights (e.g. an edited LoRA file) can't be hit anymore.
+        clip_identity = get_clip_identity(self.sd_model, self.use_lora)
+        prompt_cache = get_prompt_embedding_cache()
+        if (
+            prompt_cache is not None
+            and self.clip_identity is not None
+            and self.clip_identity != clip_identity
+        ):
+            prompt_cache.invalidate(self.clip_identity)
+        self.clip_identity = clip_identity
+
         if self.import_mlir or self.use_lora:
             if not self.import_mlir:
                 print(
@@ -114,10 +146,39 @@ class StableDiffusionPipeline:
         del self.unet
         self.unet = None
 
+    def load_unet_ksteps(self):
+        if self.unet_ksteps is not None:
+            return
+        # Not in the tank, always imported.
+        self.unet_ksteps = self.sd_model.unet(
+            steps_per_call=args.unet_steps_per_call
+        )
+
+    def unload_unet_ksteps(self):
+        del self.unet_ksteps
+        self.unet_ksteps = None
+
+    def load_unet_per_sample_cfg(self):
+        if self.unet_per_sample_cfg is not None:
+            return
+        # Not in the tank, always imported.
+        self.unet_per_sample_cfg = self.sd_model.unet(per_sample_guidance=True)
+
+    def unload_unet_per_sample_cfg(self):
+        del self.unet_per_sample_cfg
+        self.unet_per_sample_cfg = None
+
     def load_vae(self):
         if self.vae is not None:
             return
 
+        if args.vae_tile_size:
+            # Tiled modules are not in the tank.
+            self.vae = self.sd_model.vae(
+                args.vae_tile_size, args.vae_tiles_per_call
+            )
+            return
+
         if self.import_mlir or self.use_lora:
             self.vae = self.sd_model.vae()
         else:
@@ -132,6 +193,55 @@ class StableDiffusionPipeline:
         del self.vae
         self.vae = None
 
+    # Both run on tiles with --vae_tile_size, see load_vae and the
+    # load_vae_encode of the image to image pipelines.
+    def run_vae(self, latents):
+        if not args.vae_tile_size:
+            return self.vae("forward", (latents,))
+        return run_tiled(
+            lambda tiles: self.vae("forward", (tiles,)),
+            latents,
+            args.vae_tile_size,
+            args.vae_tile_overlap,
+            args.vae_tiles_per_call,
+        )
+
+    def run_vae_encode(self, image):
+        if not args.vae_tile_size:
+            return self.vae_encode("forward", (image,))
+        return run_tiled(
+            lambda tiles: self.vae_encode("forward", (tiles,)),
+            image,
+            8 * args.vae_tile_size,
+            8 * args.vae_tile_overlap,
+            args.vae_tiles_per_call,
+        )
+
+    # Called after `step` of `total_steps`, the last `num_steps` of which ran
+    # in one call. Reports the progress, and sends the previews of the
+    # latents if one of those steps is a multiple of `args.preview_every`.
+    def on_step(self, step, total_steps, latents, num_steps=1):
+        if self.step_callback is not None:
+            self.step_callback(step, total_steps)
+        if (
+            not self.has_latent_previews
+            or self.preview_callback is None
+            or args.preview_every <= 0
+        ):
+            return
+        if (
+            step // args.preview_every
+            == (step - num_steps) // args.preview_every
+        ):
+            return
+        self.preview_callback(step, latents_to_preview(latents))
+
+    # Loads every sub-model used by the pipeline.
+    def load_all(self):
+        self.load_clip()
+        self.load_unet()
+        self.load_vae()
+
     def encode_prompts(self, prompts, neg_prompts, max_length):
         # Tokenize text and get embeddings
         text_input = self.tokenizer(
@@ -172,7 +282,7 @@ class StableDiffusionPipeline:
 
         profile_device = start_profiling(file_path="vae.rdc")
         vae_start = time.time()
-        images = self.vae("forward", (latents_numpy,))
+        images = self.run_vae(latents_numpy)
         vae_inf_time = (time.time() - vae_start) * 1000
         end_profiling(profile_device)
         self.log += f"\nVAE Inference time (ms): {vae_inf_time:.3f}"
@@ -198,12 +308,47 @@ class StableDiffusionPipeline:
         masked_image_latents=None,
         return_all_latents=False,
     ):
+        # A [batch_size, 1, 1, 1] guidance scale runs the unet variant
+        # guiding each sample with its own scale.
+        per_sample_guidance = guidance_scale.dim() > 0
+        if (
+            args.unet_steps_per_call > 1
+            and mask is None
+            and not per_sample_guidance
+        ):
+            try:
+                scales, coeffs = get_loop_coefficients(
+                    self.scheduler, total_timesteps
+                )
+            except ValueError as e:
+                print(f"{e} Running one step per call.")
+            else:
+                return self.produce_img_latents_ksteps(
+                    latents,
+                    text_embeddings,
+                    guidance_scale,
+                    total_timesteps,
+                    scales,
+                    coeffs,
+                    dtype,
+                    cpu_scheduling,
+                    return_all_latents,
+                )
+
         self.status = SD_STATE_IDLE
         step_time_sum = 0
-        latent_history = [latents]
+        # Only kept when asked for, it grows with the number of steps.
+        latent_history = [latents] if return_all_latents else None
         text_embeddings = torch.from_numpy(text_embeddings).to(dtype)
-        text_embeddings_numpy = text_embeddings.detach().numpy()
-        self.load_unet()
+        if per_sample_guidance:
+            self.load_unet_per_sample_cfg()
+            unet = self.unet_per_sample_cfg
+        else:
+            self.load_unet()
+            unet = self.unet
+        # Upload the loop invariant inputs once instead of on every step.
+        text_embeddings_device = unet.to_device(text_embeddings)
+        guidance_scale_device = unet.to_device(guidance_scale)
         for i, t in tqdm(enumerate(total_timesteps)):
             step_start_time = time.time()
             timestep = torch.tensor([t]).to(dtype).detach().numpy()
@@ -222,13 +367,13 @@ class StableDiffusionPipeline:
 
             # Profiling Unet.
             profile_device = start_profiling(file_path="unet.rdc")
-            noise_pred = self.unet(
+            noise_pred = unet(
                 "forward",
                 (
                     latent_model_input,
                     timestep,
-                    text_embeddings_numpy,
-                    guidance_scale,
+                    text_embeddings_device,
+                    guidance_scale_device,
                 ),
                 send_to_host=False,
             )
@@ -242,7 +387,9 @@ class StableDiffusionPipeline:
             else:
                 latents = self.scheduler.step(noise_pred, t, latents)
 
-            latent_history.append(latents)
+            if return_all_latents:
+                latent_history.append(latents)
+            self.on_step(i + 1, len(total_timesteps), latents)
             step_time = (time.time() - step_start_time) * 1000
             #  self.log += (
             #      f"\nstep = {i} | timestep = {t} | time = {step_time:.2f}ms"
@@ -253,7 +400,10 @@ class StableDiffusionPipeline:
                 break
 
         if self.ondemand:
-            self.unload_unet()
+            if per_sample_guidance:
+                self.unload_unet_per_sample_cfg()
+            else:
+                self.unload_unet()
         avg_step_time = step_time_sum / len(total_timesteps)
         self.log += f"\nAverage step time: {avg_step_time}ms/it"
 
@@ -262,6 +412,82 @@ class StableDiffusionPipeline:
         all_latents = torch.cat(latent_history, dim=0)
         return all_latents
 
+    def produce_img_latents_ksteps(
+        self,
+        latents,
+        text_embeddings,
+        guidance_scale,
+        total_timesteps,
+        scales,
+        coeffs,
+        dtype,
+        cpu_scheduling,
+        return_all_latents=False,
+    ):
+        # Same loop as produce_img_latents, `args.unet_steps_per_call` steps
+        # per call of the UnetKStepModel. The last call is padded with steps
+        # leaving the latents unchanged.
+        self.status = SD_STATE_IDLE
+        steps_per_call = args.unet_steps_per_call
+        num_steps = len(total_timesteps)
+        padding = -num_steps % steps_per_call
+        timesteps = torch.tensor(
+            [float(t) for t in total_timesteps] + [0.0] * padding
+        ).to(dtype)
+        scales = torch.tensor(scales + [1.0] * padding)
+        coeffs = torch.tensor(coeffs + [[1.0, 0.0]] * padding)
+
+        step_time_sum = 0
+        latent_history = [latents] if return_all_latents else None
+        text_embeddings = torch.from_numpy(text_embeddings).to(dtype)
+        self.load_unet_ksteps()
+        text_embeddings_device = self.unet_ksteps.to_device(text_embeddings)
+        guidance_scale_device = self.unet_ksteps.to_device(guidance_scale)
+        latents = self.unet_ksteps.to_device(latents)
+        for start in tqdm(range(0, num_steps, steps_per_call)):
+            step_start_time = time.time()
+            chunk = slice(start, start + steps_per_call)
+
+            profile_device = start_profiling(file_path="unet.rdc")
+            latents = self.unet_ksteps(
+                "forward",
+                (
+                    latents,
+                    text_embeddings_device,
+                    guidance_scale_device,
+                    timesteps[chunk],
+                    scales[chunk],
+                    coeffs[chunk],
+                ),
+                send_to_host=False,
+            )
+            end_profiling(profile_device)
+
+            if return_all_latents:
+                latent_history.append(latents)
+            steps_done = min(start + steps_per_call, num_steps)
+            self.on_step(steps_done, num_steps, latents, steps_done - start)
+            step_time_sum += (time.time() - step_start_time) * 1000
+
+            if self.status == SD_STATE_CANCEL:
+                break
+
+        if self.ondemand:
+            self.unload_unet_ksteps()
+        avg_step_time = step_time_sum / num_steps
+        self.log += f"\nAverage step time: {avg_step_time}ms/it"
+
+        if cpu_scheduling:
+            latents = torch.from_numpy(np.asarray(latents))
+            if return_all_latents:
+                latent_history = [
+                    torch.from_numpy(np.asarray(l)) for l in latent_history
+                ]
+        if not return_all_latents:
+            return latents
+        all_latents = torch.cat(latent_history, dim=0)
+        return all_latents
+
     @classmethod
     def from_pretrained(
         cls,
@@ -329,7 +555,7 @@ class StableDiffusionPipeline:
         )
 
         if cls.__name__ in ["UpscalerPipeline"]:
-            return cls(
+            pipe = cls(
                 scheduler,
                 ddpm_scheduler,
                 sd_model,
@@ -337,8 +563,17 @@ class StableDiffusionPipeline:
                 use_lora,
                 ondemand,
             )
+        else:
+            pipe = cls(scheduler, sd_model, import_mlir, use_lora, ondemand)
 
-        return cls(scheduler, sd_model, import_mlir, use_lora, ondemand)
+        if args.parallel_compile:
+            # Compile all the sub-models concurrently instead of lazily on
+            # first use.
+            with parallel_compile(
+                args.compile_workers, args.compile_memory_budget_gb
+            ):
+                pipe.load_all()
+        return pipe
 
     # #####################################################
     # Implements text embeddings with weights from prompts
@@ -376,6 +611,28 @@ class StableDiffusionPipeline:
 
         # SHARK: Save model_max_length, load the clip and init inference time
         self.model_max_length = model_max_length
+
+        # SHARK: Reuse the embeddings of prompts encoded before. On a hit the
+        # clip is not loaded at all.
+        prompt_cache = get_prompt_embedding_cache()
+        cache_key = None
+        if prompt_cache is not None:
+            cache_key = prompt_cache.make_key(
+                get_clip_identity(self.sd_model, self.use_lora),
+                prompt,
+                negative_prompt,
+                model_max_length,
+                do_classifier_free_guidance,
+                max_embeddings_multiples,
+            )
+            text_embeddings = prompt_cache.get(cache_key)
+            if text_embeddings is not None:
+                self.log += (
+                    f"\nPrompt embeddings reused from cache "
+                    f"(hit rate {prompt_cache.hit_rate():.2f})"
+                )
+                return text_embeddings
+
         self.load_clip()
         clip_inf_start = time.time()
 
@@ -395,9 +652,9 @@ class StableDiffusionPipeline:
         text_embeddings, uncond_embeddings = get_weighted_text_embeddings(
             pipe=self,
             prompt=prompt,
-            uncond_prompt=negative_prompt
-            if do_classifier_free_guidance
-            else None,
+            uncond_prompt=(
+                negative_prompt if do_classifier_free_guidance else None
+            ),
             max_embeddings_multiples=max_embeddings_multiples,
         )
         # SHARK: we are not using num_images_per_prompt
@@ -418,7 +675,10 @@ class StableDiffusionPipeline:
             self.unload_clip()
         self.log += f"\nClip Inference time (ms) = {clip_inf_time:.3f}"
 
-        return text_embeddings.numpy()
+        text_embeddings = text_embeddings.numpy()
+        if cache_key is not None:
+            prompt_cache.put(cache_key, text_embeddings)
+        return text_embeddings
 
 
 from typing import List, Optional, Union
@@ -540,13 +800,17 @@ def get_prompts_with_weights(
     tokens = []
     weights = []
     truncated = False
-    for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
+    # SHARK: tokenize the fragments of all the prompts in one call.
+    texts_and_weights = [parse_prompt_attention(text) for text in prompt]
+    words = [word for text in texts_and_weights for word, _ in text]
+    words_ids = pipe.tokenizer(words).input_ids if words else []
+    word_index = 0
+    for text in texts_and_weights:
         text_token = []
         text_weight = []
-        for word, weight in texts_and_weights:
-            # tokenize and discard the starting and the ending token
-            token = pipe.tokenizer(word).input_ids[1:-1]
+        for word_offset, (word, weight) in enumerate(text):
+            # discard the starting and the ending token
+            token = words_ids[word_index + word_offset][1:-1]
             text_token += token
             # copy the weight by length of token
             text_weight += [weight] * len(token)
@@ -554,6 +818,7 @@ def get_prompts_with_weights(
             if len(text_token) > max_length:
                 truncated = True
                 break
+        word_index += len(text)
         # truncate
         if len(text_token) > max_length:
             truncated = True
@@ -614,6 +879,25 @@ def pad_tokens_and_weights(
     return tokens, weights
 
 
+def run_text_encoder(pipe: StableDiffusionPipeline, text_input: torch.Tensor):
+    """
+    SHARK: runs the rows of `text_input` through the text encoder, which is
+    compiled for a fixed number of rows, in as few calls as possible. Only
+    the last call is padded, by repeating its last row.
+    """
+    rows_per_call = 2 * pipe.sd_model.batch_size
+    num_rows = text_input.shape[0]
+    text_embeddings = []
+    for start in range(0, num_rows, rows_per_call):
+        rows = text_input[start : start + rows_per_call]
+        num_padding = rows_per_call - rows.shape[0]
+        if num_padding > 0:
+            rows = torch.cat([rows, rows[-1:].repeat(num_padding, 1)])
+        output = pipe.text_encoder("forward", (rows,))
+        text_embeddings.append(output[: rows_per_call - num_padding])
+    return np.concatenate(text_embeddings)
+
+
 def get_unweighted_text_embeddings(
     pipe: StableDiffusionPipeline,
     text_input: torch.Tensor,
@@ -623,10 +907,13 @@ def get_unweighted_text_embeddings(
     """
     When the length of tokens is a multiple of the capacity of the text encoder,
     it should be split into chunks and sent to the text encoder individually.
+    SHARK: the chunks of all the rows are packed into the same text encoder
+    calls instead of running each chunk alone.
     """
     max_embeddings_multiples = (text_input.shape[1] - 2) // (chunk_length - 2)
+    num_rows = text_input.shape[0]
     if max_embeddings_multiples > 1:
-        text_embeddings = []
+        text_input_chunks = []
         for i in range(max_embeddings_multiples):
             # extract the i-th chunk
             text_input_chunk = text_input[
@@ -636,14 +923,14 @@ def get_unweighted_text_embeddings(
             # cover the head and the tail by the starting and the ending tokens
             text_input_chunk[:, 0] = text_input[0, 0]
             text_input_chunk[:, -1] = text_input[0, -1]
-            # text_embedding = pipe.text_encoder(text_input_chunk)[0]
-            # SHARK: deplicate the text_input as Shark runner expects tokens and neg tokens
-            formatted_text_input_chunk = torch.cat(
-                [text_input_chunk, text_input_chunk]
+            text_input_chunks.append(text_input_chunk)
+
+        chunk_embeddings = run_text_encoder(pipe, torch.cat(text_input_chunks))
+        text_embeddings = []
+        for i in range(max_embeddings_multiples):
+            text_embedding = torch.from_numpy(
+                chunk_embeddings[i * num_rows : (i + 1) * num_rows]
             )
-            text_embedding = pipe.text_encoder(
-                "forward", (formatted_text_input_chunk,)
-            )[0]
 
             if no_boseos_middle:
                 if i == 0:
@@ -657,19 +944,9 @@ def get_unweighted_text_embeddings(
                     text_embedding = text_embedding[:, 1:-1]
 
             text_embeddings.append(text_embedding)
-        # SHARK: Convert the result to tensor
-        # text_embeddings = torch.concat(text_embeddings, axis=1)
-        text_embeddings_np = np.concatenate(np.array(text_embeddings))
-        text_embeddings = torch.from_numpy(text_embeddings_np)[None, :]
+        text_embeddings = torch.concat(text_embeddings, axis=1)
     else:
-        # SHARK: deplicate the text_input as Shark runner expects tokens and neg tokens
-        # Convert the result to tensor
-        # text_embeddings = pipe.text_encoder(text_input)[0]
-        formatted_text_input = torch.cat([text_input, text_input])
-        text_embeddings = pipe.text_encoder(
-            "forward", (formatted_text_input,)
-        )[0]
-        text_embeddings = torch.from_numpy(text_embeddings)[None, :]
+        text_embeddings = torch.from_numpy(run_text_encoder(pipe, text_input))
     return text_embeddings
 
 
@@ -782,23 +1059,23 @@ def get_weighted_text_embeddings(
         )
 
     # get the embeddings
-    text_embeddings = get_unweighted_text_embeddings(
+    # SHARK: the prompt and the negative prompt rows share the same calls.
+    all_tokens = prompt_tokens
+    if uncond_prompt is not None:
+        all_tokens = torch.cat([prompt_tokens, uncond_tokens])
+    all_embeddings = get_unweighted_text_embeddings(
         pipe,
-        prompt_tokens,
+        all_tokens,
         pipe.model_max_length,
         no_boseos_middle=no_boseos_middle,
     )
+    text_embeddings = all_embeddings[: prompt_tokens.shape[0]]
     # prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=pipe.device)
     prompt_weights = torch.tensor(
         prompt_weights, dtype=torch.float, device="cpu"
     )
     if uncond_prompt is not None:
-        uncond_embeddings = get_unweighted_text_embeddings(
-            pipe,
-            uncond_tokens,
-            pipe.model_max_length,
-            no_boseos_middle=no_boseos_middle,
-        )
+        uncond_embeddings = all_embeddings[prompt_tokens.shape[0] :]
         # uncond_weights = torch.tensor(uncond_weights, dtype=uncond_embeddings.dtype, device=pipe.device)
         uncond_weights = torch.tensor(
             uncond_weights, dtype=torch.float, device="cpu"
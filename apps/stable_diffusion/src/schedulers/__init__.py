@@ -2,3 +2,13 @@ from apps.stable_diffusion.src.schedulers.sd_schedulers import get_schedulers
 from apps.stable_diffusion.src.schedulers.shark_eulerdiscrete import (
     SharkEulerDiscreteScheduler,
 )
+from apps.stable_diffusion.src.schedulers.shark_schedulers import (
+    SharkDDIMScheduler,
+    SharkDEISMultistepScheduler,
+    SharkDPMSolverMultistepScheduler,
+    SharkEulerAncestralDiscreteScheduler,
+    SharkKDPM2DiscreteScheduler,
+    SharkLMSDiscreteScheduler,
+    SharkPNDMScheduler,
+    get_loop_coefficients,
+)
@@ -12,6 +12,26 @@ from diffusers import (
 from apps.stable_diffusion.src.schedulers.shark_eulerdiscrete import (
     SharkEulerDiscreteScheduler,
 )
+from apps.stable_diffusion.src.schedulers.shark_schedulers import (
+    SharkDDIMScheduler,
+    SharkDEISMultistepScheduler,
+    SharkDPMSolverMultistepScheduler,
+    SharkEulerAncestralDiscreteScheduler,
+    SharkKDPM2DiscreteScheduler,
+    SharkLMSDiscreteScheduler,
+    SharkPNDMScheduler,
+)
+
+# Schedulers running their steps on the device, see shark_schedulers.py.
+SHARK_SCHEDULERS = {
+    "SharkPNDM": SharkPNDMScheduler,
+    "SharkKDPM2Discrete": SharkKDPM2DiscreteScheduler,
+    "SharkLMSDiscrete": SharkLMSDiscreteScheduler,
+    "SharkDDIM": SharkDDIMScheduler,
+    "SharkDPMSolverMultistep": SharkDPMSolverMultistepScheduler,
+    "SharkEulerAncestralDiscrete": SharkEulerAncestralDiscreteScheduler,
+    "SharkDEISMultistep": SharkDEISMultistepScheduler,
+}
 
 
 def get_schedulers(model_id):
@@ -63,4 +83,11 @@ def get_schedulers(model_id):
         subfolder="scheduler",
     )
     schedulers["SharkEulerDiscrete"].compile()
+    for name, scheduler_cls in SHARK_SCHEDULERS.items():
+        schedulers[name] = scheduler_cls.from_pretrained(
+            model_id,
+            subfolder="scheduler",
+        )
+        # All of them share the same two compiled kernels.
+        schedulers[name].compile()
     return schedulers
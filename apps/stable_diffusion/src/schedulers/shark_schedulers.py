@@ -0,0 +1,350 @@
+import sys
+import torch
+from diffusers import (
+    DDIMScheduler,
+    DEISMultistepScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    KDPM2DiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+)
+from apps.stable_diffusion.src.utils import (
+    compile_through_fx,
+    args,
+)
+from shark.iree_utils.device_tensor import SharkDeviceTensor
+
+
+# Inputs of the step kernel: the sample, the model output and four tensors
+# of scheduler state (history buffers or noise).
+NUM_STEP_INPUTS = 6
+
+# Kernels shared by all the schedulers below, per batch size, shape, device
+# and precision.
+_kernels = {}
+
+
+# Schedulers whose update only depends on the current sample and model
+# output.
+STATELESS_SCHEDULERS = (EulerDiscreteScheduler, DDIMScheduler)
+
+
+class ScaleModel(torch.nn.Module):
+    def forward(self, latent, scale):
+        return latent * scale
+
+
+class LinearCombinationModel(torch.nn.Module):
+    # Returns two linear combinations of the inputs, with the coefficients
+    # in the rows of `coeffs`.
+    def forward(self, x0, x1, x2, x3, x4, x5, coeffs):
+        inputs = (x0, x1, x2, x3, x4, x5)
+        outputs = []
+        for row in range(2):
+            out = coeffs[row, 0] * inputs[0]
+            for i in range(1, NUM_STEP_INPUTS):
+                out = out + coeffs[row, i] * inputs[i]
+            outputs.append(out)
+        return tuple(outputs)
+
+
+def get_scheduler_kernels():
+    device = args.device.split(":", 1)[0].strip()
+    key = (args.batch_size, args.height, args.width, device, args.precision)
+    if key in _kernels:
+        return _kernels[key]
+
+    dtype = torch.float16 if args.precision == "fp16" else torch.float32
+    example_latent = torch.randn(
+        args.batch_size, 4, args.height // 8, args.width // 8
+    ).to(dtype)
+    example_scale = torch.tensor(1).to(torch.float32)
+    example_coeffs = torch.zeros(2, NUM_STEP_INPUTS)
+
+    iree_flags = []
+    if len(args.iree_vulkan_target_triple) > 0:
+        iree_flags.append(
+            f"-iree-vulkan-target-triple={args.iree_vulkan_target_triple}"
+        )
+    # Disable bindings fusion to work with moltenVK.
+    if sys.platform == "darwin":
+        iree_flags.append("-iree-stream-fuse-binding=false")
+
+    suffix = (
+        f"{args.batch_size}_{args.height}_{args.width}_{device}_"
+        + args.precision
+    )
+    scale_model, _ = compile_through_fx(
+        model=ScaleModel(),
+        inputs=(example_latent, example_scale),
+        extended_model_name=f"scheduler_scale_{suffix}",
+        extra_args=iree_flags,
+    )
+    step_model, _ = compile_through_fx(
+        model=LinearCombinationModel(),
+        inputs=(example_latent,) * NUM_STEP_INPUTS + (example_coeffs,),
+        extended_model_name=f"scheduler_step_{suffix}",
+        extra_args=iree_flags,
+    )
+    _kernels[key] = (scale_model, step_model, dtype)
+    return _kernels[key]
+
+
+class SharkSchedulerMixin:
+    """
+    Runs `scale_model_input` and `step` of a diffusers scheduler on the
+    device.
+
+    ...
+
+    With the configs used by SD (no sample clipping or thresholding), the
+    updates of these schedulers are linear in the sample, the model output,
+    the history buffers and the noise, with coefficients that depend on the
+    timestep only. `step` gets those coefficients by running the diffusers
+    update on the host with unit vectors standing in for the tensors, and a
+    compiled kernel shared by all the schedulers applies them on the device.
+    The state tensors of the scheduler (e.g. `model_outputs`) hold device
+    tensors, so the history never leaves the device.
+
+    Attributes
+    ----------
+    state_attrs : tuple
+        names of the scheduler attributes holding tensors of state.
+
+    Methods
+    -------
+    compile():
+        Compiles, or fetches from the cache, the shared kernels.
+    scale_model_input(sample, timestep):
+        Returns the scaled sample as a device tensor.
+    step(noise_pred, timestep, latent, generator=None):
+        Returns the previous sample as a device tensor.
+    """
+
+    state_attrs = ()
+
+    def compile(self):
+        if self.config.get("clip_sample", False) or self.config.get(
+            "thresholding", False
+        ):
+            raise ValueError(
+                f"{type(self).__name__} does not support clip_sample or "
+                "thresholding, use the cpu scheduler instead."
+            )
+        (
+            self.scaling_model,
+            self.step_model,
+            self.kernel_dtype,
+        ) = get_scheduler_kernels()
+
+    def scale_model_input(self, sample, timestep):
+        scale = super().scale_model_input(
+            torch.ones(1, dtype=torch.float64), timestep
+        )
+        scale = float(scale[0])
+        if scale == 1.0 and isinstance(sample, SharkDeviceTensor):
+            return sample
+        return self.scaling_model(
+            "forward",
+            (sample, torch.tensor(scale).to(torch.float32)),
+            send_to_host=False,
+        )
+
+    def trace_step(self, model_output, timestep, sample, extra):
+        # `extra` is a free input slot for the schedulers drawing noise.
+        output = super().step(
+            model_output, timestep, sample, return_dict=False
+        )
+        return output[0]
+
+    def _swap_in_state(self, inputs, basis):
+        slot = 2
+        for name in self.state_attrs:
+            value = getattr(self, name)
+            values = value if isinstance(value, list) else [value]
+            stand_ins = []
+            for v in values:
+                if v is None or isinstance(v, (int, float)):
+                    stand_ins.append(v)
+                    continue
+                if slot >= NUM_STEP_INPUTS:
+                    raise ValueError(
+                        f"{type(self).__name__} has more state than the step "
+                        "kernel takes."
+                    )
+                inputs[slot] = v
+                stand_ins.append(basis[slot])
+                slot += 1
+            setattr(
+                self,
+                name,
+                stand_ins if isinstance(value, list) else stand_ins[0],
+            )
+        return slot
+
+    def _swap_out_state(self, inputs, basis):
+        # The state may only hold inputs of this step and at most one new
+        # tensor, computed by the kernel as its second output.
+        new_coeffs = None
+        new_refs = []
+        for name in self.state_attrs:
+            value = getattr(self, name)
+            values = value if isinstance(value, list) else [value]
+            real = []
+            for v in values:
+                if not isinstance(v, torch.Tensor):
+                    real.append(v)
+                    continue
+                unit = [
+                    k
+                    for k in range(NUM_STEP_INPUTS)
+                    if torch.equal(v, basis[k])
+                ]
+                if unit:
+                    real.append(inputs[unit[0]])
+                    continue
+                if new_coeffs is not None and not torch.equal(v, new_coeffs):
+                    raise ValueError(
+                        f"{type(self).__name__} creates more than one state "
+                        "tensor per step."
+                    )
+                new_coeffs = v
+                real.append(None)
+                new_refs.append((name, len(real) - 1))
+            setattr(self, name, real if isinstance(value, list) else real[0])
+        return new_coeffs, new_refs
+
+    def step(self, noise_pred, timestep, latent, generator=None):
+        basis = torch.eye(NUM_STEP_INPUTS, dtype=torch.float64)
+        inputs = [latent, noise_pred] + [None] * (NUM_STEP_INPUTS - 2)
+        slot = self._swap_in_state(inputs, basis)
+        extra = basis[slot] if slot < NUM_STEP_INPUTS else None
+        prev_coeffs = self.trace_step(basis[1], timestep, basis[0], extra)
+        new_coeffs, new_refs = self._swap_out_state(inputs, basis)
+
+        if extra is not None and prev_coeffs[slot] != 0:
+            shape = tuple(noise_pred.shape)
+            noise = torch.randn(
+                shape, generator=generator, dtype=self.kernel_dtype
+            )
+            inputs[slot] = noise.numpy()
+        # The unused slots are ignored by the kernel (zero coefficients).
+        inputs = [x if x is not None else noise_pred for x in inputs]
+        coeffs = torch.stack(
+            [
+                prev_coeffs,
+                (
+                    new_coeffs
+                    if new_coeffs is not None
+                    else torch.zeros(NUM_STEP_INPUTS, dtype=torch.float64)
+                ),
+            ]
+        ).to(torch.float32)
+        prev_sample, new_state = self.step_model(
+            "forward", tuple(inputs) + (coeffs,), send_to_host=False
+        )
+        for name, index in new_refs:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                value[index] = new_state
+            else:
+                setattr(self, name, new_state)
+        return prev_sample
+
+
+class SharkDDIMScheduler(SharkSchedulerMixin, DDIMScheduler):
+    pass
+
+
+class SharkPNDMScheduler(SharkSchedulerMixin, PNDMScheduler):
+    state_attrs = ("ets", "cur_sample", "cur_model_output")
+
+
+class SharkLMSDiscreteScheduler(SharkSchedulerMixin, LMSDiscreteScheduler):
+    state_attrs = ("derivatives",)
+
+
+class SharkKDPM2DiscreteScheduler(SharkSchedulerMixin, KDPM2DiscreteScheduler):
+    state_attrs = ("sample",)
+
+
+class SharkDPMSolverMultistepScheduler(
+    SharkSchedulerMixin, DPMSolverMultistepScheduler
+):
+    state_attrs = ("model_outputs",)
+
+
+class SharkDEISMultistepScheduler(SharkSchedulerMixin, DEISMultistepScheduler):
+    state_attrs = ("model_outputs",)
+
+
+class SharkEulerAncestralDiscreteScheduler(
+    SharkSchedulerMixin, EulerAncestralDiscreteScheduler
+):
+    def trace_step(self, model_output, timestep, sample, extra):
+        # Same update as EulerAncestralDiscreteScheduler.step, with the noise
+        # as an input of the kernel. It is drawn on the host from the given
+        # generator (or the global torch one), so a seed reproduces the
+        # images of the cpu scheduler.
+        step_index = (self.timesteps == timestep).nonzero().item()
+        sigma = self.sigmas[step_index].item()
+        sigma_to = self.sigmas[step_index + 1].item()
+        if self.config.prediction_type == "epsilon":
+            pred_original_sample = sample - sigma * model_output
+        elif self.config.prediction_type == "v_prediction":
+            pred_original_sample = model_output * (
+                -sigma / (sigma**2 + 1) ** 0.5
+            ) + (sample / (sigma**2 + 1))
+        else:
+            raise ValueError(
+                f"prediction_type given as {self.config.prediction_type} "
+                "must be one of `epsilon`, or `v_prediction`"
+            )
+        sigma_up = (sigma_to**2 * (sigma**2 - sigma_to**2) / sigma**2) ** 0.5
+        sigma_down = (sigma_to**2 - sigma_up**2) ** 0.5
+        derivative = (sample - pred_original_sample) / sigma
+        return sample + derivative * (sigma_down - sigma) + extra * sigma_up
+
+
+def get_loop_coefficients(scheduler, timesteps):
+    """
+    Returns, per timestep, the scale of the model input and the (sample,
+    model output) coefficients of the update of `scheduler`, for the loops
+    folded into one module (see UnetKStepModel). Raises ValueError for the
+    schedulers whose update also depends on history or noise.
+    """
+    # Traced with the plain diffusers methods, the Shark ones run on the
+    # device.
+    base = next(
+        (c for c in STATELESS_SCHEDULERS if isinstance(scheduler, c)), None
+    )
+    if base is None:
+        raise ValueError(
+            f"{type(scheduler).__name__} keeps state between steps and "
+            "can't be folded into a multi step module."
+        )
+    basis = torch.eye(NUM_STEP_INPUTS, dtype=torch.float64)
+    scales = []
+    coeffs = []
+    for t in timesteps:
+        scale = base.scale_model_input(
+            scheduler, torch.ones(1, dtype=torch.float64), t
+        )
+        output = base.step(
+            scheduler,
+            basis[1],
+            t,
+            basis[0],
+            generator=torch.Generator(),
+            return_dict=False,
+        )
+        if torch.any(output[0][2:] != 0):
+            raise ValueError(
+                f"{type(scheduler).__name__} adds noise in its steps and "
+                "can't be folded into a multi step module."
+            )
+        scales.append(float(scale[0]))
+        coeffs.append(output[0][:2].tolist())
+    return scales, coeffs
@@ -1,7 +1,16 @@
+from apps.stable_diffusion.src.utils.latent_preview import (
+    latents_to_preview,
+    generate_with_previews,
+)
 from apps.stable_diffusion.src.utils.profiler import (
     start_profiling,
     end_profiling,
 )
+from apps.stable_diffusion.src.utils.prompt_cache import (
+    PromptEmbeddingCache,
+    get_clip_identity,
+    get_prompt_embedding_cache,
+)
 from apps.stable_diffusion.src.utils.resources import (
     prompt_examples,
     models_db,
@@ -15,9 +24,12 @@ from apps.stable_diffusion.src.utils.stencils.stencil_utils import (
     controlnet_hint_conversion,
     get_stencil_model_id,
 )
+from apps.stable_diffusion.src.utils.tiled_vae import run_tiled
 from apps.stable_diffusion.src.utils.utils import (
     get_shark_model,
     compile_through_fx,
+    parallel_compile,
+    synchronous_compile,
     set_iree_runtime_flags,
     map_device_to_name_path,
     set_init_device_flags,
@@ -0,0 +1,83 @@
+import contextvars
+import queue
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+# Least squares fit of the RGB output of the SD 1.x/2.x VAE on its 4 latent
+# channels, [latent channel, rgb].
+LATENT_RGB_FACTORS = np.array(
+    [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ],
+    dtype=np.float32,
+)
+
+
+def latents_to_preview(latents):
+    """
+    Approximates the images of [N, 4, H, W] latents (torch, numpy or device
+    tensors) with a linear projection of the latent channels instead of the
+    VAE. Returns N PIL images of H x W, 1/8 of the image size.
+    """
+    if hasattr(latents, "to_host"):
+        latents = latents.to_host()
+    elif hasattr(latents, "detach"):
+        latents = latents.detach().cpu().float().numpy()
+    latents = np.asarray(latents, dtype=np.float32)
+    rgb = np.einsum("nchw,cr->nhwr", latents, LATENT_RGB_FACTORS)
+    rgb = ((rgb + 1) * 127.5).round().clip(0, 255).astype(np.uint8)
+    return [Image.fromarray(image) for image in rgb]
+
+
+def generate_with_previews(pipe, generate, previews=True):
+    """
+    Runs `generate()`, a call to `pipe.generate_images` or alike, in a thread
+    and yields (previews, None) for every preview the pipeline sends while
+    the images are denoised, then (None, images) with the return value of
+    `generate`. Meant for the generators of the web UI, which can only show
+    something by yielding it.
+
+    With `previews=False`, e.g. for API calls nobody watches, `generate` runs
+    in the calling thread without a preview callback, so the latents aren't
+    copied back to the host for previews, and only (None, images) is
+    yielded.
+    """
+    if not previews:
+        yield None, generate()
+        return
+    previews = queue.Queue()
+    result = {}
+
+    def run():
+        try:
+            result["images"] = generate()
+        except Exception as e:
+            result["error"] = e
+        finally:
+            previews.put(None)
+
+    pipe.preview_callback = lambda step, images: previews.put(images)
+    # In the context of the caller, so the step callbacks of the pipeline
+    # see its job (see JobQueue.current_job).
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(run,), daemon=True
+    )
+    thread.start()
+    try:
+        while True:
+            images = previews.get()
+            if images is None:
+                break
+            yield images, None
+    finally:
+        thread.join()
+        pipe.preview_callback = None
+    if "error" in result:
+        raise result["error"]
+    yield None, result["images"]
@@ -0,0 +1,127 @@
+import collections
+import os
+import threading
+
+from apps.stable_diffusion.src.utils.stable_args import args
+
+
+class PromptEmbeddingCache:
+    """
+    Bounded LRU cache of the final text embeddings of a prompt pair.
+
+    ...
+
+    Entries are keyed on the prompt, the negative prompt, the encoding
+    parameters and the identity of the text encoder (model, precision and
+    LoRA), so the same cache can serve several pipelines. The size is
+    accounted in bytes of the stored embeddings.
+
+    Attributes
+    ----------
+    max_bytes : int
+        size cap; least recently used entries are evicted past it.
+    stats : dict
+        hits, misses, evictions and invalidations.
+
+    Methods
+    -------
+    get(key):
+        Returns a copy of the cached embeddings or None.
+    put(key, embeddings):
+        Stores the embeddings and evicts old entries.
+    invalidate(clip_identity=None):
+        Drops the entries of one text encoder, or all of them.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+        self._entries = collections.OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(clip_identity, prompt, negative_prompt, *params):
+        def _as_tuple(p):
+            if p is None or isinstance(p, str):
+                return (p,)
+            return tuple(p)
+
+        return (
+            clip_identity,
+            _as_tuple(prompt),
+            _as_tuple(negative_prompt),
+        ) + params
+
+    def get(self, key):
+        with self._lock:
+            embeddings = self._entries.get(key)
+            if embeddings is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        # Callers may modify what they get back.
+        return embeddings.copy()
+
+    def put(self, key, embeddings):
+        if embeddings.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = embeddings.copy()
+            self._size_bytes += embeddings.nbytes
+            while self._size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size_bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+    def invalidate(self, clip_identity=None):
+        with self._lock:
+            for key in list(self._entries):
+                if clip_identity is None or key[0] == clip_identity:
+                    self._size_bytes -= self._entries.pop(key).nbytes
+                    self.stats["invalidations"] += 1
+
+    def size_bytes(self):
+        return self._size_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+
+def get_clip_identity(sd_model, use_lora=""):
+    """
+    Identifies the weights of the text encoder of `sd_model`. A LoRA given as
+    a local file includes its modification time, so editing it changes the
+    identity.
+    """
+    lora_mtime = None
+    if use_lora and os.path.isfile(use_lora):
+        lora_mtime = os.path.getmtime(use_lora)
+    return (sd_model.model_id, sd_model.precision, use_lora, lora_mtime)
+
+
+_prompt_embedding_cache = None
+
+
+def get_prompt_embedding_cache():
+    """Returns the process wide cache sized by --prompt_cache_size_mb."""
+    global _prompt_embedding_cache
+    if args.prompt_cache_size_mb <= 0:
+        return None
+    max_bytes = int(args.prompt_cache_size_mb * (1 << 20))
+    if _prompt_embedding_cache is None:
+        _prompt_embedding_cache = PromptEmbeddingCache(max_bytes)
+    _prompt_embedding_cache.max_bytes = max_bytes
+    return _prompt_embedding_cache
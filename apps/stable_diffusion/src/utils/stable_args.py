@@ -101,6 +101,22 @@ p.add_argument(
     help="the value to be used for noise level of upscaler.",
 )
 
+p.add_argument(
+    "--upscaler_tile_size",
+    type=int,
+    default=128,
+    help="Size of the square tiles the upscaler unet and VAE are compiled "
+    "for. Images of any size are upscaled by batches of --batch_size tiles.",
+)
+
+p.add_argument(
+    "--upscaler_tile_overlap",
+    type=int,
+    default=16,
+    help="Overlap in low res pixels of adjacent upscaler tiles, blended to "
+    "hide the seams.",
+)
+
 p.add_argument(
     "--max_length",
     type=int,
@@ -274,7 +290,8 @@ p.add_argument(
     "--scheduler",
     type=str,
     default="SharkEulerDiscrete",
-    help="other supported schedulers are [PNDM, DDIM, LMSDiscrete, EulerDiscrete, DPMSolverMultistep]",
+    help="other supported schedulers are [PNDM, DDIM, LMSDiscrete, EulerDiscrete, DPMSolverMultistep], "
+    "and their on-device versions prefixed with Shark, e.g. SharkDPMSolverMultistep",
 )
 
 p.add_argument(
@@ -361,6 +378,56 @@ p.add_argument(
     help="Load and unload models for low VRAM",
 )
 
+p.add_argument(
+    "--vae_tile_size",
+    type=int,
+    default=0,
+    help="Run the VAE on square tiles of this many latent pixels (8x in "
+    "image pixels), so one compile of bounded memory serves any output "
+    "size. 0 runs it on the whole image.",
+)
+
+p.add_argument(
+    "--vae_tile_overlap",
+    type=int,
+    default=8,
+    help="Overlap in latent pixels of adjacent VAE tiles, blended to hide "
+    "the seams.",
+)
+
+p.add_argument(
+    "--vae_tiles_per_call",
+    type=int,
+    default=1,
+    help="Number of VAE tiles batched into one call.",
+)
+
+p.add_argument(
+    "--unet_steps_per_call",
+    type=int,
+    default=1,
+    help="Fold this many denoising steps (unet and scheduler) into one "
+    "compiled module for txt2img with the EulerDiscrete or DDIM schedulers. "
+    "Fewer calls per image, at the cost of an extra unet compile.",
+)
+
+p.add_argument(
+    "--preview_every",
+    type=int,
+    default=5,
+    help="Send a low res preview of the images being denoised every this "
+    "many steps, to the pipelines having a preview callback (e.g. the web "
+    "UI). 0 disables the previews.",
+)
+
+p.add_argument(
+    "--prompt_cache_size_mb",
+    type=float,
+    default=64,
+    help="Size of the in memory cache of prompt text embeddings, reused "
+    "when the same prompts are generated again. 0 disables it.",
+)
+
 ##############################################################################
 ### IREE - Vulkan supported flags
 ##############################################################################
@@ -403,6 +470,27 @@ p.add_argument(
     help="use the default scheduler precompiled into the model if available",
 )
 
+p.add_argument(
+    "--parallel_compile",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Compile all the sub-models (clip, unet, vae, ...) concurrently when the pipeline is created.",
+)
+
+p.add_argument(
+    "--compile_workers",
+    type=int,
+    default=0,
+    help="Number of concurrent compile processes used with --parallel_compile. 0 uses the cpu count.",
+)
+
+p.add_argument(
+    "--compile_memory_budget_gb",
+    type=float,
+    default=None,
+    help="Approximate host memory in GB the concurrent compiles may use with --parallel_compile. Not limited if not set.",
+)
+
 p.add_argument(
     "--local_tank_cache",
     default="",
@@ -522,6 +610,24 @@ p.add_argument(
     help="flag for enabling rest API",
 )
 
+p.add_argument(
+    "--api_batch_size",
+    type=int,
+    default=1,
+    help="Number of txt2img API requests batched in one unet call. Above 1, "
+    "concurrent requests of the same model, size, steps and scheduler share "
+    "a pipeline compiled for this batch size, loaded next to the one of the "
+    "UI.",
+)
+
+p.add_argument(
+    "--api_batch_wait_ms",
+    type=float,
+    default=50,
+    help="How long a txt2img API request waits for others to fill its batch "
+    "with --api_batch_size.",
+)
+
 p.add_argument(
     "--output_gallery",
     default=True,
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+def get_tile_starts(size, tile_size, overlap):
+    """
+    Returns the offsets of the tiles covering [0, size) with tiles of
+    `tile_size` overlapping by at least `overlap`. The last tile ends at
+    `size`.
+    """
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(
+            f"Tile overlap {overlap} must be smaller than the tile size "
+            f"{tile_size}."
+        )
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def get_blend_ramp(length, overlap, blend_start, blend_end):
+    """
+    Weights along one axis of an output tile: a linear ramp over `overlap`
+    on the sides shared with another tile, 1 elsewhere.
+    """
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap <= 0:
+        return ramp
+    edge = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+    if blend_start:
+        ramp[:overlap] = np.minimum(ramp[:overlap], edge)
+    if blend_end:
+        ramp[length - overlap :] = np.minimum(
+            ramp[length - overlap :], edge[::-1]
+        )
+    return ramp
+
+
+def run_tiled(run, x, tile_size, overlap, tiles_per_call=1):
+    """
+    Runs `run` on [tile_size, tile_size] tiles of the [N, C, H, W] array `x`
+    and blends the outputs back into one array. The output tiles may be
+    larger or smaller than the input ones by a fixed factor, as for VAE
+    decode (8x) and encode (1/8x). Overlapping outputs are cross-faded to
+    hide the seams.
+
+    `run` takes a batch of `tiles_per_call` tiles stacked along the first
+    dim, which is what a module compiled for the tile shape expects; the
+    last batch is padded by repeating its last tile. Inputs smaller than a
+    tile are edge padded. Device memory only depends on the tile shape, not
+    on the size of `x`.
+    """
+    x = np.asarray(x)
+    n, _, height, width = x.shape
+    pad_h = max(tile_size - height, 0)
+    pad_w = max(tile_size - width, 0)
+    if pad_h or pad_w:
+        x = np.pad(x, ((0, 0), (0, 0), (0, pad_h), (0, pad_w)), mode="edge")
+
+    tiles = [
+        (top, left)
+        for top in get_tile_starts(x.shape[2], tile_size, overlap)
+        for left in get_tile_starts(x.shape[3], tile_size, overlap)
+    ]
+    output = None
+    weights = None
+    scale = None
+    for i in range(0, len(tiles), tiles_per_call):
+        group = tiles[i : i + tiles_per_call]
+        padded = group + [group[-1]] * (tiles_per_call - len(group))
+        batch = np.concatenate(
+            [
+                x[:, :, top : top + tile_size, left : left + tile_size]
+                for top, left in padded
+            ]
+        )
+        out = np.asarray(run(batch), dtype=np.float32)
+        if output is None:
+            scale = out.shape[-1] / tile_size
+            out_tile = out.shape[-1]
+            output = np.zeros(
+                (
+                    n,
+                    out.shape[1],
+                    round(x.shape[2] * scale),
+                    round(x.shape[3] * scale),
+                ),
+                dtype=np.float32,
+            )
+            weights = np.zeros(output.shape[2:], dtype=np.float32)
+            out_overlap = round(overlap * scale)
+        for j, (top, left) in enumerate(group):
+            out_top = round(top * scale)
+            out_left = round(left * scale)
+            weight = np.outer(
+                get_blend_ramp(
+                    out_tile,
+                    out_overlap,
+                    top > 0,
+                    top + tile_size < x.shape[2],
+                ),
+                get_blend_ramp(
+                    out_tile,
+                    out_overlap,
+                    left > 0,
+                    left + tile_size < x.shape[3],
+                ),
+            )
+            rows = slice(out_top, out_top + out_tile)
+            cols = slice(out_left, out_left + out_tile)
+            output[:, :, rows, cols] += out[j * n : (j + 1) * n] * weight
+            weights[rows, cols] += weight
+
+    output /= weights
+    return output[:, :, : round(height * scale), : round(width * scale)]
@@ -10,6 +10,8 @@ from pathlib import Path
 import numpy as np
 from random import randint
 import tempfile
+import time
+from contextlib import contextmanager
 import torch
 from safetensors.torch import load_file
 from shark.shark_inference import SharkInference
@@ -53,7 +55,92 @@ def _load_vmfb(shark_module, vmfb_path, model, precision):
     return shark_module
 
 
+# Set while `parallel_compile` is active: (CompilePool, pending modules).
+_parallel_compile = None
+
+
+@contextmanager
+def parallel_compile(num_workers=None, memory_budget_gb=None):
+    """
+    Within this context `_compile_module` queues the compiles on a process
+    pool instead of blocking, so the sub-models compile concurrently (and
+    overlap with importing the next sub-model). The returned shark_modules
+    are usable once the context exits.
+    """
+    global _parallel_compile
+    from shark.iree_utils.compile_pool import CompilePool
+
+    if _parallel_compile is not None:
+        yield
+        return
+    start = time.time()
+    with CompilePool(num_workers, memory_budget_gb) as pool:
+        pending = []
+        _parallel_compile = (pool, pending)
+        try:
+            yield
+        finally:
+            _parallel_compile = None
+    errors = []
+    for shark_module, model_name, extra_args, future in pending:
+        try:
+            flatbuffer_blob = future.result()
+        except Exception as e:
+            errors.append((model_name, e))
+            continue
+        if args.save_vmfb:
+            vmfb_path = get_vmfb_path_name(model_name)
+            print("Saving to {}".format(vmfb_path))
+            with open(vmfb_path, "wb") as f:
+                f.write(flatbuffer_blob)
+        shark_module.load_flatbuffer_blob(
+            flatbuffer_blob, extra_args=extra_args
+        )
+    print(
+        f"Compiled {len(pending) - len(errors)} modules in "
+        f"{time.time() - start:.1f}s with {pool.num_workers} workers."
+    )
+    if errors:
+        for model_name, e in errors:
+            print(f"Compiling {model_name} failed: {e}")
+        raise errors[0][1]
+
+
+@contextmanager
+def synchronous_compile():
+    """
+    Compiles blocking within this context, even inside `parallel_compile`,
+    for callers that need to know whether a compile succeeded, e.g. to
+    retry with another configuration.
+    """
+    global _parallel_compile
+    saved = _parallel_compile
+    _parallel_compile = None
+    try:
+        yield
+    finally:
+        _parallel_compile = saved
+
+
 def _compile_module(shark_module, model_name, extra_args=[]):
+    if (
+        _parallel_compile is not None
+        and not args.dispatch_benchmarks
+        and not (
+            args.load_vmfb and os.path.isfile(get_vmfb_path_name(model_name))
+        )
+    ):
+        pool, pending = _parallel_compile
+        future = pool.submit(
+            model_name,
+            shark_module.mlir_module,
+            shark_module.device,
+            shark_module.mlir_dialect,
+            extra_args,
+        )
+        pending.append((shark_module, model_name, extra_args, future))
+        return shark_module
+
     if args.load_vmfb or args.save_vmfb:
         vmfb_path = get_vmfb_path_name(model_name)
         if args.load_vmfb and os.path.isfile(vmfb_path) and not args.save_vmfb:
@@ -0,0 +1,135 @@
+import time
+import unittest
+from unittest import mock
+
+from apps.stable_diffusion.src.pipelines import (
+    pipeline_shark_stable_diffusion_batch as batch,
+)
+from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_batch import (
+    Text2ImageBatchScheduler,
+)
+
+
+class FakePipeline:
+    # Returns (prompt, seed, guidance scale) per sample instead of images.
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+        self.scheduler = None
+
+    def generate_images_batch(
+        self, prompts, neg_prompts, seeds, guidance_scales, *args
+    ):
+        self.calls.append((list(prompts), list(seeds), args[2]))
+        if self.error is not None:
+            raise self.error
+        return list(zip(prompts, seeds, guidance_scales))
+
+
+class FakeLoader:
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.keys = []
+
+    def __call__(self, model_id, height, width, batch_size):
+        self.keys.append((model_id, height, width, batch_size))
+        # The args the pipeline is compiled with.
+        self.args = (batch.args.hf_model_id, batch.args.height)
+        return self.pipe, {"SharkEulerDiscrete": "euler", "DDIM": "ddim"}
+
+
+class Text2ImageBatchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(batch, "set_init_device_flags", lambda: None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def make_scheduler(
+        self, batch_size, max_wait_ms, error=None, run_batch=None
+    ):
+        self.pipe = FakePipeline(error)
+        self.loader = FakeLoader(self.pipe)
+        scheduler = Text2ImageBatchScheduler(
+            batch_size,
+            max_wait_ms,
+            load_pipeline=self.loader,
+            run_batch=run_batch,
+        )
+        self.addCleanup(scheduler.close)
+        return scheduler
+
+    def test_groups_by_batch_key(self):
+        scheduler = self.make_scheduler(2, 200)
+        futures = [
+            scheduler.submit("a", seed=1, steps=20, model_id="m"),
+            scheduler.submit("b", seed=2, steps=30, model_id="m"),
+            scheduler.submit("c", seed=3, steps=20, model_id="m"),
+        ]
+        results = [future.result(timeout=5)[0] for future in futures]
+        self.assertEqual(
+            results, [("a", 1, 7.5), ("b", 2, 7.5), ("c", 3, 7.5)]
+        )
+        # The requests of 20 steps share a call, the one of 30 steps is
+        # padded with a copy of itself.
+        self.assertEqual(
+            self.pipe.calls,
+            [(["a", "c"], [1, 3], 20), (["b", "b"], [2, 2], 30)],
+        )
+        self.assertEqual(self.loader.keys, [("m", 512, 512, 2)])
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["batches"], 2)
+        self.assertEqual(metrics["padded_samples"], 1)
+        self.assertAlmostEqual(metrics["mean_batch_occupancy"], 0.75)
+
+    def test_max_wait_deadline(self):
+        scheduler = self.make_scheduler(4, 50)
+        start = time.time()
+        image, seed = scheduler.submit("a", seed=5, model_id="m").result(
+            timeout=5
+        )
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual((image, seed), (("a", 5, 7.5), 5))
+        self.assertEqual(self.pipe.calls[0][0], ["a"] * 4)
+        self.assertEqual(scheduler.metrics()["padded_samples"], 3)
+
+    def test_scheduler_is_set(self):
+        scheduler = self.make_scheduler(1, 0)
+        scheduler.submit("a", model_id="m", scheduler="DDIM").result(5)
+        self.assertEqual(self.pipe.scheduler, "ddim")
+
+    def test_errors_reach_every_request(self):
+        scheduler = self.make_scheduler(2, 200, RuntimeError("unet failed"))
+        futures = [
+            scheduler.submit(prompt, model_id="m") for prompt in ("a", "b")
+        ]
+        for future in futures:
+            with self.assertRaisesRegex(RuntimeError, "unet failed"):
+                future.result(timeout=5)
+        self.assertEqual(scheduler.metrics()["finished"], 2)
+
+    def test_args_are_restored(self):
+        scheduler = self.make_scheduler(1, 0)
+        saved_args = dict(vars(batch.args))
+        scheduler.submit("a", model_id="m", height=768).result(5)
+        self.assertEqual(self.loader.args, ("m", 768))
+        self.assertEqual(vars(batch.args), saved_args)
+
+    def test_run_batch(self):
+        runs = []
+
+        def run_batch(fn, requests):
+            runs.append([(r.prompt, r.user, r.priority) for r in requests])
+            return fn()
+
+        scheduler = self.make_scheduler(2, 200, run_batch=run_batch)
+        futures = [
+            scheduler.submit("a", seed=1, model_id="m", user="u"),
+            scheduler.submit("b", seed=2, model_id="m", priority=1),
+        ]
+        results = [future.result(timeout=5)[0] for future in futures]
+        self.assertEqual(results, [("a", 1, 7.5), ("b", 2, 7.5)])
+        self.assertEqual(runs, [[("a", "u", 0), ("b", "", 1)]])
+
+
+if __name__ == "__main__":
+    unittest.main()
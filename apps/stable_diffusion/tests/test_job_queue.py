@@ -0,0 +1,145 @@
+import contextvars
+import threading
+import unittest
+
+from apps.stable_diffusion.web.utils.job_queue import (
+    JOB_CANCELLED,
+    JOB_DONE,
+    JOB_FAILED,
+    JobCancelled,
+    JobQueue,
+)
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = JobQueue(num_workers=1)
+        self.addCleanup(self.queue.close)
+        self.order = []
+
+    def block_worker(self):
+        # Keeps the worker busy until the returned event is set, so the
+        # jobs submitted meanwhile are all waiting when it picks the next.
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        self.queue.submit(blocker, user="blocker")
+        started.wait(5)
+        return release
+
+    def record(self, name):
+        return lambda: self.order.append(name)
+
+    def test_priority_order(self):
+        release = self.block_worker()
+        jobs = [
+            self.queue.submit(self.record("low"), priority=0),
+            self.queue.submit(self.record("high"), priority=2),
+            self.queue.submit(self.record("mid"), priority=1),
+        ]
+        release.set()
+        for job in jobs:
+            job.wait(5)
+        self.assertEqual(self.order, ["high", "mid", "low"])
+
+    def test_user_fairness(self):
+        release = self.block_worker()
+        jobs = [
+            self.queue.submit(self.record("a1"), user="a"),
+            self.queue.submit(self.record("a2"), user="a"),
+            self.queue.submit(self.record("a3"), user="a"),
+            self.queue.submit(self.record("b1"), user="b"),
+        ]
+        release.set()
+        for job in jobs:
+            job.wait(5)
+        self.assertEqual(self.order, ["a1", "b1", "a2", "a3"])
+
+    def test_cancel_queued(self):
+        release = self.block_worker()
+        job = self.queue.submit(self.record("cancelled"))
+        self.assertTrue(self.queue.cancel(job.id))
+        release.set()
+        with self.assertRaises(JobCancelled):
+            job.wait(5)
+        self.assertEqual(job.state, JOB_CANCELLED)
+        self.assertFalse(self.queue.cancel(job.id))
+        self.queue.submit(lambda: None).wait(5)
+        self.assertEqual(self.order, [])
+
+    def test_cancel_running_at_step(self):
+        at_step = threading.Event()
+        cancelled = threading.Event()
+
+        def steps():
+            # Reports progress from another thread run in the context of
+            # the job, like generate_with_previews.
+            for step in range(10):
+                self.queue.current_job().report_progress(step, 10)
+                if step == 2:
+                    at_step.set()
+                    cancelled.wait(5)
+
+        def fn():
+            thread_error = []
+
+            def run():
+                try:
+                    steps()
+                except JobCancelled as e:
+                    thread_error.append(e)
+
+            thread = threading.Thread(
+                target=contextvars.copy_context().run, args=(run,)
+            )
+            thread.start()
+            thread.join()
+            if thread_error:
+                raise thread_error[0]
+
+        job = self.queue.submit(fn)
+        at_step.wait(5)
+        self.assertTrue(self.queue.cancel(job.id))
+        cancelled.set()
+        with self.assertRaises(JobCancelled):
+            job.wait(5)
+        self.assertEqual(job.state, JOB_CANCELLED)
+        self.assertEqual((job.step, job.total_steps), (3, 10))
+        self.assertIsNone(self.queue.current_job())
+
+    def test_generator_result_and_events(self):
+        def fn():
+            yield "partial"
+            yield "final"
+
+        job = self.queue.submit(fn)
+        self.assertEqual(job.wait(5), "final")
+        states = [event.get("state") for event in job.events(timeout=5)]
+        self.assertEqual(states, ["queued", "running", JOB_DONE])
+
+    def test_metrics(self):
+        def fail():
+            raise ValueError("failed")
+
+        self.queue.submit(lambda: None).wait(5)
+        failed = self.queue.submit(fail)
+        with self.assertRaises(ValueError):
+            failed.wait(5)
+        self.assertEqual(failed.state, JOB_FAILED)
+        metrics = self.queue.metrics()
+        self.assertEqual(metrics["submitted"], 2)
+        self.assertEqual(metrics[JOB_DONE], 1)
+        self.assertEqual(metrics[JOB_FAILED], 1)
+        self.assertEqual(metrics[JOB_CANCELLED], 0)
+        self.assertEqual(metrics["waiting"], 0)
+        self.assertEqual(metrics["started"], 2)
+        self.assertGreaterEqual(metrics["mean_run_time_ms"], 0.0)
+        self.assertEqual(len(self.queue.jobs()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
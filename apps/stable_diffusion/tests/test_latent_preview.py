@@ -0,0 +1,73 @@
+import types
+import unittest
+
+import numpy as np
+import torch
+
+from apps.stable_diffusion.src.utils.latent_preview import (
+    generate_with_previews,
+    latents_to_preview,
+)
+
+
+class LatentsToPreviewTest(unittest.TestCase):
+    def test_shape_and_dtype(self):
+        latents = torch.randn(2, 4, 8, 16, dtype=torch.float16)
+        images = latents_to_preview(latents)
+        self.assertEqual(len(images), 2)
+        for image in images:
+            self.assertEqual(image.mode, "RGB")
+            self.assertEqual(image.size, (16, 8))
+            self.assertEqual(np.asarray(image).dtype, np.uint8)
+
+    def test_numpy(self):
+        images = latents_to_preview(np.zeros((1, 4, 4, 4), dtype=np.float32))
+        # Zero latents map to mid grey.
+        np.testing.assert_array_equal(np.asarray(images[0]), 128)
+
+
+class GenerateWithPreviewsTest(unittest.TestCase):
+    def setUp(self):
+        self.pipe = types.SimpleNamespace(preview_callback=None)
+
+    def generate(self, error=None):
+        def run():
+            for step in range(3):
+                if self.pipe.preview_callback is not None:
+                    self.pipe.preview_callback(step, [f"preview {step}"])
+            if error is not None:
+                raise error
+            return ["image"]
+
+        return run
+
+    def test_previews_then_result(self):
+        outputs = list(generate_with_previews(self.pipe, self.generate()))
+        self.assertEqual(
+            outputs,
+            [
+                (["preview 0"], None),
+                (["preview 1"], None),
+                (["preview 2"], None),
+                (None, ["image"]),
+            ],
+        )
+        self.assertIsNone(self.pipe.preview_callback)
+
+    def test_reraises(self):
+        outputs = generate_with_previews(
+            self.pipe, self.generate(ValueError("unet failed"))
+        )
+        with self.assertRaisesRegex(ValueError, "unet failed"):
+            list(outputs)
+        self.assertIsNone(self.pipe.preview_callback)
+
+    def test_without_previews(self):
+        outputs = list(
+            generate_with_previews(self.pipe, self.generate(), previews=False)
+        )
+        self.assertEqual(outputs, [(None, ["image"])])
+
+
+if __name__ == "__main__":
+    unittest.main()
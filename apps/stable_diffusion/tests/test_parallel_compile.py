@@ -0,0 +1,79 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from apps.stable_diffusion.src.utils import utils
+from shark.iree_utils import compile_pool
+
+
+def fake_compile(module, target_backend, args, input_type):
+    if module.startswith(b"bad"):
+        raise RuntimeError(f"{module.decode()} failed")
+    return module + b" flatbuffer"
+
+
+def thread_pool(max_workers, mp_context):
+    # The compiles run in threads, which see the patched compile function.
+    return ThreadPoolExecutor(max_workers)
+
+
+class FakeModule:
+    def __init__(self, mlir_module):
+        self.mlir_module = mlir_module
+        self.device = "cpu"
+        self.mlir_dialect = "linalg"
+        self.flatbuffer = None
+
+    def load_flatbuffer_blob(self, flatbuffer_blob, extra_args=[]):
+        self.flatbuffer = flatbuffer_blob
+
+
+class ParallelCompileTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(
+                compile_pool, "_compile_in_worker", fake_compile
+            ),
+            mock.patch.object(
+                compile_pool, "ProcessPoolExecutor", thread_pool
+            ),
+            mock.patch.object(
+                compile_pool,
+                "get_iree_compile_args",
+                lambda device, frontend, extra_args: ([], "none"),
+            ),
+            mock.patch.object(
+                compile_pool, "get_vmfb_cache_for", lambda a: None
+            ),
+            mock.patch.object(utils.args, "load_vmfb", False),
+            mock.patch.object(utils.args, "save_vmfb", False),
+            mock.patch.object(utils.args, "dispatch_benchmarks", None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_failed_compile_keeps_the_others(self):
+        good, bad = FakeModule(b"clip"), FakeModule(b"bad_unet")
+        with mock.patch("builtins.print") as printed:
+            with self.assertRaisesRegex(RuntimeError, "bad_unet failed"):
+                with utils.parallel_compile():
+                    utils._compile_module(good, "clip")
+                    utils._compile_module(bad, "bad_unet")
+        # The module that compiled is loaded despite the other failure.
+        self.assertEqual(good.flatbuffer, b"clip flatbuffer")
+        self.assertIsNone(bad.flatbuffer)
+        output = "\n".join(str(call.args[0]) for call in printed.mock_calls)
+        self.assertIn("Compiling bad_unet failed: bad_unet failed", output)
+        self.assertIn("Compiled 1 modules", output)
+
+    def test_synchronous_compile_inside(self):
+        with utils.parallel_compile():
+            with utils.synchronous_compile():
+                self.assertIsNone(utils._parallel_compile)
+            self.assertIsNotNone(utils._parallel_compile)
+        self.assertIsNone(utils._parallel_compile)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+from apps.stable_diffusion.src.utils.prompt_cache import (
+    PromptEmbeddingCache,
+    get_clip_identity,
+)
+
+
+def embeddings(value):
+    # 16 bytes.
+    return np.full(4, value, dtype=np.float32)
+
+
+class PromptEmbeddingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = PromptEmbeddingCache(max_bytes=48)
+
+    def key(self, prompt, clip_identity="clip"):
+        return self.cache.make_key(clip_identity, prompt, "", 77, True, 1)
+
+    def test_lru_eviction(self):
+        for i, prompt in enumerate("abc"):
+            self.cache.put(self.key(prompt), embeddings(i))
+        # "a" becomes the most recently used, "b" the least.
+        self.assertIsNotNone(self.cache.get(self.key("a")))
+        self.cache.put(self.key("d"), embeddings(3))
+        self.assertIsNone(self.cache.get(self.key("b")))
+        for prompt in "acd":
+            self.assertIsNotNone(self.cache.get(self.key(prompt)))
+        self.assertEqual(self.cache.stats["evictions"], 1)
+
+    def test_byte_budget(self):
+        self.cache.put(self.key("a"), embeddings(0))
+        self.cache.put(self.key("a"), embeddings(1))
+        self.assertEqual(self.cache.size_bytes(), 16)
+        self.cache.put(self.key("big"), np.zeros(8, dtype=np.float32))
+        self.assertEqual(self.cache.size_bytes(), 48)
+        self.assertEqual(len(self.cache), 2)
+        # Larger than the whole cache: not stored, nothing evicted.
+        self.cache.put(self.key("huge"), np.zeros(16, dtype=np.float32))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.stats["evictions"], 0)
+
+    def test_get_returns_a_copy(self):
+        self.cache.put(self.key("a"), embeddings(1))
+        self.cache.get(self.key("a"))[:] = 0
+        np.testing.assert_array_equal(
+            self.cache.get(self.key("a")), embeddings(1)
+        )
+
+    def test_key(self):
+        self.assertEqual(self.key("a"), self.key(["a"]))
+        self.assertNotEqual(self.key("a"), self.key("a", "other clip"))
+
+    def test_invalidate_on_clip_identity_change(self):
+        sd_model = types.SimpleNamespace(model_id="sd", precision="fp16")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lora = os.path.join(tmp_dir, "lora.safetensors")
+            open(lora, "wb").close()
+            os.utime(lora, (1, 1))
+            old_identity = get_clip_identity(sd_model, lora)
+            os.utime(lora, (2, 2))
+            new_identity = get_clip_identity(sd_model, lora)
+        self.assertNotEqual(old_identity, new_identity)
+
+        self.cache.put(self.key("a", old_identity), embeddings(0))
+        self.cache.put(self.key("b", old_identity), embeddings(1))
+        self.cache.put(self.key("a", new_identity), embeddings(2))
+        self.cache.invalidate(old_identity)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.size_bytes(), 16)
+        self.assertEqual(self.cache.stats["invalidations"], 2)
+        self.assertIsNone(self.cache.get(self.key("a", old_identity)))
+        self.assertIsNotNone(self.cache.get(self.key("a", new_identity)))
+
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size_bytes(), 0)
+
+    def test_hit_rate(self):
+        self.assertEqual(self.cache.hit_rate(), 0.0)
+        self.cache.put(self.key("a"), embeddings(0))
+        self.cache.get(self.key("a"))
+        self.cache.get(self.key("a"))
+        self.cache.get(self.key("b"))
+        self.assertEqual(self.cache.stats["hits"], 2)
+        self.assertEqual(self.cache.stats["misses"], 1)
+        self.assertAlmostEqual(self.cache.hit_rate(), 2 / 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
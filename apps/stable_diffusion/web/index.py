@@ -37,6 +37,11 @@ if __name__ == "__main__":
             upscaler_api,
             inpaint_api,
         )
+        from apps.stable_diffusion.web.ui.utils import (
+            jobs_api,
+            job_api,
+            cancel_job_api,
+        )
         from fastapi import FastAPI, APIRouter
         import uvicorn
 
@@ -51,6 +56,13 @@ if __name__ == "__main__":
         #      "/sdapi/v1/outpaint", outpaint_api, methods=["post"]
         #  )
         app.add_api_route("/sdapi/v1/upscaler", upscaler_api, methods=["post"])
+        # The generations above run one at a time through a job queue,
+        # monitored and cancelled with these.
+        app.add_api_route("/sdapi/v1/jobs", jobs_api, methods=["get"])
+        app.add_api_route("/sdapi/v1/jobs/{job_id}", job_api, methods=["get"])
+        app.add_api_route(
+            "/sdapi/v1/jobs/{job_id}/cancel", cancel_job_api, methods=["post"]
+        )
         app.include_router(APIRouter())
         uvicorn.run(app, host="127.0.0.1", port=args.server_port)
         sys.exit(0)
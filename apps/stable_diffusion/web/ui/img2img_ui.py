@@ -15,6 +15,7 @@ from apps.stable_diffusion.web.ui.utils import (
     scheduler_list_cpu_only,
     predefined_models,
     cancel_sd,
+    run_as_job,
 )
 from apps.stable_diffusion.src import (
     args,
@@ -310,7 +311,9 @@ def img2img_api(
         f'Prompt: {InputData["prompt"]}, Negative Prompt: {InputData["negative_prompt"]}, Seed: {InputData["seed"]}'
     )
     init_image = decode_base64_to_image(InputData["init_images"][0])
-    res = img2img_inf(
+    res = run_as_job(
+        InputData,
+        img2img_inf,
         InputData["prompt"],
         InputData["negative_prompt"],
         init_image,
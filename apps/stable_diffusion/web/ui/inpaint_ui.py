@@ -15,6 +15,7 @@ from apps.stable_diffusion.web.ui.utils import (
     scheduler_list_cpu_only,
     predefined_paint_models,
     cancel_sd,
+    run_as_job,
 )
 from apps.stable_diffusion.src import (
     args,
@@ -261,7 +262,9 @@ def inpaint_api(
     )
     init_image = decode_base64_to_image(InputData["image"])
     mask = decode_base64_to_image(InputData["mask"])
-    res = inpaint_inf(
+    res = run_as_job(
+        InputData,
+        inpaint_inf,
         InputData["prompt"],
         InputData["negative_prompt"],
         {"image": init_image, "mask": mask},
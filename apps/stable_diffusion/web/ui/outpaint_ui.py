@@ -14,6 +14,7 @@ from apps.stable_diffusion.web.ui.utils import (
     scheduler_list_cpu_only,
     predefined_paint_models,
     cancel_sd,
+    run_as_job,
 )
 from apps.stable_diffusion.src import (
     args,
@@ -267,7 +268,9 @@ def outpaint_api(
         f'Prompt: {InputData["prompt"]}, Negative Prompt: {InputData["negative_prompt"]}, Seed: {InputData["seed"]}'
     )
     init_image = decode_base64_to_image(InputData["init_images"][0])
-    res = outpaint_inf(
+    res = run_as_job(
+        InputData,
+        outpaint_inf,
         InputData["prompt"],
         InputData["negative_prompt"],
         init_image,
@@ -15,7 +15,9 @@ from apps.stable_diffusion.web.ui.utils import (
     scheduler_list,
     predefined_models,
     cancel_sd,
+    run_as_job,
 )
+from apps.stable_diffusion.web.utils.job_queue import JobCancelled
 from apps.stable_diffusion.web.utils.metadata import import_png_metadata
 from apps.stable_diffusion.web.utils.common_label_calc import status_label
 from apps.stable_diffusion.src import (
@@ -30,6 +32,7 @@ from apps.stable_diffusion.src import (
 from apps.stable_diffusion.src.utils import (
     get_generated_imgs_path,
     get_generation_text_info,
+    generate_with_previews,
 )
 
 # set initial values of iree_vulkan_target_triple, use_tuned and import_mlir.
@@ -60,6 +63,7 @@ def txt2img_inf(
     lora_weights: str,
     lora_hf_id: str,
     ondemand: bool,
+    show_previews: bool = True,
 ):
     from apps.stable_diffusion.web.ui.utils import (
         get_custom_model_pathfile,
@@ -180,20 +184,30 @@ def txt2img_inf(
     for i in range(batch_count):
         if i > 0:
             img_seed = utils.sanitize_seed(-1)
-        out_imgs = global_obj.get_sd_obj().generate_images(
-            prompt,
-            negative_prompt,
-            batch_size,
-            height,
-            width,
-            steps,
-            guidance_scale,
-            img_seed,
-            args.max_length,
-            dtype,
-            args.use_base_vae,
-            cpu_scheduling,
-        )
+        # Show low res previews of the images being denoised until they
+        # are decoded.
+        for previews, out_imgs in generate_with_previews(
+            global_obj.get_sd_obj(),
+            lambda: global_obj.get_sd_obj().generate_images(
+                prompt,
+                negative_prompt,
+                batch_size,
+                height,
+                width,
+                steps,
+                guidance_scale,
+                img_seed,
+                args.max_length,
+                dtype,
+                args.use_base_vae,
+                cpu_scheduling,
+            ),
+            show_previews,
+        ):
+            if previews is not None:
+                yield generated_imgs + previews, text_output, status_label(
+                    "Text-to-Image", i, batch_count, batch_size
+                )
         seeds.append(img_seed)
         total_time = time.time() - start_time
         text_output = get_generation_text_info(seeds, device)
@@ -237,7 +251,11 @@ def txt2img_api(
     print(
         f'Prompt: {InputData["prompt"]}, Negative Prompt: {InputData["negative_prompt"]}, Seed: {InputData["seed"]}'
     )
-    res = txt2img_inf(
+    if args.api_batch_size > 1:
+        return txt2img_batched_api(InputData)
+    res = run_as_job(
+        InputData,
+        txt2img_inf,
         InputData["prompt"],
         InputData["negative_prompt"],
         InputData["height"],
@@ -261,6 +279,7 @@ def txt2img_api(
         lora_weights="None",
         lora_hf_id="",
         ondemand=False,
+        show_previews=False,
     )
     return {
         "images": encode_pil_to_base64(res[0]),
@@ -269,6 +288,40 @@ def txt2img_api(
     }
 
 
+# With --api_batch_size, the requests served concurrently are grouped into
+# batched unet calls instead of queued one image at a time.
+def txt2img_batched_api(InputData: dict):
+    import apps.stable_diffusion.web.utils.global_obj as global_obj
+
+    batch_scheduler = global_obj.get_batch_scheduler(
+        args.api_batch_size, args.api_batch_wait_ms
+    )
+    future = batch_scheduler.submit(
+        InputData["prompt"],
+        InputData["negative_prompt"],
+        seed=InputData["seed"],
+        guidance_scale=InputData["cfg_scale"],
+        steps=InputData["steps"],
+        height=InputData["height"],
+        width=InputData["width"],
+        scheduler="EulerDiscrete",
+        model_id=InputData.get(
+            "hf_model_id", "stabilityai/stable-diffusion-2-1-base"
+        ),
+        user=InputData.get("user", ""),
+        priority=int(InputData.get("priority", 0)),
+    )
+    try:
+        image, seed = future.result()
+    except JobCancelled as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {
+        "images": encode_pil_to_base64([image]),
+        "parameters": {},
+        "info": f"seed={seed}, batch_size={args.api_batch_size}",
+    }
+
+
 with gr.Blocks(title="Text-to-Image") as txt2img_web:
     with gr.Row(elem_id="ui_title"):
         nod_logo = Image.open(nodlogo_loc)
@@ -14,6 +14,7 @@ from apps.stable_diffusion.web.ui.utils import (
     scheduler_list_cpu_only,
     predefined_upscaler_models,
     cancel_sd,
+    run_as_job,
 )
 from apps.stable_diffusion.web.utils.common_label_calc import status_label
 from apps.stable_diffusion.src import (
@@ -78,7 +79,7 @@ def upscaler_inf(
 
     if init_image is None:
         return None, "An Initial Image is required"
-    image = init_image.convert("RGB").resize((height, width))
+    image = init_image.convert("RGB").resize((width, height))
 
     # set ckpt_loc and hf_model_id.
     args.ckpt_loc = ""
@@ -110,8 +111,10 @@ def upscaler_inf(
 
     dtype = torch.float32 if precision == "fp32" else torch.half
     cpu_scheduling = not scheduler.startswith("Shark")
-    args.height = 128
-    args.width = 128
+    # The models are compiled for one tile, any image size is upscaled by
+    # tiles.
+    args.height = args.upscaler_tile_size
+    args.width = args.upscaler_tile_size
     new_config_obj = Config(
         "upscaler",
         args.hf_model_id,
@@ -181,35 +184,23 @@ def upscaler_inf(
     for current_batch in range(batch_count):
         if current_batch > 0:
             img_seed = utils.sanitize_seed(-1)
-        low_res_img = image
-        high_res_img = Image.new("RGB", (height * 4, width * 4))
-
-        for i in range(0, width, 128):
-            for j in range(0, height, 128):
-                box = (j, i, j + 128, i + 128)
-                upscaled_image = global_obj.get_sd_obj().generate_images(
-                    prompt,
-                    negative_prompt,
-                    low_res_img.crop(box),
-                    batch_size,
-                    args.height,
-                    args.width,
-                    steps,
-                    noise_level,
-                    guidance_scale,
-                    img_seed,
-                    args.max_length,
-                    dtype,
-                    args.use_base_vae,
-                    cpu_scheduling,
-                )
-                if global_obj.get_sd_status() == SD_STATE_CANCEL:
-                    break
-                else:
-                    high_res_img.paste(upscaled_image[0], (j * 4, i * 4))
-
-            if global_obj.get_sd_status() == SD_STATE_CANCEL:
-                break
+        high_res_img = global_obj.get_sd_obj().generate_images(
+            prompt,
+            negative_prompt,
+            image,
+            batch_size,
+            args.height,
+            args.width,
+            steps,
+            noise_level,
+            guidance_scale,
+            img_seed,
+            args.max_length,
+            dtype,
+            args.use_base_vae,
+            cpu_scheduling,
+            args.upscaler_tile_overlap,
+        )[0]
 
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
@@ -272,7 +263,9 @@ def upscaler_api(
         f'Prompt: {InputData["prompt"]}, Negative Prompt: {InputData["negative_prompt"]}, Seed: {InputData["seed"]}'
     )
     init_image = decode_base64_to_image(InputData["init_images"][0])
-    res = upscaler_inf(
+    res = run_as_job(
+        InputData,
+        upscaler_inf,
         InputData["prompt"],
         InputData["negative_prompt"],
         init_image,
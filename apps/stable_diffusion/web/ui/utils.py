@@ -5,7 +5,9 @@ import glob
 from pathlib import Path
 from apps.stable_diffusion.src import args
 from dataclasses import dataclass
+from fastapi.exceptions import HTTPException
 import apps.stable_diffusion.web.utils.global_obj as global_obj
+from apps.stable_diffusion.web.utils.job_queue import JobCancelled
 from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_utils import (
     SD_STATE_CANCEL,
 )
@@ -44,6 +46,13 @@ scheduler_list_cpu_only = [
 ]
 scheduler_list = scheduler_list_cpu_only + [
     "SharkEulerDiscrete",
+    "SharkEulerAncestralDiscrete",
+    "SharkDPMSolverMultistep",
+    "SharkDDIM",
+    "SharkPNDM",
+    "SharkLMSDiscrete",
+    "SharkKDPM2Discrete",
+    "SharkDEISMultistep",
 ]
 
 predefined_models = [
@@ -158,5 +167,43 @@ def cancel_sd():
         pass
 
 
+# Runs a generation of the REST API through the job queue and returns its
+# result. The optional "user" and "priority" fields of the request schedule
+# it against the other queued requests.
+def run_as_job(InputData, fn, *args, **kwargs):
+    job = global_obj.get_job_queue().submit(
+        lambda: fn(*args, **kwargs),
+        user=InputData.get("user", ""),
+        priority=int(InputData.get("priority", 0)),
+    )
+    try:
+        return job.wait()
+    except JobCancelled as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+# Job monitoring Rest API.
+def jobs_api():
+    job_queue = global_obj.get_job_queue()
+    return {
+        "metrics": job_queue.metrics(),
+        "batch_metrics": global_obj.get_batch_scheduler_metrics(),
+        "jobs": job_queue.jobs(),
+    }
+
+
+def job_api(job_id: str):
+    job = global_obj.get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.info()
+
+
+def cancel_job_api(job_id: str):
+    if not global_obj.get_job_queue().cancel(job_id):
+        raise HTTPException(status_code=404, detail="Unknown or finished job")
+    return {"cancelled": job_id}
+
+
 nodlogo_loc = resource_path("logos/nod-logo.png")
 available_devices = get_available_devices()
@@ -1,4 +1,5 @@
 import gc
+from apps.stable_diffusion.web.utils.job_queue import JobQueue
 
 
 """
@@ -8,6 +9,13 @@ Also we could avoid memory leak when switching models by clearing the cache.
 """
 
 
+# The queue of the jobs of the API, it outlives the pipelines.
+_job_queue = None
+# Batches the txt2img API requests with --api_batch_size, it has its own
+# pipeline and runs each batch as a job of the job queue.
+_batch_scheduler = None
+
+
 def _init():
     global _sd_obj
     global _config_obj
@@ -20,6 +28,16 @@ def _init():
 def set_sd_obj(value):
     global _sd_obj
     _sd_obj = value
+    if _sd_obj is not None:
+        _sd_obj.step_callback = _report_progress
+
+
+def _report_progress(step, total_steps):
+    # Progress of the job running the pipeline, when run by the job queue.
+    # Raises JobCancelled to stop a cancelled job at this step.
+    job = _job_queue.current_job() if _job_queue is not None else None
+    if job is not None:
+        job.report_progress(step, total_steps)
 
 
 def set_sd_scheduler(key):
@@ -57,6 +75,58 @@ def get_cfg_obj():
     return _config_obj
 
 
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        # One worker, the pipeline is shared by all the jobs.
+        _job_queue = JobQueue(num_workers=1)
+    return _job_queue
+
+
+def _load_batch_pipeline(model_id, height, width, batch_size):
+    from apps.stable_diffusion.src.pipelines.pipeline_shark_stable_diffusion_batch import (
+        load_text2img_pipeline,
+    )
+
+    pipe, schedulers = load_text2img_pipeline(
+        model_id, height, width, batch_size
+    )
+    pipe.step_callback = _report_progress
+    return pipe, schedulers
+
+
+def _run_batch_as_job(fn, batch):
+    # The batches share the job worker with the other jobs, as the job of
+    # their oldest request.
+    job = get_job_queue().submit(
+        fn,
+        user=batch[0].user,
+        priority=max(request.priority for request in batch),
+    )
+    return job.wait()
+
+
+def get_batch_scheduler(batch_size, max_wait_ms):
+    global _batch_scheduler
+    if _batch_scheduler is None:
+        from apps.stable_diffusion.src import Text2ImageBatchScheduler
+
+        _batch_scheduler = Text2ImageBatchScheduler(
+            batch_size,
+            max_wait_ms,
+            load_pipeline=_load_batch_pipeline,
+            run_batch=_run_batch_as_job,
+        )
+    return _batch_scheduler
+
+
+def get_batch_scheduler_metrics():
+    global _batch_scheduler
+    if _batch_scheduler is None:
+        return None
+    return _batch_scheduler.metrics()
+
+
 def get_scheduler(key):
     global _schedulers
     return _schedulers[key]
@@ -0,0 +1,333 @@
+import collections
+import contextvars
+import itertools
+import threading
+import time
+import types
+import uuid
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINAL_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+# The job run by a worker. A context variable rather than a thread local so
+# it is also seen by the threads a job runs in its context, e.g. the thread
+# of generate_with_previews.
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobCancelled(Exception):
+    """Raised at a step boundary of a job that was asked to stop."""
+
+
+class Job:
+    """
+    A generation queued in a JobQueue.
+
+    ...
+
+    Attributes
+    ----------
+    id : str
+        unique id of the job.
+    user : str
+        who submitted it, the unit of fairness of the queue.
+    priority : int
+        jobs of higher priority run first.
+    state : str
+        one of queued, running, done, failed and cancelled.
+    step, total_steps : int
+        denoising progress of the running job.
+    result :
+        what `fn` returned, or the last value it yielded if it is a
+        generator.
+    error : Exception
+        what `fn` raised, if it failed.
+
+    Methods
+    -------
+    report_progress(step, total_steps):
+        Called by the job at each step. Raises JobCancelled once the job is
+        cancelled, which stops it at that step.
+    wait(timeout=None):
+        Blocks until the job is finished and returns its result. Raises
+        what the job raised, or JobCancelled.
+    events(since=0, timeout=None):
+        Yields the state and progress events of the job until it finishes.
+    """
+
+    def __init__(self, fn, user, priority, seq):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.state = JOB_QUEUED
+        self.step = 0
+        self.total_steps = 0
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self._events = []
+        self._cond = threading.Condition()
+        self._add_event({"type": "state", "state": JOB_QUEUED})
+
+    def _add_event(self, event):
+        with self._cond:
+            event["time"] = time.time()
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def _set_state(self, state):
+        self.state = state
+        self._add_event({"type": "state", "state": state})
+
+    def report_progress(self, step, total_steps):
+        self.step = step
+        self.total_steps = total_steps
+        self._add_event(
+            {"type": "progress", "step": step, "total_steps": total_steps}
+        )
+        if self.cancel_requested:
+            raise JobCancelled(f"Job {self.id} cancelled at step {step}.")
+
+    def wait(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self.state in FINAL_STATES, timeout
+            ):
+                raise TimeoutError(f"Job {self.id} is still {self.state}.")
+        if self.error is not None:
+            raise self.error
+        if self.state == JOB_CANCELLED:
+            raise JobCancelled(f"Job {self.id} was cancelled.")
+        return self.result
+
+    def events(self, since=0, timeout=None):
+        index = since
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(
+                    lambda: len(self._events) > index, timeout
+                ):
+                    return
+                events = self._events[index:]
+            index += len(events)
+            for event in events:
+                yield event
+                if event.get("state") in FINAL_STATES:
+                    return
+
+    def info(self):
+        return {
+            "id": self.id,
+            "user": self.user,
+            "priority": self.priority,
+            "state": self.state,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "queue_wait_ms": _elapsed_ms(self.submit_time, self.start_time),
+            "run_time_ms": _elapsed_ms(self.start_time, self.end_time),
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+def _elapsed_ms(start, end):
+    if start is None:
+        return None
+    return ((end or time.time()) - start) * 1000
+
+
+class JobQueue:
+    """
+    Prioritized queue of generation jobs run by a pool of worker threads.
+
+    ...
+
+    Waiting jobs are started by decreasing priority. Among jobs of the same
+    priority, the user who had the fewest jobs started so far goes first,
+    so a user queuing many jobs can't starve the others, then the oldest
+    job. A queued job is cancelled right away; a running one at its next
+    step boundary (see Job.report_progress).
+
+    Attributes
+    ----------
+    num_workers : int
+        jobs run concurrently. The SD pipelines are process wide, so the
+        web app uses one worker per process.
+    max_finished_jobs : int
+        finished jobs kept for `get` and `jobs`.
+
+    Methods
+    -------
+    submit(fn, user="", priority=0):
+        Queues `fn()` and returns its Job.
+    get(job_id):
+        Returns the Job of an id, or None.
+    cancel(job_id):
+        Cancels a job; returns False if it is unknown or finished.
+    current_job():
+        Returns the job run in the calling context, or None.
+    jobs():
+        Returns the info of the queued, running and recent jobs.
+    metrics():
+        Returns job counts and queue wait / run time averages.
+    close():
+        Lets the workers finish the queued jobs and stops them.
+    """
+
+    def __init__(self, num_workers=1, max_finished_jobs=256):
+        self.num_workers = num_workers
+        self.max_finished_jobs = max_finished_jobs
+        self._waiting = []
+        self._jobs = {}
+        self._finished = collections.deque()
+        self._served = collections.Counter()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            "submitted": 0,
+            JOB_DONE: 0,
+            JOB_FAILED: 0,
+            JOB_CANCELLED: 0,
+            "queue_wait_ms_sum": 0.0,
+            "run_time_ms_sum": 0.0,
+            "started": 0,
+            "ran": 0,
+        }
+        self._workers = [
+            threading.Thread(
+                target=self._work, name=f"sd-job-worker-{i}", daemon=True
+            )
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fn, user="", priority=0):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("JobQueue is closed.")
+            job = Job(fn, user, priority, next(self._seq))
+            self._jobs[job.id] = job
+            self._waiting.append(job)
+            self._metrics["submitted"] += 1
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINAL_STATES:
+                return False
+            job.cancel_requested = True
+            if job.state != JOB_QUEUED:
+                return True
+            self._waiting.remove(job)
+        self._finish(job, JOB_CANCELLED)
+        return True
+
+    def current_job(self):
+        return _current_job.get()
+
+    def _next_job(self):
+        return min(
+            self._waiting,
+            key=lambda job: (-job.priority, self._served[job.user], job.seq),
+        )
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                job = self._next_job()
+                self._waiting.remove(job)
+                self._served[job.user] += 1
+                job.start_time = time.time()
+                self._metrics["started"] += 1
+                self._metrics["queue_wait_ms_sum"] += (
+                    job.start_time - job.submit_time
+                ) * 1000
+                job._set_state(JOB_RUNNING)
+
+            token = _current_job.set(job)
+            try:
+                result = job.fn()
+                if isinstance(result, types.GeneratorType):
+                    # Gradio style generators yield partial results, the
+                    # last one is the result of the job.
+                    for partial in result:
+                        job.result = partial
+                else:
+                    job.result = result
+            except JobCancelled:
+                self._finish(job, JOB_CANCELLED)
+            except Exception as e:
+                job.error = e
+                self._finish(job, JOB_FAILED)
+            else:
+                self._finish(job, JOB_DONE)
+            finally:
+                _current_job.reset(token)
+
+    def _finish(self, job, state):
+        job.end_time = time.time()
+        with self._cond:
+            self._metrics[state] += 1
+            if job.start_time is not None:
+                self._metrics["ran"] += 1
+                self._metrics["run_time_ms_sum"] += (
+                    job.end_time - job.start_time
+                ) * 1000
+            self._finished.append(job)
+            while len(self._finished) > self.max_finished_jobs:
+                self._jobs.pop(self._finished.popleft().id, None)
+        job._set_state(state)
+
+    def jobs(self):
+        with self._cond:
+            jobs = list(self._jobs.values())
+        return [job.info() for job in jobs]
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["waiting"] = len(self._waiting)
+            metrics["running"] = sum(
+                job.state == JOB_RUNNING for job in self._jobs.values()
+            )
+            metrics["waiting_per_user"] = dict(
+                collections.Counter(job.user for job in self._waiting)
+            )
+        started = metrics["started"]
+        metrics["mean_queue_wait_ms"] = (
+            metrics["queue_wait_ms_sum"] / started if started else 0.0
+        )
+        ran = metrics.pop("ran")
+        metrics["mean_run_time_ms"] = (
+            metrics["run_time_ms_sum"] / ran if ran else 0.0
+        )
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
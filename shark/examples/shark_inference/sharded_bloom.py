@@ -35,7 +35,14 @@ import subprocess
 from torch.fx.experimental.proxy_tensor import make_fx
 from torch._decomp import get_decompositions
 from shark.shark_inference import SharkInference
+from shark.shark_sharding import (
+    ShardedPipeline,
+    load_sharded_modules,
+    plan_placement,
+)
+from shark.iree_utils.layer_compile import LayerCompiler, save_compiled_layer
 from shark.shark_downloader import download_public_file
+from shark.shark_sampler import SharkSampler
 from transformers import (
     BloomTokenizerFast,
     BloomForSequenceClassification,
@@ -49,8 +56,26 @@ from transformers.models.bloom.modeling_bloom import (
 IS_CUDA = False
 
 
+def _set_cuda_device(module):
+    cudaSetDevice(module.device_idx)
+
+
+LAYER_COMPILE_ARGS = [
+    "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
+    "--iree-stream-resource-max-allocation-size=1000000000",
+    "--iree-codegen-check-ir-before-llvm-conversion=false",
+]
+
+
 class ShardedBloom:
-    def __init__(self, src_folder):
+    def __init__(
+        self,
+        src_folder,
+        temperature=0.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
+    ):
         f = open(f"{src_folder}/config.json")
         config = json.load(f)
         f.close()
@@ -68,6 +93,12 @@ class ShardedBloom:
             self.n_head = config["num_attention_heads"]
         except KeyError:
             self.n_head = config["n_head"]
+        self.sampling_args = {
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p,
+            "repetition_penalty": repetition_penalty,
+        }
 
     def _init_layer(self, layer_name, device, replace, device_idx):
         if replace or not os.path.exists(
@@ -85,11 +116,7 @@ class ShardedBloom:
             )
             shark_module.save_module(
                 module_name=f"{self.src_folder}/{layer_name}",
-                extra_args=[
-                    "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
-                    "--iree-stream-resource-max-allocation-size=1000000000",
-                    "--iree-codegen-check-ir-before-llvm-conversion=false",
-                ],
+                extra_args=LAYER_COMPILE_ARGS,
             )
         else:
             shark_module = SharkInference(
@@ -101,6 +128,27 @@ class ShardedBloom:
 
         return shark_module
 
+    def _compile_blocks(self, device, replace):
+        # The blocks only differ in their weights, which are lifted out of
+        # the mlir, so one compile serves all of them.
+        compiler = LayerCompiler(
+            device, "tm_tensor", extra_args=LAYER_COMPILE_ARGS
+        )
+        for i in range(self.n_layer):
+            layer_name = f"bloom_block_{i}"
+            if not replace and os.path.exists(
+                f"{self.src_folder}/{layer_name}.vmfb"
+            ):
+                continue
+            with open(
+                f"{self.src_folder}/{layer_name}.mlir", encoding="utf-8"
+            ) as f_:
+                compiler.add(layer_name, f_.read())
+        for layer_name, compiled_layer in compiler.compile().items():
+            save_compiled_layer(
+                f"{self.src_folder}/{layer_name}.vmfb", compiled_layer
+            )
+
     def init_layers(self, device, replace=False, device_idx=[0]):
         if device_idx is not None:
             n_devices = len(device_idx)
@@ -129,17 +177,23 @@ class ShardedBloom:
             replace,
             device_idx if device_idx is None else device_idx[3 % n_devices],
         )
-        self.block_modules = [
-            self._init_layer(
-                f"bloom_block_{i}",
-                device,
-                replace,
-                device_idx
-                if device_idx is None
-                else device_idx[(i + 4) % n_devices],
-            )
-            for i in range(self.n_layer)
-        ]
+        # Samples on the device of the lm_head, next to the logits.
+        self.sampler = SharkSampler(
+            self.vocab_size,
+            device=device,
+            device_idx=self.lm_head_module.device_idx,
+            **self.sampling_args,
+        )
+        # Consecutive blocks share a device, so the hidden states only
+        # leave a device at the boundaries of the shards.
+        block_placement = (
+            [None] * self.n_layer
+            if device_idx is None
+            else plan_placement([1.0] * self.n_layer, device_idx)
+        )
+        self._compile_blocks(device, replace)
+        self.block_placement = block_placement
+        self.device = device
 
         self.layers_initialized = True
 
@@ -152,8 +206,18 @@ class ShardedBloom:
         self.word_embeddings_layernorm_module.load_module(
             f"{self.src_folder}/word_embeddings_layernorm.vmfb"
         )
-        for block_module, i in zip(self.block_modules, range(self.n_layer)):
-            block_module.load_module(f"{self.src_folder}/bloom_block_{i}.vmfb")
+        self.block_modules = load_sharded_modules(
+            [
+                f"{self.src_folder}/bloom_block_{i}.vmfb"
+                for i in range(self.n_layer)
+            ],
+            self.device,
+            self.block_placement,
+        )
+        self.blocks = ShardedPipeline(
+            self.block_modules,
+            before_layer=_set_cuda_device if IS_CUDA else None,
+        )
         self.ln_f_module.load_module(f"{self.src_folder}/ln_f.vmfb")
         self.lm_head_module.load_module(f"{self.src_folder}/lm_head.vmfb")
 
@@ -189,31 +253,16 @@ class ShardedBloom:
         )
         causal_mask = torch.tensor(causal_mask).float()
 
-        presents = ()
-        all_hidden_states = tuple(hidden_states)
-
-        for block_module, i in zip(self.block_modules, range(self.n_layer)):
-            if IS_CUDA:
-                cudaSetDevice(block_module.device_idx)
-
-            output = block_module(
-                inputs=(
-                    hidden_states.detach().numpy(),
-                    alibi.detach().numpy(),
-                    causal_mask.detach().numpy(),
-                ),
-                function_name="forward",
-            )
-            hidden_states = torch.tensor(output[0]).float()
-            all_hidden_states = all_hidden_states + (hidden_states,)
-            presents = presents + (
-                tuple(
-                    (
-                        output[1],
-                        output[2],
-                    )
-                ),
-            )
+        # The hidden states stay on the device between blocks of a shard.
+        hidden_states, block_outputs = self.blocks(
+            hidden_states.detach().numpy(),
+            side_inputs=(
+                alibi.detach().numpy(),
+                causal_mask.detach().numpy(),
+            ),
+        )
+        hidden_states = torch.tensor(hidden_states).float()
+        presents = tuple(tuple(outputs) for outputs in block_outputs)
         if IS_CUDA:
             cudaSetDevice(self.ln_f_module.device_idx)
 
@@ -224,11 +273,12 @@ class ShardedBloom:
             cudaSetDevice(self.lm_head_module.device_idx)
 
         logits = self.lm_head_module(
-            inputs=(hidden_states,), function_name="forward"
+            inputs=(hidden_states,),
+            function_name="forward",
+            send_to_host=False,
         )
-        logits = torch.tensor(logits).float()
 
-        return torch.argmax(logits[:, -1, :], dim=-1)
+        return torch.tensor([self.sampler(logits)])
 
 
 def _make_causal_mask(
@@ -714,6 +764,10 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--token_count", default=10, type=int)
     parser.add_argument("-m", "--model_name", default="bloom-560m")
     parser.add_argument("-cm", "--create_mlirs", default=False, type=bool)
+    parser.add_argument("--temperature", default=0.0, type=float)
+    parser.add_argument("--top_k", default=0, type=int)
+    parser.add_argument("--top_p", default=1.0, type=float)
+    parser.add_argument("--repetition_penalty", default=1.0, type=float)
 
     parser.add_argument(
         "-lm", "--large_model_memory_efficient", default=False, type=bool
@@ -797,7 +851,13 @@ if __name__ == "__main__":
                 )
 
     else:
-        shardedbloom = ShardedBloom(args.model_path)
+        shardedbloom = ShardedBloom(
+            args.model_path,
+            temperature=args.temperature,
+            top_k=args.top_k,
+            top_p=args.top_p,
+            repetition_penalty=args.repetition_penalty,
+        )
         shardedbloom.init_layers(
             device=args.device,
             replace=args.recompile,
@@ -806,6 +866,7 @@ if __name__ == "__main__":
         shardedbloom.load_layers()
 
         if args.prompt is not None:
+            shardedbloom.sampler.reset(input_ids)
             for _ in range(args.token_count):
                 next_token = shardedbloom.forward_pass(
                     torch.tensor(input_ids), device=args.device
@@ -830,6 +891,7 @@ if __name__ == "__main__":
                     token_count = 10
 
                 input_ids = tokenizer.encode(prompt, return_tensors="pt")
+                shardedbloom.sampler.reset(input_ids)
 
                 for _ in range(token_count):
                     next_token = shardedbloom.forward_pass(
@@ -0,0 +1,216 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Content-addressed on-disk cache of compiled .vmfb flatbuffers.
+
+import hashlib
+import os
+import platform
+import tempfile
+import threading
+
+
+def get_iree_compiler_version():
+    """Returns the installed iree-compiler version string."""
+    try:
+        from importlib.metadata import version
+
+        return version("iree-compiler")
+    except Exception:
+        pass
+    try:
+        from iree.compiler import version
+
+        return str(version.VERSION)
+    except Exception:
+        return "unknown"
+
+
+def module_to_bytes(module):
+    if isinstance(module, bytes):
+        return module
+    if isinstance(module, str):
+        return module.encode("utf-8")
+    if hasattr(module, "operation"):
+        # torch-mlir / MLIR python module object.
+        return module.operation.get_asm().encode("utf-8")
+    return str(module).encode("utf-8")
+
+
+def get_compile_cache_key(module, target_backend, compile_args, input_type=""):
+    """
+    Hashes everything that determines the bytes produced by iree-compile:
+    the MLIR module, the fully resolved flag list, the target backend and
+    host (for `host` cpu features), the input type and the compiler version.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(module_to_bytes(module))
+    for item in [
+        str(target_backend),
+        str(input_type),
+        get_iree_compiler_version(),
+        platform.system(),
+        platform.machine(),
+        platform.processor(),
+    ] + [str(arg) for arg in compile_args]:
+        hasher.update(b"\0")
+        hasher.update(item.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class VmfbCache:
+    """
+    On-disk cache of compiled flatbuffers keyed on `get_compile_cache_key`.
+
+    ...
+
+    Attributes
+    ----------
+    cache_dir : str
+        directory holding the cached <key>.vmfb files. It can be shared by
+        several processes; entries are written atomically.
+    max_size_bytes : int
+        size cap of the cache. Least recently used entries are evicted
+        once the cap is exceeded. None or 0 disables eviction.
+    stats : dict
+        hits, misses, writes and evictions seen by this process.
+
+    Methods
+    -------
+    get(key):
+        Returns the cached flatbuffer for `key` or None.
+    put(key, flatbuffer_blob):
+        Atomically stores the flatbuffer and evicts old entries.
+    """
+
+    suffix = ".vmfb"
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = None):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                flatbuffer_blob = f.read()
+        except OSError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        try:
+            # Bump the mtime so eviction sees this entry as recently used.
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.stats["hits"] += 1
+        return flatbuffer_blob
+
+    def put(self, key, flatbuffer_blob):
+        path = self.path_for(key)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix=f".{key}.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(flatbuffer_blob)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self.stats["writes"] += 1
+        self.evict()
+        return path
+
+    def entries(self):
+        """Returns (mtime, size, path) of the cached entries, oldest first."""
+        entries = []
+        for f_ in os.listdir(self.cache_dir):
+            if not f_.endswith(self.suffix) or f_.startswith("."):
+                continue
+            path = os.path.join(self.cache_dir, f_)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Evicted by another process in the meantime.
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        if not self.max_size_bytes:
+            return 0
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        # Keep the most recent entry even if it alone exceeds the cap.
+        for _, size, path in entries[:-1]:
+            if total <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.stats["evictions"] += evicted
+        return evicted
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+
+_vmfb_cache = None
+
+
+def get_vmfb_cache():
+    """Returns the process wide cache configured through shark_args, if any."""
+    global _vmfb_cache
+    from shark.parser import shark_args
+
+    cache_dir = shark_args.vmfb_cache_dir
+    if not cache_dir:
+        return None
+    max_size_bytes = int(shark_args.vmfb_cache_max_size_gb * (1 << 30))
+    if (
+        _vmfb_cache is None
+        or _vmfb_cache.cache_dir != os.path.expanduser(cache_dir)
+        or _vmfb_cache.max_size_bytes != max_size_bytes
+    ):
+        _vmfb_cache = VmfbCache(cache_dir, max_size_bytes)
+    return _vmfb_cache
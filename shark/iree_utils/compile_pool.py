@@ -0,0 +1,169 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Concurrent compilation of several mlir modules in worker processes.
+
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing
+import threading
+import time
+
+from shark.iree_utils._common import iree_target_map
+from shark.iree_utils.compile_cache import (
+    get_compile_cache_key,
+    module_to_bytes,
+)
+from shark.iree_utils.compile_utils import (
+    compile_flatbuffer,
+    get_iree_compile_args,
+    get_vmfb_cache_for,
+)
+
+
+def _compile_in_worker(module, target_backend, args, input_type):
+    # Runs in a worker process; the flags are resolved by the parent so the
+    # worker never has to query devices or read shark_args.
+    return compile_flatbuffer(module, target_backend, args, input_type)
+
+
+class CompilePool:
+    """
+    Compiles several mlir modules concurrently in a pool of worker processes.
+
+    ...
+
+    Attributes
+    ----------
+    num_workers : int
+        maximum number of iree-compile invocations running at once.
+    memory_budget_gb : float
+        approximate host memory the in flight compiles may use. A compile is
+        estimated to need `memory_per_module_byte` times the size of its mlir.
+        At least one compile is always allowed to run. None disables the
+        budget.
+
+    Methods
+    -------
+    submit(name, module, device, frontend, extra_args):
+        Resolves the compile flags in the calling process and queues the
+        compile. Returns a future yielding the flatbuffer.
+    shutdown(cancel=False):
+        Waits for the running compiles and stops the workers. Also called
+        when leaving a `with` block, cancelling the queued compiles if the
+        block raised.
+    wait():
+        Blocks until all the submitted modules are compiled and returns a
+        dict of name -> flatbuffer.
+    """
+
+    memory_per_module_byte = 4
+
+    def __init__(self, num_workers: int = None, memory_budget_gb=None):
+        if num_workers is None or num_workers < 1:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.memory_budget_gb = memory_budget_gb
+        self._budget_bytes = (
+            None if not memory_budget_gb else memory_budget_gb * (1 << 30)
+        )
+        self._in_flight_bytes = 0
+        self._cond = threading.Condition()
+        self._futures = {}
+        self._start_times = {}
+        # Spawn the workers: forked processes break CUDA and the IREE driver
+        # cache initialized in the parent.
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only waits for the compiles to finish: callers read the results
+        # of the futures, so one failed compile doesn't hide the others.
+        self.shutdown(cancel=exc_type is not None)
+
+    def _log(self, name, message):
+        done = sum(1 for f in self._futures.values() if f.done())
+        print(f"[compile {done}/{len(self._futures)}] {name}: {message}")
+
+    def _reserve(self, estimate):
+        with self._cond:
+            if self._budget_bytes is not None:
+                self._cond.wait_for(
+                    lambda: self._in_flight_bytes == 0
+                    or self._in_flight_bytes + estimate <= self._budget_bytes
+                )
+            self._in_flight_bytes += estimate
+
+    def _release(self, estimate):
+        with self._cond:
+            self._in_flight_bytes -= estimate
+            self._cond.notify_all()
+
+    def submit(self, name, module, device, frontend="linalg", extra_args=[]):
+        if name in self._futures:
+            raise ValueError(f"Module {name} already submitted.")
+        # Modules are pickled to the workers, so send serialized mlir.
+        module = module_to_bytes(module)
+        args, input_type = get_iree_compile_args(device, frontend, extra_args)
+        target_backend = iree_target_map(device)
+
+        vmfb_cache = get_vmfb_cache_for(args)
+        if vmfb_cache is not None:
+            cache_key = get_compile_cache_key(
+                module, target_backend, args, input_type
+            )
+            flatbuffer_blob = vmfb_cache.get(cache_key)
+            if flatbuffer_blob is not None:
+                future = Future()
+                future.set_result(flatbuffer_blob)
+                self._futures[name] = future
+                self._log(name, "loaded from vmfb cache")
+                return future
+
+        estimate = len(module) * self.memory_per_module_byte
+        self._reserve(estimate)
+        self._start_times[name] = time.time()
+        future = self._executor.submit(
+            _compile_in_worker, module, target_backend, args, input_type
+        )
+        self._futures[name] = future
+        self._log(name, "compiling")
+
+        def _on_done(f):
+            self._release(estimate)
+            if f.cancelled():
+                self._log(name, "cancelled")
+                return
+            if f.exception() is not None:
+                self._log(name, f"failed: {f.exception()}")
+                return
+            if vmfb_cache is not None:
+                vmfb_cache.put(cache_key, f.result())
+            elapsed = time.time() - self._start_times[name]
+            self._log(name, f"compiled in {elapsed:.1f}s")
+
+        future.add_done_callback(_on_done)
+        return future
+
+    def wait(self):
+        return {
+            name: future.result() for name, future in self._futures.items()
+        }
+
+    def shutdown(self, cancel=False):
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
@@ -14,6 +14,14 @@
 import iree.runtime as ireert
 import iree.compiler as ireec
 from shark.iree_utils._common import iree_device_map, iree_target_map
+from shark.iree_utils.compile_cache import (
+    get_compile_cache_key,
+    get_vmfb_cache,
+)
+from shark.iree_utils.device_tensor import (
+    SharkDeviceTensor,
+    get_function_input_dtypes,
+)
 from shark.iree_utils.benchmark_utils import *
 from shark.parser import shark_args
 import numpy as np
@@ -248,14 +256,8 @@ def compile_benchmark_dirs(bench_dir, device, dispatch_benchmarks):
     f_.close()
 
 
-def compile_module_to_flatbuffer(
-    module,
-    device,
-    frontend,
-    model_config_path,
-    extra_args,
-    model_name="None",
-):
+def get_iree_compile_args(device, frontend, extra_args):
+    """Returns the fully resolved iree-compile flags and the input type."""
     # Setup Compile arguments wrt to frontends.
     input_type = ""
     args = get_iree_frontend_args(frontend)
@@ -272,32 +274,78 @@ def compile_module_to_flatbuffer(
         input_type = "tosa"
     elif frontend in ["tm_tensor"]:
         input_type = ireec.InputType.TM_TENSOR
+    return args, input_type
+
+
+def get_vmfb_cache_for(args):
+    # Flags dumping compiler artifacts need a real compile, so they bypass
+    # the cache.
+    if any("--iree-hal-dump-executable" in arg for arg in args):
+        return None
+    if "IREE_SAVE_TEMPS" in os.environ:
+        return None
+    return get_vmfb_cache()
+
 
+def compile_flatbuffer(module, target_backend, args, input_type=""):
+    """Runs iree-compile on an already resolved flag list."""
     # TODO: make it simpler.
     # Compile according to the input type, else just try compiling.
     if input_type != "":
         # Currently for MHLO/TOSA.
-        flatbuffer_blob = ireec.compile_str(
+        return ireec.compile_str(
             module,
-            target_backends=[iree_target_map(device)],
+            target_backends=[target_backend],
             extra_args=args,
             input_type=input_type,
         )
-    else:
-        # Currently for Torch.
-        flatbuffer_blob = ireec.compile_str(
-            module,
-            target_backends=[iree_target_map(device)],
-            extra_args=args,
+    # Currently for Torch.
+    return ireec.compile_str(
+        module,
+        target_backends=[target_backend],
+        extra_args=args,
+    )
+
+
+def compile_module_to_flatbuffer(
+    module,
+    device,
+    frontend,
+    model_config_path,
+    extra_args,
+    model_name="None",
+):
+    args, input_type = get_iree_compile_args(device, frontend, extra_args)
+    target_backend = iree_target_map(device)
+
+    # Reuse a previously compiled flatbuffer if the module and the fully
+    # resolved flags match.
+    vmfb_cache = get_vmfb_cache_for(args)
+    if vmfb_cache is not None:
+        cache_key = get_compile_cache_key(
+            module, target_backend, args, input_type
         )
+        flatbuffer_blob = vmfb_cache.get(cache_key)
+        if flatbuffer_blob is not None:
+            print(f"Loaded vmfb from cache: {vmfb_cache.path_for(cache_key)}")
+            return flatbuffer_blob
 
+    flatbuffer_blob = compile_flatbuffer(
+        module, target_backend, args, input_type
+    )
+
+    if vmfb_cache is not None:
+        vmfb_cache.put(cache_key, flatbuffer_blob)
     return flatbuffer_blob
 
 
-def get_iree_module(flatbuffer_blob, device, device_idx=None):
-    # Returns the compiled module and the configs.
-    if device_idx is not None:
-        device = iree_device_map(device)
+def _get_iree_module_config(device, device_idx=None):
+    if device_idx is None:
+        return get_iree_runtime_config(device)
+    device = iree_device_map(device)
+    config_key = (device, device_idx, tuple(shark_args.device_allocator))
+    config = _iree_runtime_configs.get(config_key)
+    if config is None:
         print("registering device id: ", device_idx)
         haldriver = ireert.get_driver(device)
 
@@ -306,17 +354,26 @@ def get_iree_module(flatbuffer_blob, device, device_idx=None):
             allocators=shark_args.device_allocator,
         )
         config = ireert.Config(device=haldevice)
-    else:
-        config = get_iree_runtime_config(device)
-    vm_module = ireert.VmModule.from_flatbuffer(
-        config.vm_instance, flatbuffer_blob
-    )
+        _iree_runtime_configs[config_key] = config
+    return config
+
+
+def _load_vm_module(vm_module, config):
     ctx = ireert.SystemContext(config=config)
     ctx.add_vm_module(vm_module)
     ModuleCompiled = getattr(ctx.modules, vm_module.name)
     return ModuleCompiled, config
 
 
+def get_iree_module(flatbuffer_blob, device, device_idx=None):
+    # Returns the compiled module and the configs.
+    config = _get_iree_module_config(device, device_idx)
+    vm_module = ireert.VmModule.from_flatbuffer(
+        config.vm_instance, flatbuffer_blob
+    )
+    return _load_vm_module(vm_module, config)
+
+
 def get_iree_compiled_module(
     module,
     device: str,
@@ -332,11 +389,26 @@ def get_iree_compiled_module(
     return get_iree_module(flatbuffer_blob, device, device_idx=device_idx)
 
 
-def load_flatbuffer(flatbuffer_path: str, device: str, device_idx: int = None):
-    with open(os.path.join(flatbuffer_path), "rb") as f:
-        flatbuffer_blob = f.read()
-
-    return get_iree_module(flatbuffer_blob, device, device_idx=device_idx)
+def load_flatbuffer(
+    flatbuffer_path: str,
+    device: str,
+    device_idx: int = None,
+    mmap: bool = True,
+):
+    # Memory maps the .vmfb rather than reading it: the module is backed by
+    # the page cache instead of a heap copy, which matters for multi GB
+    # modules. The file must not be rewritten while the module is in use.
+    if not mmap or not hasattr(ireert.VmModule, "mmap"):
+        with open(os.path.join(flatbuffer_path), "rb") as f:
+            flatbuffer_blob = f.read()
+
+        return get_iree_module(flatbuffer_blob, device, device_idx=device_idx)
+
+    config = _get_iree_module_config(device, device_idx)
+    vm_module = ireert.VmModule.mmap(
+        config.vm_instance, os.fspath(flatbuffer_path)
+    )
+    return _load_vm_module(vm_module, config)
 
 
 def export_iree_module_to_vmfb(
@@ -387,7 +459,20 @@ def get_results(
     send_to_host=True,
 ):
     """Runs a .vmfb file given inputs and config and returns output."""
-    device_inputs = [ireert.asdevicearray(config.device, a) for a in input]
+    device_inputs = []
+    input_dtypes = None
+    for i, a in enumerate(input):
+        if isinstance(a, SharkDeviceTensor):
+            # Already on the device: validate instead of copying.
+            if input_dtypes is None:
+                input_dtypes = (
+                    get_function_input_dtypes(compiled_vm, function_name) or []
+                )
+            dtype = input_dtypes[i] if i < len(input_dtypes) else None
+            a.check(config.device, dtype)
+            device_inputs.append(a)
+        else:
+            device_inputs.append(ireert.asdevicearray(config.device, a))
     result = compiled_vm[function_name](*device_inputs)
     result_tensors = []
     if isinstance(result, tuple):
@@ -396,7 +481,7 @@ def get_results(
                 result_tensors.append(np.asarray(val, val.dtype))
         else:
             for val in result:
-                result_tensors.append(val)
+                result_tensors.append(_as_device_tensor(val))
         return result_tensors
     elif isinstance(result, dict):
         data = list(result.items())
@@ -407,15 +492,31 @@ def get_results(
     else:
         if send_to_host and result is not None:
             return result.to_host()
-        return result
+        return _as_device_tensor(result)
+
+
+def _as_device_tensor(val):
+    if isinstance(val, ireert.DeviceArray):
+        return SharkDeviceTensor.from_device_array(val)
+    return val
+
+
+# Runtime configs are shared by all the modules on the same device, so
+# their buffers can be handed from one module to the next without copies.
+_iree_runtime_configs = {}
 
 
 def get_iree_runtime_config(device):
     device = iree_device_map(device)
+    config_key = (device, None, tuple(shark_args.device_allocator))
+    config = _iree_runtime_configs.get(config_key)
+    if config is not None:
+        return config
     haldriver = ireert.get_driver(device)
     haldevice = haldriver.create_device_by_uri(
         device,
         allocators=shark_args.device_allocator,
     )
     config = ireert.Config(device=haldevice)
+    _iree_runtime_configs[config_key] = config
     return config
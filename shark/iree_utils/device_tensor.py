@@ -0,0 +1,108 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Device resident tensors handed between SharkInference modules.
+
+import json
+import iree.runtime as ireert
+import numpy as np
+
+# Element types of the iree.abi reflection metadata.
+_ABI_DTYPES = {
+    "f16": np.float16,
+    "f32": np.float32,
+    "f64": np.float64,
+    "i1": np.bool_,
+    "i8": np.int8,
+    "i16": np.int16,
+    "i32": np.int32,
+    "i64": np.int64,
+    "u8": np.uint8,
+}
+
+
+class SharkDeviceTensor(ireert.DeviceArray):
+    """
+    A buffer living on the device of a SharkInference module.
+
+    It is what `SharkInference.__call__(..., send_to_host=False)` returns and
+    can be passed back as an input to any module on the same device without
+    a host round trip. Being a DeviceArray, `to_host()` and `np.asarray()`
+    still work when the host copy is actually needed.
+
+    ...
+
+    Methods
+    -------
+    from_host(config, array):
+        Uploads a host array (numpy or torch) once to the device of `config`.
+    check(device, dtype=None):
+        Raises ValueError if the tensor lives on another device or has a
+        different element type than expected.
+    """
+
+    @classmethod
+    def from_device_array(cls, device_array):
+        if isinstance(device_array, cls):
+            return device_array
+        return cls(
+            device_array._device,
+            device_array._buffer_view,
+            implicit_host_transfer=device_array._implicit_host_transfer,
+            override_dtype=device_array._override_dtype,
+        )
+
+    @classmethod
+    def from_host(cls, config, array):
+        if hasattr(array, "detach"):
+            array = array.detach().cpu().numpy()
+        return cls.from_device_array(
+            ireert.asdevicearray(config.device, np.asarray(array))
+        )
+
+    @property
+    def hal_device(self):
+        return self._device
+
+    def check(self, device, dtype=None):
+        if self._device is not device:
+            raise ValueError(
+                "SharkDeviceTensor lives on a different device than the "
+                "module it is passed to. Copy it with to_host() first."
+            )
+        if dtype is not None and np.dtype(dtype) != self.dtype:
+            raise ValueError(
+                f"SharkDeviceTensor has dtype {self.dtype}, but the module "
+                f"expects {np.dtype(dtype)}."
+            )
+
+
+def get_function_input_dtypes(compiled_vm, function_name):
+    """
+    Returns the input dtypes of `function_name` from the iree.abi reflection
+    metadata, with None for non tensor or unknown inputs. Returns None if the
+    module carries no such metadata.
+    """
+    try:
+        reflection = compiled_vm[function_name].vm_function.reflection
+        abi = json.loads(reflection["iree.abi"])
+    except Exception:
+        return None
+    dtypes = []
+    for arg in abi.get("a", []):
+        if isinstance(arg, list) and len(arg) > 1 and arg[0] == "ndarray":
+            dtypes.append(_ABI_DTYPES.get(arg[1]))
+        else:
+            dtypes.append(None)
+    return dtypes
@@ -0,0 +1,289 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Compiles the structurally identical layers of a sharded model once.
+
+import collections
+import hashlib
+import os
+import re
+import time
+
+import numpy as np
+
+from shark.iree_utils.compile_cache import module_to_bytes
+
+# Element types of the constants that can be lifted to arguments.
+_MLIR_DTYPES = {
+    "f16": np.float16,
+    "f32": np.float32,
+    "f64": np.float64,
+    "i8": np.int8,
+    "i16": np.int16,
+    "i32": np.int32,
+    "i64": np.int64,
+    "ui8": np.uint8,
+}
+
+_CONSTANT_RE = re.compile(
+    r"^[ \t]*(%[\w.$-]+) = arith\.constant "
+    r'(?:dense<"0x([0-9A-Fa-f]+)">|dense_resource<([\w.$-]+)>) '
+    r": tensor<([^<>]*)>[ \t]*(?:loc\([^()]*\))?[ \t]*\n",
+    re.MULTILINE,
+)
+_RESOURCE_RE = re.compile(
+    r'^[ \t]*([\w.$-]+): "0x([0-9A-Fa-f]+)",?[ \t]*\n', re.MULTILINE
+)
+_FUNC_RE = re.compile(r"func\.func (?:public |private )?@([\w.$-]+)\(")
+_LOC_RE = re.compile(r"\s*loc\((?:[^()]|\([^()]*\))*\)|^#loc.*$", re.MULTILINE)
+
+CompiledLayer = collections.namedtuple(
+    "CompiledLayer", ["flatbuffer", "weights", "structure"]
+)
+
+
+def _parse_tensor_type(tensor_type):
+    *dims, element_type = tensor_type.split("x")
+    if element_type not in _MLIR_DTYPES or any(
+        not dim.isdigit() for dim in dims
+    ):
+        return None
+    return tuple(int(dim) for dim in dims), np.dtype(
+        _MLIR_DTYPES[element_type]
+    )
+
+
+def _find_function(mlir, function_name):
+    # Returns the offsets of the argument list and of the end of the body.
+    for match in _FUNC_RE.finditer(mlir):
+        if match.group(1) != function_name:
+            continue
+        depth = 1
+        i = match.end()
+        while depth:
+            depth += {"(": 1, ")": -1}.get(mlir[i], 0)
+            i += 1
+        args_end = i - 1
+        body_start = mlir.index("{", args_end)
+        depth = 1
+        i = body_start + 1
+        while depth:
+            depth += {"{": 1, "}": -1}.get(mlir[i], 0)
+            i += 1
+        return match.end(), args_end, i
+    return None
+
+
+def externalize_constants(module, function_name="forward", min_bytes=1024):
+    """
+    Lifts the large dense tensor constants (the weights) of `function_name`
+    into extra arguments, appended after its inputs. Returns the rewritten
+    mlir text and the values of the lifted constants, in argument order.
+
+    Layers that only differ in their weights then have the same mlir, so
+    it is compiled once and each layer passes its own weights. Constants
+    under `min_bytes`, splats and element types without a numpy equivalent
+    stay in the module.
+    """
+    mlir = module_to_bytes(module).decode("utf-8")
+    function = _find_function(mlir, function_name)
+    if function is None:
+        return mlir, []
+    args_start, args_end, body_end = function
+    resources = {
+        match.group(1): match
+        for match in _RESOURCE_RE.finditer(mlir)
+        if match.start() > body_end or match.end() < args_start
+    }
+
+    weights = []
+    new_args = []
+    removed = []
+    used_resources = []
+    for match in _CONSTANT_RE.finditer(mlir, args_end, body_end):
+        name, hex_data, resource, tensor_type = match.groups()
+        parsed = _parse_tensor_type(tensor_type)
+        if parsed is None:
+            continue
+        shape, dtype = parsed
+        if resource is not None:
+            if resource not in resources:
+                continue
+            # Resource blobs start with their 4 byte alignment.
+            hex_data = resources[resource].group(2)[8:]
+        data = bytes.fromhex(hex_data)
+        if len(data) < min_bytes or len(data) != dtype.itemsize * int(
+            np.prod(shape)
+        ):
+            continue
+        weights.append(np.frombuffer(data, dtype=dtype).reshape(shape))
+        new_args.append(f"{name}: tensor<{tensor_type}>")
+        removed.append(match.span())
+        if resource is not None:
+            used_resources.append(resources[resource].span())
+
+    if not weights:
+        return mlir, []
+    pieces = []
+    position = 0
+    spans = sorted(removed + used_resources + [(args_end, args_end)])
+    for start, end in spans:
+        pieces.append(mlir[position:start])
+        if start == args_end == end:
+            has_args = mlir[args_start:args_end].strip() != ""
+            pieces.append((", " if has_args else "") + ", ".join(new_args))
+        position = end
+    pieces.append(mlir[position:])
+    mlir = "".join(pieces)
+    # Drop the trailing comma left by removed resource entries.
+    mlir = re.sub(r'",(\s*\})', r'"\1', mlir)
+    return mlir, weights
+
+
+def structural_hash(module):
+    """Hashes a module ignoring its debug locations."""
+    mlir = module_to_bytes(module).decode("utf-8")
+    return hashlib.sha256(_LOC_RE.sub("", mlir).encode("utf-8")).hexdigest()
+
+
+class LayerCompiler:
+    """
+    Compiles the per-layer modules of a sharded model, once per distinct
+    structure.
+
+    ...
+
+    The weights of every layer added are lifted out of its mlir (see
+    externalize_constants) and the rest is hashed: layers differing only in
+    their weights share one compile. The first layer of each structure is
+    submitted to a CompilePool as soon as it is added, so the compiles run
+    in worker processes while the caller imports the next layers.
+
+    Attributes
+    ----------
+    device : str
+        device to compile for.
+    frontend : str
+        mlir dialect of the modules.
+    extra_args : list
+        extra iree-compile flags.
+
+    Methods
+    -------
+    add(name, module):
+        Adds the mlir of a layer.
+    compile():
+        Waits for the compiles and returns a dict of name -> CompiledLayer,
+        the flatbuffer shared by the layers of a structure and the weights
+        of the layer, to be passed after its inputs.
+    stats:
+        number of layers, of compiles, and the compile time.
+    """
+
+    def __init__(
+        self,
+        device,
+        frontend="linalg",
+        extra_args=[],
+        num_workers=None,
+        memory_budget_gb=None,
+        function_name="forward",
+        min_weight_bytes=1024,
+    ):
+        self.device = device
+        self.frontend = frontend
+        self.extra_args = extra_args
+        self.num_workers = num_workers
+        self.memory_budget_gb = memory_budget_gb
+        self.function_name = function_name
+        self.min_weight_bytes = min_weight_bytes
+        self._pool = None
+        self._layers = {}
+        self._futures = {}
+        self._start_time = None
+        self.stats = {"layers": 0, "compiles": 0, "compile_time_s": 0.0}
+
+    def add(self, name, module):
+        if name in self._layers:
+            raise ValueError(f"Layer {name} already added.")
+        mlir, weights = externalize_constants(
+            module, self.function_name, self.min_weight_bytes
+        )
+        structure = structural_hash(mlir)
+        self._layers[name] = (structure, weights)
+        self.stats["layers"] += 1
+        if structure not in self._futures:
+            if self._pool is None:
+                from shark.iree_utils.compile_pool import CompilePool
+
+                self._start_time = time.time()
+                self._pool = CompilePool(
+                    self.num_workers, self.memory_budget_gb
+                )
+            self._futures[structure] = self._pool.submit(
+                f"{name} ({structure[:8]})",
+                mlir,
+                self.device,
+                self.frontend,
+                self.extra_args,
+            )
+            self.stats["compiles"] += 1
+
+    def compile(self):
+        try:
+            flatbuffers = {
+                structure: future.result()
+                for structure, future in self._futures.items()
+            }
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        if self._start_time is not None:
+            self.stats["compile_time_s"] = time.time() - self._start_time
+        print(
+            f"Compiled {self.stats['layers']} layers with "
+            f"{self.stats['compiles']} compiles in "
+            f"{self.stats['compile_time_s']:.1f}s."
+        )
+        return {
+            name: CompiledLayer(flatbuffers[structure], weights, structure)
+            for name, (structure, weights) in self._layers.items()
+        }
+
+
+def get_weights_path(vmfb_path):
+    return f"{str(vmfb_path)[:-len('.vmfb')]}.weights.npz"
+
+
+def save_compiled_layer(vmfb_path, compiled_layer):
+    """
+    Writes the flatbuffer of a layer and, next to it, its weights, which
+    shark.shark_sharding.load_layer_module reads back.
+
+    Callers skip the layers whose .vmfb exists, so the weights are written
+    first and the .vmfb is renamed into place last: an interrupted save
+    never leaves a .vmfb without its weights.
+    """
+    vmfb_path = os.fspath(vmfb_path)
+    weights_path = get_weights_path(vmfb_path)
+    if compiled_layer.weights:
+        with open(weights_path + ".tmp", "wb") as f:
+            np.savez(f, *compiled_layer.weights)
+        os.replace(weights_path + ".tmp", weights_path)
+    elif os.path.exists(weights_path):
+        os.remove(weights_path)
+    with open(vmfb_path + ".tmp", "wb") as f:
+        f.write(compiled_layer.flatbuffer)
+    os.replace(vmfb_path + ".tmp", vmfb_path)
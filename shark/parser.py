@@ -76,6 +76,54 @@ parser.add_argument(
     default=None,
     help="Specify where to save downloaded shark_tank artifacts. If this is not set, the default is ~/.local/shark_tank/.",
 )
+parser.add_argument(
+    "--tank_download_workers",
+    type=int,
+    default=8,
+    help="Number of concurrent ranged requests used to download shark_tank artifacts.",
+)
+parser.add_argument(
+    "--tank_chunk_size_mb",
+    type=int,
+    default=32,
+    help="Size in MB of the ranged requests shark_tank artifacts are downloaded by. Interrupted downloads resume from the last complete chunk.",
+)
+parser.add_argument(
+    "--tank_endpoint",
+    default="https://storage.googleapis.com",
+    help="Root URL of the GCS JSON API shark_tank artifacts are downloaded from.",
+)
+parser.add_argument(
+    "--tank_manifest_ttl",
+    type=float,
+    default=3600,
+    help="Seconds the listing of hashes and sizes of a shark_tank prefix is cached for, in memory and in the local tank. Artifacts are checked for updates against it.",
+)
+parser.add_argument(
+    "--tank_offline",
+    default=False,
+    action="store_true",
+    help="Never contact shark_tank, only use the artifacts already present in the local tank.",
+)
+
+parser.add_argument(
+    "--vmfb_cache_dir",
+    default=None,
+    help="Directory of the persistent compilation cache. Compiled .vmfb files are stored there keyed on a hash of the mlir, the compile flags, the target and the iree-compiler version. Disabled if not set.",
+)
+parser.add_argument(
+    "--vmfb_cache_max_size_gb",
+    type=float,
+    default=20,
+    help="Size cap of the compilation cache in GB. Least recently used entries are evicted past it.",
+)
+
+parser.add_argument(
+    "--max_in_flight_invocations",
+    type=int,
+    default=4,
+    help="Maximum number of asynchronous invocations queued or running per device before invoke_async blocks.",
+)
 
 parser.add_argument(
     "--dispatch_benchmarks",
@@ -0,0 +1,267 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import Future
+import collections
+import threading
+import time
+import numpy as np
+
+
+class SharkBatcher:
+    """
+    Dynamic request batching in front of modules compiled for fixed batch
+    sizes.
+
+    ...
+
+    Independent requests for `function_name` are collected for at most
+    `max_latency_ms` after the first one arrives, concatenated along the
+    batch axis, padded up to the smallest compiled batch size that fits,
+    run once and the results scattered back to the callers. Scalar inputs
+    are passed to the whole batch as is, so only requests with equal
+    scalars are batched together.
+
+    Attributes
+    ----------
+    modules : dict
+        batch size -> compiled SharkInference (or any callable with the
+        SharkInference call signature) for that batch size.
+    function_name : str
+        function run on the modules.
+    max_latency_ms : float
+        how long the first request of a batch may wait for others.
+
+    Methods
+    -------
+    submit(inputs):
+        Queues one request and returns a Future of its outputs. Every input
+        must have the same leading (batch) dimension, usually 1.
+    __call__(inputs):
+        Blocking version of submit.
+    metrics():
+        Returns queue depth, batch fill and latency counters.
+    close():
+        Runs the pending requests and stops the scheduler thread.
+    """
+
+    def __init__(
+        self,
+        modules: dict,
+        function_name: str = "forward",
+        max_latency_ms: float = 5.0,
+    ):
+        if not modules:
+            raise ValueError("SharkBatcher needs at least one module.")
+        self.modules = dict(modules)
+        self.batch_sizes = sorted(self.modules)
+        self.function_name = function_name
+        self.max_latency_ms = max_latency_ms
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            "requests": 0,
+            "batches": 0,
+            "rows": 0,
+            "padded_rows": 0,
+            "queue_wait_ms_sum": 0.0,
+            "batches_per_size": {bs: 0 for bs in self.batch_sizes},
+        }
+        self._thread = threading.Thread(
+            target=self._schedule, name="shark-batcher", daemon=True
+        )
+        self._thread.start()
+
+    @classmethod
+    def from_tank(
+        cls,
+        model_name: str,
+        batch_sizes=(1, 2, 4, 8),
+        frontend: str = "torch",
+        device: str = "none",
+        mlir_dialect: str = "linalg",
+        max_latency_ms: float = 5.0,
+    ):
+        """Compiles the shark_tank artifacts of `model_name` per batch size."""
+        from shark.shark_downloader import download_model
+        from shark.shark_inference import SharkInference
+
+        modules = {}
+        function_name = None
+        for batch_size in batch_sizes:
+            mlir_model, function_name, _, _ = download_model(
+                model_name,
+                frontend=frontend,
+                import_args={"batch_size": batch_size},
+            )
+            shark_module = SharkInference(
+                mlir_model, device=device, mlir_dialect=mlir_dialect
+            )
+            shark_module.compile()
+            modules[batch_size] = shark_module
+        return cls(modules, function_name, max_latency_ms)
+
+    def submit(self, inputs: tuple):
+        inputs = tuple(np.asarray(x) for x in inputs)
+        rows = {x.shape[0] for x in inputs if x.ndim > 0}
+        if len(rows) != 1:
+            raise ValueError(
+                "All the inputs of a request need the same batch dimension."
+            )
+        rows = rows.pop()
+        if rows > self.batch_sizes[-1]:
+            raise ValueError(
+                f"Request batch {rows} is larger than the largest compiled "
+                f"batch size {self.batch_sizes[-1]}."
+            )
+        # Requests are only batched with the ones with the same scalars.
+        key = tuple(
+            (i, x.dtype.str, x.tobytes())
+            for i, x in enumerate(inputs)
+            if x.ndim == 0
+        )
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SharkBatcher is closed.")
+            self._queue.append((inputs, rows, future, time.time(), key))
+            self._metrics["requests"] += 1
+            self._cond.notify_all()
+        return future
+
+    def __call__(self, inputs: tuple):
+        return self.submit(inputs).result()
+
+    def _take_batch(self):
+        # Called with the lock held: wait for a request, then for the batch
+        # to fill up or for the first request's latency window to pass.
+        while not self._queue and not self._closed:
+            self._cond.wait()
+        if not self._queue:
+            return None
+        deadline = self._queue[0][3] + self.max_latency_ms / 1000
+        key = self._queue[0][4]
+        max_rows = self.batch_sizes[-1]
+        while not self._closed:
+            queued_rows = sum(
+                request[1] for request in self._queue if request[4] == key
+            )
+            remaining = deadline - time.time()
+            if queued_rows >= max_rows or remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        batch = []
+        total_rows = 0
+        remaining_requests = collections.deque()
+        for request in self._queue:
+            if request[4] == key and total_rows + request[1] <= max_rows:
+                batch.append(request)
+                total_rows += request[1]
+            else:
+                remaining_requests.append(request)
+        self._queue = remaining_requests
+        return batch
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if batch is None:
+                return
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        now = time.time()
+        rows = sum(request[1] for request in batch)
+        batch_size = next(bs for bs in self.batch_sizes if bs >= rows)
+        num_inputs = len(batch[0][0])
+        batched_inputs = []
+        for i in range(num_inputs):
+            parts = [request[0][i] for request in batch]
+            if parts[0].ndim == 0:
+                # Scalars are equal across the batch, see submit.
+                batched_inputs.append(parts[0])
+                continue
+            if batch_size > rows:
+                pad_shape = (batch_size - rows,) + parts[0].shape[1:]
+                parts.append(np.zeros(pad_shape, dtype=parts[0].dtype))
+            batched_inputs.append(np.concatenate(parts, axis=0))
+
+        with self._cond:
+            self._metrics["batches"] += 1
+            self._metrics["rows"] += rows
+            self._metrics["padded_rows"] += batch_size - rows
+            self._metrics["batches_per_size"][batch_size] += 1
+            self._metrics["queue_wait_ms_sum"] += sum(
+                (now - request[3]) * 1000 for request in batch
+            )
+
+        try:
+            outputs = self.modules[batch_size](
+                self.function_name, tuple(batched_inputs)
+            )
+        except Exception as e:
+            for request in batch:
+                request[2].set_exception(e)
+            return
+
+        try:
+            results = []
+            offset = 0
+            for request in batch:
+                results.append(
+                    self._slice_outputs(
+                        outputs, offset, request[1], batch_size
+                    )
+                )
+                offset += request[1]
+        except Exception as e:
+            for request in batch:
+                request[2].set_exception(e)
+            return
+        for request, result in zip(batch, results):
+            request[2].set_result(result)
+
+    def _slice_outputs(self, outputs, offset, rows, batch_size):
+        def _slice(output):
+            output = np.asarray(output)
+            if output.ndim > 0 and output.shape[0] == batch_size:
+                return output[offset : offset + rows]
+            return output
+
+        if isinstance(outputs, (list, tuple)):
+            return type(outputs)(_slice(output) for output in outputs)
+        return _slice(outputs)
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["batches_per_size"] = dict(metrics["batches_per_size"])
+            metrics["queue_depth"] = len(self._queue)
+        total_rows = metrics["rows"] + metrics["padded_rows"]
+        metrics["batch_fill"] = (
+            metrics["rows"] / total_rows if total_rows else 0.0
+        )
+        served = metrics["requests"] - metrics["queue_depth"]
+        metrics["mean_queue_wait_ms"] = (
+            metrics["queue_wait_ms_sum"] / served if served else 0.0
+        )
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
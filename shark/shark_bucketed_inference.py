@@ -0,0 +1,167 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import numpy as np
+
+
+class SharkBucketedInference:
+    """
+    Runs inputs of variable length on a ladder of statically shaped modules.
+
+    ...
+
+    Every call is routed to the smallest bucket that fits the inputs, which
+    are padded up to that bucket only. The module of a bucket is compiled on
+    first use, so compiles go through the vmfb cache when one is configured
+    and unused buckets cost nothing.
+
+    Attributes
+    ----------
+    module_factory : callable
+        bucket -> mlir module with the dynamic dims fixed to `bucket`. It
+        may also return an already loaded SharkInference, e.g. one read from
+        a saved vmfb.
+    buckets : list
+        sizes the dynamic dims may be padded to, e.g. [32, 64, 128, 256].
+    dynamic_dims : tuple
+        per input, the axis padded to the bucket or None for inputs that are
+        passed unchanged.
+    pad_values : tuple
+        per input, the value used for padding. Defaults to 0.
+    device : str
+        device to compile the modules for.
+    mlir_dialect : str
+        dialect of the modules returned by `module_factory`.
+
+    Methods
+    -------
+    __call__(function_name, inputs, send_to_host=True):
+        Pads the inputs to the smallest fitting bucket and runs them. The
+        outputs keep the padded shape, slicing them is left to the caller.
+    bucket_for(length):
+        Returns the smallest bucket >= length.
+    get_module(bucket):
+        Returns the compiled module of `bucket`, compiling it if needed.
+    """
+
+    def __init__(
+        self,
+        module_factory,
+        buckets,
+        dynamic_dims,
+        pad_values=None,
+        device: str = "none",
+        mlir_dialect: str = "linalg",
+        extra_args=[],
+    ):
+        if not buckets:
+            raise ValueError(
+                "SharkBucketedInference needs at least one bucket."
+            )
+        self.module_factory = module_factory
+        self.buckets = sorted(buckets)
+        self.dynamic_dims = tuple(dynamic_dims)
+        self.pad_values = (
+            tuple(pad_values)
+            if pad_values is not None
+            else (0,) * len(self.dynamic_dims)
+        )
+        self.device = device
+        self.mlir_dialect = mlir_dialect
+        self.extra_args = extra_args
+        self.modules = {}
+        self.calls_per_bucket = {bucket: 0 for bucket in self.buckets}
+        self._lock = threading.Lock()
+
+    @property
+    def max_length(self):
+        return self.buckets[-1]
+
+    def bucket_for(self, length):
+        for bucket in self.buckets:
+            if bucket >= length:
+                return bucket
+        raise ValueError(
+            f"Length {length} exceeds the largest bucket {self.max_length}."
+        )
+
+    def compile_bucket(self, bucket):
+        from shark.shark_inference import SharkInference
+
+        mlir_module = self.module_factory(bucket)
+        if isinstance(mlir_module, SharkInference):
+            return mlir_module
+        print(f"Compiling bucket {bucket}")
+        shark_module = SharkInference(
+            mlir_module,
+            device=self.device,
+            mlir_dialect=self.mlir_dialect,
+        )
+        shark_module.compile(extra_args=list(self.extra_args))
+        return shark_module
+
+    def get_module(self, bucket):
+        # One lock for all buckets: compiles are heavy enough that running
+        # two of them at once would not help.
+        with self._lock:
+            if bucket not in self.modules:
+                self.modules[bucket] = self.compile_bucket(bucket)
+            return self.modules[bucket]
+
+    def pad_inputs(self, inputs, bucket):
+        padded = []
+        for x, dim, pad_value in zip(
+            inputs, self.dynamic_dims, self.pad_values
+        ):
+            if dim is None:
+                padded.append(x)
+                continue
+            if hasattr(x, "detach"):
+                x = x.detach().cpu().numpy()
+            x = np.asarray(x)
+            pad_width = [(0, 0)] * x.ndim
+            pad_width[dim] = (0, bucket - x.shape[dim])
+            padded.append(
+                np.pad(
+                    x, pad_width, mode="constant", constant_values=pad_value
+                )
+            )
+        return tuple(padded)
+
+    def input_length(self, inputs):
+        lengths = {
+            np.shape(x)[dim]
+            for x, dim in zip(inputs, self.dynamic_dims)
+            if dim is not None
+        }
+        if len(lengths) != 1:
+            raise ValueError(
+                "All the dynamic dims of a call need the same length."
+            )
+        return lengths.pop()
+
+    def __call__(self, function_name: str, inputs: tuple, send_to_host=True):
+        if len(inputs) != len(self.dynamic_dims):
+            raise ValueError(
+                f"Expected {len(self.dynamic_dims)} inputs, got {len(inputs)}."
+            )
+        bucket = self.bucket_for(self.input_length(inputs))
+        shark_module = self.get_module(bucket)
+        self.calls_per_bucket[bucket] += 1
+        return shark_module(
+            function_name,
+            self.pad_inputs(inputs, bucket),
+            send_to_host=send_to_host,
+        )
@@ -14,11 +14,21 @@
 
 import numpy as np
 import os
-from tqdm.std import tqdm
+from collections.abc import Sequence
 import sys
 from pathlib import Path
 from shark.parser import shark_args
-from google.cloud import storage
+from shark.tank_downloader import TankDownloader, file_md5
+from shark.tank_manifest import get_tank_manifest
+import requests
+
+
+def get_tank_downloader():
+    return TankDownloader(
+        endpoint=shark_args.tank_endpoint,
+        num_workers=shark_args.tank_download_workers,
+        chunk_size=shark_args.tank_chunk_size_mb << 20,
+    )
 
 
 def download_public_file(
@@ -28,44 +38,49 @@ def download_public_file(
     # bucket_name = "gs://your-bucket-name/path/to/file"
     # destination_file_name = "local/path/to/file"
 
-    storage_client = storage.Client.create_anonymous_client()
-    bucket_name = full_gs_url.split("/")[2]
-    source_blob_name = None
-    dest_filename = None
-    desired_file = None
+    downloader = get_tank_downloader()
     if single_file:
-        desired_file = full_gs_url.split("/")[-1]
-        source_blob_name = "/".join(full_gs_url.split("/")[3:-1])
-        destination_folder_name, dest_filename = os.path.split(
-            destination_folder_name
-        )
+        try:
+            downloader.download_file(full_gs_url, destination_folder_name)
+        except FileNotFoundError as e:
+            print(e)
     else:
-        source_blob_name = "/".join(full_gs_url.split("/")[3:])
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=source_blob_name)
-    if not os.path.exists(destination_folder_name):
-        os.mkdir(destination_folder_name)
-    for blob in blobs:
-        blob_name = blob.name.split("/")[-1]
-        if single_file:
-            if blob_name == desired_file:
-                destination_filename = os.path.join(
-                    destination_folder_name, dest_filename
-                )
-                with open(destination_filename, "wb") as f:
-                    with tqdm.wrapattr(
-                        f, "write", total=blob.size
-                    ) as file_obj:
-                        storage_client.download_blob_to_file(blob, file_obj)
-            else:
-                continue
+        downloader.download_prefix(full_gs_url, destination_folder_name)
+
+
+class LazyNpzTuple(Sequence):
+    """
+    The arrays of an .npz file as a read-only tuple. The file is only opened
+    when the arrays are accessed, and each array is read once, so callers
+    that only need the module don't pay for the inputs and golden outputs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._npz = None
+        self._arrays = {}
+
+    def _files(self):
+        if self._npz is None:
+            self._npz = np.load(self.path)
+        return self._npz.files
+
+    def __len__(self):
+        return len(self._files())
 
-        destination_filename = os.path.join(destination_folder_name, blob_name)
-        if os.path.isdir(destination_filename):
-            continue
-        with open(destination_filename, "wb") as f:
-            with tqdm.wrapattr(f, "write", total=blob.size) as file_obj:
-                storage_client.download_blob_to_file(blob, file_obj)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self))))
+        key = self._files()[index]
+        if key not in self._arrays:
+            self._arrays[key] = self._npz[key]
+        return self._arrays[key]
+
+    def __add__(self, other):
+        return tuple(self) + tuple(other)
+
+    def __repr__(self):
+        return f"LazyNpzTuple({self.path!r})"
 
 
 input_type_to_np_dtype = {
@@ -136,16 +151,6 @@ def check_dir_exists(model_name, frontend="torch", dynamic=""):
     return False
 
 
-def _internet_connected():
-    import requests as req
-
-    try:
-        req.get("http://1.1.1.1")
-        return True
-    except:
-        return False
-
-
 def get_git_revision_short_hash() -> str:
     import subprocess
 
@@ -163,21 +168,29 @@ def get_git_revision_short_hash() -> str:
     return prefix_kw
 
 
+# Resolved shark_tank prefixes, so the bucket is looked up once per process.
+_tank_prefixes = {}
+
+
 def get_sharktank_prefix():
+    if shark_args.tank_offline:
+        return "none"
+    desired_prefix = get_git_revision_short_hash()
+    if desired_prefix in _tank_prefixes:
+        return _tank_prefixes[desired_prefix]
     tank_prefix = ""
-    if not _internet_connected():
+    try:
+        dir_blobs = get_tank_downloader().list_blobs(
+            "shark_tank", desired_prefix, max_results=1
+        )
+    except requests.RequestException:
         print(
             "No internet connection. Using the model already present in the tank."
         )
         tank_prefix = "none"
     else:
-        desired_prefix = get_git_revision_short_hash()
-        storage_client_a = storage.Client.create_anonymous_client()
-        base_bucket_name = "shark_tank"
-        base_bucket = storage_client_a.bucket(base_bucket_name)
-        dir_blobs = base_bucket.list_blobs(prefix=f"{desired_prefix}")
         for blob in dir_blobs:
-            dir_blob_name = blob.name.split("/")
+            dir_blob_name = blob["name"].split("/")
             if desired_prefix in dir_blob_name[0]:
                 tank_prefix = dir_blob_name[0]
                 break
@@ -188,9 +201,37 @@ def get_sharktank_prefix():
                 f"shark_tank bucket not found matching ({desired_prefix}). Defaulting to nightly."
             )
             tank_prefix = "nightly"
+    _tank_prefixes[desired_prefix] = tank_prefix
     return tank_prefix
 
 
+def get_manifest(tank_url):
+    """Returns the TankManifest of tank_url, or None when offline."""
+    if shark_args.tank_offline:
+        return None
+    return get_tank_manifest(
+        tank_url,
+        WORKDIR,
+        shark_args.tank_manifest_ttl,
+        get_tank_downloader(),
+    )
+
+
+def _download_model_dir(manifest, full_gs_url, model_dir_name, model_dir):
+    if manifest is None:
+        download_public_file(full_gs_url, model_dir)
+        return
+    blobs = manifest.model_blobs(model_dir_name)
+    get_tank_downloader().download_blobs(
+        manifest.bucket,
+        blobs,
+        [
+            os.path.join(model_dir, blob["name"].split("/")[-1])
+            for blob in blobs
+        ],
+    )
+
+
 # Downloads the torch model from gs://shark_tank dir.
 def download_model(
     model_name,
@@ -203,7 +244,6 @@ def download_model(
     model_name = model_name.replace("/", "_")
     dyn_str = "_dynamic" if dynamic else ""
     os.makedirs(WORKDIR, exist_ok=True)
-    shark_args.shark_prefix = get_sharktank_prefix()
     if import_args["batch_size"] and import_args["batch_size"] != 1:
         model_dir_name = (
             model_name
@@ -220,56 +260,52 @@ def download_model(
     model_dir = os.path.join(WORKDIR, model_dir_name)
 
     if not tank_url:
+        shark_args.shark_prefix = get_sharktank_prefix()
         tank_url = "gs://shark_tank/" + shark_args.shark_prefix
 
     full_gs_url = tank_url.rstrip("/") + "/" + model_dir_name
+    manifest = get_manifest(tank_url)
     if not check_dir_exists(
         model_dir_name, frontend=frontend, dynamic=dyn_str
     ):
-        print(
-            f"Downloading artifacts for model {model_name} from: {full_gs_url}"
-        )
-        download_public_file(full_gs_url, model_dir)
+        if shark_args.tank_offline:
+            print(
+                f"Offline mode: artifacts for model {model_name} are not in the local tank."
+            )
+        else:
+            print(
+                f"Downloading artifacts for model {model_name} from: {full_gs_url}"
+            )
+            _download_model_dir(
+                manifest, full_gs_url, model_dir_name, model_dir
+            )
 
     elif shark_args.force_update_tank == True:
         print(
             f"Force-updating artifacts for model {model_name} from: {full_gs_url}"
         )
-        download_public_file(full_gs_url, model_dir)
+        _download_model_dir(manifest, full_gs_url, model_dir_name, model_dir)
+    elif manifest is None:
+        print("Offline. Using the model already present in the tank.")
     else:
-        if not _internet_connected():
+        upstream_hash = manifest.md5(model_dir_name + "/hash.npy")
+        if upstream_hash is None:
+            print(f"Model artifact hash not found at {full_gs_url}.")
+        local_hash = file_md5(os.path.join(model_dir, "hash.npy"))
+        if local_hash != upstream_hash and shark_args.update_tank == True:
+            print(f"Updating artifacts for model {model_name}...")
+            _download_model_dir(
+                manifest, full_gs_url, model_dir_name, model_dir
+            )
+
+        elif local_hash != upstream_hash:
             print(
-                "No internet connection. Using the model already present in the tank."
+                "Hash does not match upstream in gs://shark_tank/. If you want to use locally generated artifacts, this is working as intended. Otherwise, run with --update_tank."
             )
         else:
-            local_hash = str(np.load(os.path.join(model_dir, "hash.npy")))
-            gs_hash_url = (
-                tank_url.rstrip("/") + "/" + model_dir_name + "/hash.npy"
-            )
-            download_public_file(
-                gs_hash_url,
-                os.path.join(model_dir, "upstream_hash.npy"),
-                single_file=True,
+            print(
+                "Local and upstream hashes match. Using cached model artifacts."
             )
-            try:
-                upstream_hash = str(
-                    np.load(os.path.join(model_dir, "upstream_hash.npy"))
-                )
-            except FileNotFoundError:
-                print(f"Model artifact hash not found at {model_dir}.")
-                upstream_hash = None
-            if local_hash != upstream_hash and shark_args.update_tank == True:
-                print(f"Updating artifacts for model {model_name}...")
-                download_public_file(full_gs_url, model_dir)
-
-            elif local_hash != upstream_hash:
-                print(
-                    "Hash does not match upstream in gs://shark_tank/. If you want to use locally generated artifacts, this is working as intended. Otherwise, run with --update_tank."
-                )
-            else:
-                print(
-                    "Local and upstream hashes match. Using cached model artifacts."
-                )
 
     model_dir = os.path.join(WORKDIR, model_dir_name)
     tuned_str = "" if tuned is None else "_" + tuned
@@ -290,9 +326,6 @@ def download_model(
     with open(filename, mode="rb") as f:
         mlir_file = f.read()
     function_name = str(np.load(os.path.join(model_dir, "function_name.npy")))
-    inputs = np.load(os.path.join(model_dir, "inputs.npz"))
-    golden_out = np.load(os.path.join(model_dir, "golden_out.npz"))
-
-    inputs_tuple = tuple([inputs[key] for key in inputs])
-    golden_out_tuple = tuple([golden_out[key] for key in golden_out])
+    inputs_tuple = LazyNpzTuple(os.path.join(model_dir, "inputs.npz"))
+    golden_out_tuple = LazyNpzTuple(os.path.join(model_dir, "golden_out.npz"))
     return mlir_file, function_name, inputs_tuple, golden_out_tuple
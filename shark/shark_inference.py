@@ -12,11 +12,13 @@
 from shark.iree_utils.compile_utils import (
     export_iree_module_to_vmfb,
     load_flatbuffer,
+    get_iree_module,
     create_dispatch_dirs,
     compile_benchmark_dirs,
 )
 import os
 from shark.shark_runner import SharkRunner
+from shark.iree_utils.device_tensor import SharkDeviceTensor
 from shark.parser import shark_args
 import numpy as np
 
@@ -55,6 +57,9 @@ class SharkInference:
         Runs the function with `function_name` within the mlir_module along
         with the given inputs, if the inputs are not given it autogenerates the
         inputs. Also, the inputs should be a numpy array.
+    invoke_async(function_name, inputs):
+        Same as __call__ but runs on the device's worker thread and returns a
+        future of the results.
     input_info():
         Gives the information about the inputs required by the `function_name`.
         This can be expensive as it does string matching to do so.
@@ -133,10 +138,37 @@ class SharkInference:
             )
             os.system(f"rm -rf {self.temp_dispatch_benchmarks_dir}")
 
-    # inputs are considered to be tuple of np.array.
+    # inputs are considered to be tuple of np.array or SharkDeviceTensor.
+    # With send_to_host=False the results stay on the device as
+    # SharkDeviceTensor and can be fed to another module on the same device.
     def __call__(self, function_name: str, inputs: tuple, send_to_host=True):
         return self.shark_runner.run(function_name, inputs, send_to_host)
 
+    # Queues the call on the device's worker thread and returns a
+    # concurrent.futures.Future; at most --max_in_flight_invocations calls
+    # are pending per device.
+    def invoke_async(
+        self, function_name: str, inputs: tuple, send_to_host=True
+    ):
+        return self.shark_runner.invoke_async(
+            function_name, inputs, send_to_host
+        )
+
+    # Awaitable version of invoke_async.
+    async def call_async(
+        self, function_name: str, inputs: tuple, send_to_host=True
+    ):
+        return await self.shark_runner.run_async(
+            function_name, inputs, send_to_host
+        )
+
+    # Uploads a host array once to the device of this module, e.g. inputs
+    # that stay constant over many calls.
+    def to_device(self, array):
+        return SharkDeviceTensor.from_host(
+            self.shark_runner.iree_config, array
+        )
+
     # Get all function names defined within the compiled module.
     def get_functions_in_module(self):
         return self.shark_runner.get_functions_in_module()
@@ -194,8 +226,27 @@ class SharkInference:
             extra_args=extra_args,
         )
 
-    # load and return the module.
-    def load_module(self, path, extra_args=[]):
+    # load the module from an in-memory flatbuffer, e.g. one compiled
+    # out of process by shark.iree_utils.compile_pool.
+    def load_flatbuffer_blob(self, flatbuffer_blob, extra_args=[]):
+        self.shark_runner = SharkRunner(
+            device=self.device,
+            compile_vmfb=False,
+            extra_args=extra_args,
+        )
+        (
+            self.shark_runner.iree_compilation_module,
+            self.shark_runner.iree_config,
+        ) = get_iree_module(
+            flatbuffer_blob,
+            self.device,
+            self.device_idx,
+        )
+        return
+
+    # load and return the module, memory mapping the .vmfb unless `mmap`
+    # is False.
+    def load_module(self, path, extra_args=[], mmap=True):
         self.shark_runner = SharkRunner(
             device=self.device,
             compile_vmfb=False,
@@ -208,5 +259,6 @@ class SharkInference:
             path,
             self.device,
             self.device_idx,
+            mmap=mmap,
         )
         return
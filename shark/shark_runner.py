@@ -20,8 +20,11 @@ from shark.iree_utils.compile_utils import (
 )
 from shark.iree_utils._common import check_device_drivers, device_driver_info
 from shark.parser import shark_args
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
 import sys
+import threading
 
 
 # supported dialects by the shark-runtime.
@@ -35,6 +38,54 @@ supported_dialects = {
 }
 
 
+class DeviceExecutor:
+    """
+    Runs invocations for one device on a dedicated worker thread.
+
+    At most `max_in_flight` invocations are queued or running at once;
+    `submit` blocks past that so producers cannot run arbitrarily far ahead
+    of the device.
+    """
+
+    def __init__(self, device_key, max_in_flight):
+        self.device_key = device_key
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"shark-{device_key}"
+        )
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_device_executors = {}
+_device_executors_lock = threading.Lock()
+
+
+def get_device_executor(device, device_idx=None):
+    """Returns the executor shared by all the runners on the device."""
+    device_key = device if device_idx is None else f"{device}:{device_idx}"
+    with _device_executors_lock:
+        executor = _device_executors.get(device_key)
+        if executor is None:
+            executor = DeviceExecutor(
+                device_key, shark_args.max_in_flight_invocations
+            )
+            _device_executors[device_key] = executor
+    return executor
+
+
 class SharkRunner:
     """
     Base class for SharkInference and SharkTrainer
@@ -59,6 +110,12 @@ class SharkRunner:
         Runs the function with `function_name` within the mlir_module along
         with the given inputs, if the inputs are not given it autogenerates the
         inputs. Also, the inputs should be a numpy array.
+    invoke_async(function_name, inputs, send_to_host=True):
+        Queues the run on the device's worker thread and returns a
+        concurrent.futures.Future of the results, numpy arrays unless
+        send_to_host is False, as for SharkInference.
+    run_async(function_name, inputs, send_to_host=True):
+        Awaitable version of invoke_async for asyncio callers.
     input_info():
         Gives the information about the inputs required by the `function_name`.
         This can be expensive as it does string matching to do so.
@@ -106,6 +163,21 @@ class SharkRunner:
             send_to_host,
         )
 
+    def invoke_async(self, function_name, inputs: tuple, send_to_host=True):
+        # Invocations of all the runners on a device are serialized on one
+        # worker thread, so CPU side work of the caller overlaps with them.
+        # Don't mix with concurrent synchronous `run` calls on the same
+        # module from other threads.
+        executor = get_device_executor(self.device, self.device_idx)
+        return executor.submit(self.run, function_name, inputs, send_to_host)
+
+    async def run_async(self, function_name, inputs: tuple, send_to_host=True):
+        # Waiting for a free in-flight slot must not block the event loop.
+        future = await asyncio.get_running_loop().run_in_executor(
+            None, self.invoke_async, function_name, inputs, send_to_host
+        )
+        return await asyncio.wrap_future(future)
+
     # Get all function names defined within the compiled module.
     def get_functions_in_module(self):
         return self.iree_compilation_module._vm_module.function_names
@@ -0,0 +1,218 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import torch
+
+from shark.iree_utils.device_tensor import SharkDeviceTensor
+
+
+class SamplingModule(torch.nn.Module):
+    """
+    Picks the next token from the logits of one position.
+
+    Inputs are the [1, seq_len, vocab] logits, the [1] index of the position
+    to sample, the [1, vocab] mask of the tokens seen so far, the [4] params
+    (temperature, top_k, top_p, repetition_penalty) and a [1] uniform random
+    number. Returns the [1] token and the updated seen mask. A temperature
+    <= 0 is greedy decoding.
+    """
+
+    def forward(self, logits, index, seen, params, rand):
+        vocab_size = logits.shape[2]
+        logits = torch.index_select(logits, 1, index)
+        logits = logits.reshape(1, vocab_size).float()
+        temperature = params[0]
+        top_k = params[1]
+        top_p = params[2]
+        repetition_penalty = params[3]
+
+        penalized = torch.where(
+            logits > 0,
+            logits / repetition_penalty,
+            logits * repetition_penalty,
+        )
+        logits = torch.where(seen > 0, penalized, logits)
+        greedy = torch.argmax(logits, dim=1)
+
+        scaled = logits / torch.clamp(temperature, min=1e-5)
+        sorted_logits, sorted_ids = torch.sort(scaled, dim=1, descending=True)
+        probs = torch.softmax(sorted_logits, dim=1)
+        cumulative = torch.cumsum(probs, dim=1)
+        ranks = torch.arange(vocab_size).reshape(1, vocab_size)
+        # The most likely token is always kept.
+        keep = ((ranks < top_k) & (cumulative - probs < top_p)) | (ranks == 0)
+        probs = probs * keep.float()
+        cumulative = torch.cumsum(probs, dim=1)
+        threshold = rand * cumulative[:, -1]
+        choice = torch.sum((cumulative < threshold).to(torch.int64), dim=1)
+        choice = torch.clamp(choice, max=vocab_size - 1)
+        sampled = torch.gather(sorted_ids, 1, choice.reshape(1, 1))
+        token = torch.where(temperature > 0, sampled.reshape(1), greedy)
+
+        seen = torch.maximum(
+            seen, (ranks == token.reshape(1, 1)).to(seen.dtype)
+        )
+        return token, seen
+
+
+class SharkSampler:
+    """
+    Samples tokens from LLM logits without copying the logits to the host.
+
+    ...
+
+    Logits given as a SharkDeviceTensor (a module output returned with
+    `send_to_host=False`) are sampled by a compiled SamplingModule on the
+    same device, and only the token id is copied back. Host logits are
+    sampled by running the same SamplingModule eagerly.
+
+    Attributes
+    ----------
+    vocab_size : int
+        size of the last dim of the logits.
+    device : str
+        device the logits live on.
+    device_idx : int
+        index of that device, as given to SharkInference.
+    temperature : float
+        <= 0 for greedy decoding.
+    top_k : int
+        sample among the k most likely tokens. 0 disables the limit.
+    top_p : float
+        sample among the most likely tokens whose probabilities sum to p.
+    repetition_penalty : float
+        divides the positive logits and multiplies the negative ones of the
+        tokens already seen. 1 disables it.
+    seed : int
+        seed of the random numbers used for sampling.
+
+    Methods
+    -------
+    reset(input_ids=None):
+        Starts a new sequence; the prompt ids count as seen tokens.
+    __call__(logits, index=-1):
+        Returns the token sampled at position `index` of the logits as an
+        int and marks it as seen.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        device: str = "none",
+        device_idx: int = None,
+        temperature: float = 0.0,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0,
+        seed: int = None,
+    ):
+        self.vocab_size = vocab_size
+        self.device = device
+        self.device_idx = device_idx
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.rng = np.random.default_rng(seed)
+        self.sampling_module = SamplingModule()
+        self.shark_module = None
+        self._seen = None
+        self._device_params = None
+        self.reset()
+
+    def get_params(self):
+        top_k = self.top_k if self.top_k > 0 else self.vocab_size
+        return np.array(
+            [self.temperature, top_k, self.top_p, self.repetition_penalty],
+            dtype=np.float32,
+        )
+
+    def compile(self):
+        import torch_mlir
+        from shark.shark_inference import SharkInference
+
+        logits = torch_mlir.TensorPlaceholder.like(
+            torch.zeros([1, 2, self.vocab_size]), dynamic_axes=[1]
+        )
+        inputs = (
+            logits,
+            torch.zeros([1], dtype=torch.int64),
+            torch.zeros([1, self.vocab_size]),
+            torch.zeros([4]),
+            torch.zeros([1]),
+        )
+        module = torch_mlir.compile(
+            self.sampling_module,
+            inputs,
+            torch_mlir.OutputType.LINALG_ON_TENSORS,
+            use_tracing=False,
+            verbose=False,
+        )
+        shark_module = SharkInference(
+            module.operation.get_asm(),
+            device=self.device,
+            mlir_dialect="tm_tensor",
+            device_idx=self.device_idx,
+        )
+        shark_module.compile()
+        return shark_module
+
+    def get_shark_module(self):
+        if self.shark_module is None:
+            self.shark_module = self.compile()
+        return self.shark_module
+
+    def reset(self, input_ids=None):
+        seen = np.zeros([1, self.vocab_size], dtype=np.float32)
+        if input_ids is not None and self.repetition_penalty != 1.0:
+            seen[0, np.asarray(input_ids).reshape(-1)] = 1.0
+        self._seen = seen
+        self._device_params = None
+
+    def __call__(self, logits, index=-1):
+        if index < 0:
+            index += logits.shape[1]
+        index = np.array([index], dtype=np.int64)
+        rand = self.rng.random(1, dtype=np.float32)
+
+        if not isinstance(logits, SharkDeviceTensor):
+            if hasattr(logits, "detach"):
+                logits = logits.detach().cpu()
+            seen = self._seen
+            if isinstance(seen, SharkDeviceTensor):
+                seen = seen.to_host()
+            token, seen = self.sampling_module(
+                torch.as_tensor(np.asarray(logits)),
+                torch.from_numpy(index),
+                torch.from_numpy(np.asarray(seen)),
+                torch.from_numpy(self.get_params()),
+                torch.from_numpy(rand),
+            )
+            self._seen = seen.numpy()
+            return int(token[0])
+
+        shark_module = self.get_shark_module()
+        if self._device_params is None:
+            self._device_params = shark_module.to_device(self.get_params())
+        if not isinstance(self._seen, SharkDeviceTensor):
+            self._seen = shark_module.to_device(self._seen)
+        token, seen = shark_module(
+            "forward",
+            (logits, index, self._seen, self._device_params, rand),
+            send_to_host=False,
+        )
+        # The seen mask stays on the device for the next call.
+        self._seen = seen
+        return int(token.to_host()[0])
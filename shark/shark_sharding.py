@@ -0,0 +1,381 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Pipeline parallel execution of a model sharded into per-layer modules.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from shark.iree_utils.device_tensor import SharkDeviceTensor
+
+
+def _fits(latencies, memories, max_latency, max_memory, num_devices):
+    # Greedily packs consecutive layers on each device; returns the
+    # placement as device positions, or None if it needs more devices.
+    placement = []
+    device = 0
+    latency = 0.0
+    memory = 0.0
+    for layer_latency, layer_memory in zip(latencies, memories):
+        if layer_latency > max_latency or layer_memory > max_memory:
+            return None
+        if (
+            latency + layer_latency > max_latency
+            or memory + layer_memory > max_memory
+        ):
+            device += 1
+            latency = 0.0
+            memory = 0.0
+            if device == num_devices:
+                return None
+        latency += layer_latency
+        memory += layer_memory
+        placement.append(device)
+    return placement
+
+
+def plan_placement(
+    layer_latencies, devices, layer_memory=None, device_memory=None
+):
+    """
+    Assigns consecutive ranges of layers to `devices` (a list of
+    device_idx), minimizing the latency of the slowest device, which bounds
+    the throughput of the pipeline, while keeping the memory of the layers
+    of each device under `device_memory`. Returns the device_idx of every
+    layer. Consecutive ranges keep activations on a device except at the
+    boundaries.
+
+    `layer_latencies` are e.g. the ones measured by
+    ShardedPipeline.profile, `layer_memory` the .vmfb sizes of the layers.
+    Raises ValueError if the layers don't fit in the devices.
+    """
+    if not devices:
+        raise ValueError("plan_placement needs at least one device.")
+    latencies = [float(latency) for latency in layer_latencies]
+    memories = (
+        [0.0] * len(latencies)
+        if layer_memory is None
+        else [float(memory) for memory in layer_memory]
+    )
+    max_memory = float("inf") if device_memory is None else device_memory
+    total = sum(latencies)
+    low = max(latencies, default=0.0)
+    high = total
+    best = _fits(latencies, memories, high, max_memory, len(devices))
+    if best is None:
+        raise ValueError(
+            f"{len(latencies)} layers of {sum(memories)} bytes don't fit in "
+            f"{len(devices)} devices of {device_memory} bytes."
+        )
+    # Bisect the bottleneck latency; the greedy packing is optimal for a
+    # given bound.
+    for _ in range(64):
+        if high - low <= 1e-6 * max(total, 1e-12):
+            break
+        middle = (low + high) / 2
+        placement = _fits(
+            latencies, memories, middle, max_memory, len(devices)
+        )
+        if placement is None:
+            low = middle
+        else:
+            high = middle
+            best = placement
+    return [devices[device] for device in best]
+
+
+def split_batch(array, num_micro_batches):
+    """Splits an array along its first dim into micro-batches."""
+    if isinstance(array, SharkDeviceTensor):
+        array = array.to_host()
+    return np.array_split(np.asarray(array), num_micro_batches)
+
+
+class ShardedPipeline:
+    """
+    Runs a model split into consecutive per-layer SharkInference modules,
+    each possibly on a different device.
+
+    ...
+
+    Layer i is called with (hidden_states, *side_inputs, *layer_inputs[i])
+    and returns the hidden states of the next layer first, followed by
+    outputs of its own (e.g. its kv cache). The side inputs, e.g. attention
+    masks, are the same for all layers and are uploaded once per device.
+    Activations stay on the device between layers placed on the same
+    device, and are copied to the next device otherwise.
+
+    With micro-batching, the inputs are split along their first dim and the
+    micro-batches flow through the layers concurrently: each device runs
+    its layers in order on its own worker thread, so while a device works on
+    a micro-batch, the previous devices already work on the next ones.
+
+    Attributes
+    ----------
+    modules : list
+        the per-layer SharkInference modules, loaded on their device.
+    function_name : str
+        the function of the modules to call.
+    before_layer : callable
+        optional, called with the module of each layer right before it
+        runs, e.g. to cudaSetDevice its device_idx. Such per thread state
+        must be set on the thread invoking the layer, so with a hook the
+        layers are run synchronously on the calling thread instead of on
+        the worker thread of their device.
+
+    Methods
+    -------
+    __call__(hidden_states, side_inputs=(), layer_inputs=None,
+             num_micro_batches=1, send_to_host=True):
+        Runs the layers and returns the final hidden states and the extra
+        outputs of every layer.
+    profile(hidden_states, side_inputs=(), layer_inputs=None, iterations=3):
+        Returns the mean latency in ms of every layer, for plan_placement.
+    placement:
+        the device_idx of every layer.
+    metrics():
+        Returns counts of runs, micro-batches and device to device copies.
+    """
+
+    def __init__(self, modules, function_name="forward", before_layer=None):
+        self.modules = list(modules)
+        self.function_name = function_name
+        self.before_layer = before_layer
+        self._lock = threading.Lock()
+        self._metrics = {"runs": 0, "micro_batches": 0, "device_copies": 0}
+
+    @property
+    def placement(self):
+        return [module.device_idx for module in self.modules]
+
+    def _to_device(self, array, module):
+        config = module.shark_runner.iree_config
+        if isinstance(array, SharkDeviceTensor):
+            if array.hal_device is config.device:
+                return array
+            # IREE has no cross device copy through the python API, the
+            # copy is staged in host memory.
+            array = array.to_host()
+            with self._lock:
+                self._metrics["device_copies"] += 1
+        return SharkDeviceTensor.from_host(config, array)
+
+    def _run_layer(self, index, hidden_states, side_inputs, layer_inputs):
+        module = self.modules[index]
+        inputs = (
+            self._to_device(hidden_states, module),
+            *side_inputs,
+            *(self._to_device(x, module) for x in layer_inputs),
+        )
+        if self.before_layer is not None:
+            self.before_layer(module)
+            outputs = module(self.function_name, inputs, send_to_host=False)
+        else:
+            outputs = module.invoke_async(
+                self.function_name, inputs, send_to_host=False
+            ).result()
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        return outputs[0], list(outputs[1:])
+
+    def _run_micro_batch(self, hidden_states, side_inputs, layer_inputs):
+        # Side inputs uploaded to each device.
+        device_side_inputs = {}
+        extra_outputs = []
+        for i, module in enumerate(self.modules):
+            device = module.shark_runner.iree_config.device
+            if id(device) not in device_side_inputs:
+                device_side_inputs[id(device)] = [
+                    self._to_device(x, module) for x in side_inputs
+                ]
+            hidden_states, extra = self._run_layer(
+                i,
+                hidden_states,
+                device_side_inputs[id(device)],
+                layer_inputs[i],
+            )
+            extra_outputs.append(extra)
+        return hidden_states, extra_outputs
+
+    def __call__(
+        self,
+        hidden_states,
+        side_inputs=(),
+        layer_inputs=None,
+        num_micro_batches=1,
+        send_to_host=True,
+    ):
+        if layer_inputs is None:
+            layer_inputs = [()] * len(self.modules)
+        if len(layer_inputs) != len(self.modules):
+            raise ValueError(
+                f"Got layer inputs for {len(layer_inputs)} layers, the "
+                f"pipeline has {len(self.modules)}."
+            )
+        with self._lock:
+            self._metrics["runs"] += 1
+            self._metrics["micro_batches"] += num_micro_batches
+
+        if num_micro_batches == 1:
+            hidden_states, extra_outputs = self._run_micro_batch(
+                hidden_states, side_inputs, layer_inputs
+            )
+            if send_to_host:
+                hidden_states = _to_host(hidden_states)
+                extra_outputs = [
+                    [_to_host(x) for x in extra] for extra in extra_outputs
+                ]
+            return hidden_states, extra_outputs
+
+        micro_hidden = split_batch(hidden_states, num_micro_batches)
+        micro_side = [split_batch(x, num_micro_batches) for x in side_inputs]
+        micro_layer = [
+            [split_batch(x, num_micro_batches) for x in inputs]
+            for inputs in layer_inputs
+        ]
+        with ThreadPoolExecutor(num_micro_batches) as pool:
+            futures = [
+                pool.submit(
+                    self._run_micro_batch,
+                    micro_hidden[m],
+                    [x[m] for x in micro_side],
+                    [[x[m] for x in inputs] for inputs in micro_layer],
+                )
+                for m in range(num_micro_batches)
+            ]
+            results = [future.result() for future in futures]
+
+        # The micro-batches are gathered on the host.
+        hidden_states = np.concatenate(
+            [_to_host(hidden) for hidden, _ in results]
+        )
+        extra_outputs = [
+            [
+                np.concatenate(
+                    [_to_host(extras[i][j]) for _, extras in results]
+                )
+                for j in range(len(results[0][1][i]))
+            ]
+            for i in range(len(self.modules))
+        ]
+        return hidden_states, extra_outputs
+
+    def profile(
+        self, hidden_states, side_inputs=(), layer_inputs=None, iterations=3
+    ):
+        if layer_inputs is None:
+            layer_inputs = [()] * len(self.modules)
+        latencies = []
+        for i, module in enumerate(self.modules):
+            side = [self._to_device(x, module) for x in side_inputs]
+            inputs = self._to_device(hidden_states, module)
+            # Warm up, and the input of the next layer.
+            next_hidden, _ = self._run_layer(i, inputs, side, layer_inputs[i])
+            start = time.perf_counter()
+            for _ in range(iterations):
+                self._run_layer(i, inputs, side, layer_inputs[i])
+            latencies.append((time.perf_counter() - start) * 1000 / iterations)
+            hidden_states = next_hidden
+        return latencies
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+
+def _to_host(array):
+    if isinstance(array, SharkDeviceTensor):
+        return array.to_host()
+    return array
+
+
+class LayerWithWeights:
+    """
+    A layer compiled with its weights lifted to arguments (see
+    shark.iree_utils.layer_compile), called like a SharkInference module.
+    The weights are uploaded once to the device of the module and passed
+    after the inputs of every call.
+    """
+
+    def __init__(self, module, weights):
+        self.module = module
+        self.weights = [module.to_device(weight) for weight in weights]
+
+    @property
+    def device_idx(self):
+        return self.module.device_idx
+
+    @property
+    def shark_runner(self):
+        return self.module.shark_runner
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        return self.module(
+            function_name, (*inputs, *self.weights), send_to_host
+        )
+
+    def invoke_async(self, function_name, inputs, send_to_host=True):
+        return self.module.invoke_async(
+            function_name, (*inputs, *self.weights), send_to_host
+        )
+
+    def to_device(self, array):
+        return self.module.to_device(array)
+
+
+def load_layer_module(
+    vmfb_path, device, mlir_dialect="tm_tensor", device_idx=None
+):
+    """
+    Loads the .vmfb of a layer, with the weights saved next to it by
+    save_compiled_layer if there are any.
+    """
+    from shark.iree_utils.layer_compile import get_weights_path
+    from shark.shark_inference import SharkInference
+
+    module = SharkInference(
+        None,
+        device=device,
+        mlir_dialect=mlir_dialect,
+        device_idx=device_idx,
+    )
+    module.load_module(vmfb_path)
+    weights_path = get_weights_path(vmfb_path)
+    if not os.path.isfile(weights_path):
+        return module
+    with np.load(weights_path) as weights:
+        keys = sorted(weights.files, key=lambda key: int(key.split("_")[1]))
+        return LayerWithWeights(module, [weights[key] for key in keys])
+
+
+def load_sharded_modules(
+    vmfb_paths, device, placement, mlir_dialect="tm_tensor"
+):
+    """
+    Loads the .vmfb of every layer on the device_idx `placement` gives it,
+    e.g. the output of plan_placement with the .vmfb sizes as memory.
+    """
+    return [
+        load_layer_module(path, device, mlir_dialect, device_idx)
+        for path, device_idx in zip(vmfb_paths, placement)
+    ]
+
+
+def get_vmfb_sizes(vmfb_paths):
+    """The size of every .vmfb, a proxy of the device memory of a layer."""
+    return [os.path.getsize(path) for path in vmfb_paths]
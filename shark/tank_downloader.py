@@ -0,0 +1,328 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Parallel, resumable and verified downloads of public GCS blobs.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from tqdm.std import tqdm
+
+GCS_ENDPOINT = "https://storage.googleapis.com"
+
+
+class DownloadError(Exception):
+    pass
+
+
+def file_md5(path, block_size=1 << 22):
+    """Returns the base64 md5 of a file, as GCS reports it."""
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return base64.b64encode(hasher.digest()).decode("ascii")
+
+
+def split_gs_url(gs_url):
+    """Splits gs://bucket/some/prefix into ("bucket", "some/prefix")."""
+    path = gs_url[len("gs://") :] if gs_url.startswith("gs://") else gs_url
+    bucket, _, prefix = path.partition("/")
+    return bucket, prefix
+
+
+class _PartialFile:
+    # A blob being downloaded to `<dest>.part`, with the chunks already
+    # written recorded in `<dest>.part.json` so an interrupted download
+    # resumes where it stopped.
+    def __init__(self, dest, blob, chunk_size):
+        self.dest = os.fspath(dest)
+        self.path = self.dest + ".part"
+        self.state_path = self.path + ".json"
+        self.blob = blob
+        self.chunk_size = chunk_size
+        self.num_chunks = max(1, -(-blob["size"] // chunk_size))
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        return {
+            "size": self.blob["size"],
+            "md5": self.blob.get("md5"),
+            "generation": self.blob.get("generation"),
+            "chunk_size": self.chunk_size,
+        }
+
+    def open(self):
+        state = None
+        if os.path.isfile(self.path) and os.path.isfile(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except ValueError:
+                state = None
+        if state is not None and state.get("blob") == self._signature():
+            self.done = set(state["done"])
+        else:
+            self.done = set()
+            with open(self.path, "wb") as f:
+                f.truncate(self.blob["size"])
+            self._save()
+
+    def _save(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"blob": self._signature(), "done": sorted(self.done)}, f
+            )
+        os.replace(tmp_path, self.state_path)
+
+    def chunk_range(self, index):
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.blob["size"])
+
+    def write_chunk(self, index, data):
+        start, end = self.chunk_range(index)
+        if len(data) != end - start:
+            raise DownloadError(
+                f"Got {len(data)} bytes for bytes {start}-{end} of "
+                f"{self.blob['name']}."
+            )
+        with open(self.path, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+        with self._lock:
+            self.done.add(index)
+            self._save()
+
+    def pending(self):
+        return [i for i in range(self.num_chunks) if i not in self.done]
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def commit(self):
+        os.replace(self.path, self.dest)
+        os.remove(self.state_path)
+
+
+class TankDownloader:
+    """
+    Downloads public blobs of a GCS bucket through its JSON API.
+
+    ...
+
+    The blobs are split into ranged chunks downloaded concurrently by a
+    pool of threads, each chunk being retried on failure. A blob is written
+    to a `.part` file next to its destination, with the list of chunks
+    already written, so an interrupted download only fetches the missing
+    chunks when started again. Once complete, the file is checked against
+    the md5 the bucket reports and renamed to its destination: the
+    destination never holds a partial or corrupt file.
+
+    Attributes
+    ----------
+    endpoint : str
+        root URL of the GCS JSON API, e.g. a local fake server for tests.
+    num_workers : int
+        chunks downloaded concurrently.
+    chunk_size : int
+        size in bytes of the ranged requests.
+    retries : int
+        attempts per chunk before giving up.
+
+    Methods
+    -------
+    list_blobs(bucket, prefix, max_results=None):
+        Returns the name, size and md5 of the blobs under a prefix.
+    download_blobs(bucket, blobs, dest_paths):
+        Downloads blobs to the given paths.
+    download_prefix(gs_url, dest_dir):
+        Downloads the blobs under a gs:// prefix to a directory.
+    download_file(gs_url, dest_path):
+        Downloads one blob to a path.
+    """
+
+    def __init__(
+        self,
+        endpoint=GCS_ENDPOINT,
+        num_workers=8,
+        chunk_size=32 << 20,
+        retries=3,
+        timeout=60,
+        show_progress=True,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.show_progress = show_progress
+        self._local = threading.local()
+
+    def _session(self):
+        # requests sessions are not thread safe, one per worker.
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def list_blobs(self, bucket, prefix, max_results=None):
+        url = f"{self.endpoint}/storage/v1/b/{quote(bucket, safe='')}/o"
+        params = {"prefix": prefix}
+        if max_results is not None:
+            params["maxResults"] = max_results
+        blobs = []
+        while True:
+            response = self._session().get(
+                url, params=params, timeout=self.timeout
+            )
+            response.raise_for_status()
+            listing = response.json()
+            for item in listing.get("items", []):
+                blobs.append(
+                    {
+                        "name": item["name"],
+                        "size": int(item["size"]),
+                        "md5": item.get("md5Hash"),
+                        "generation": item.get("generation"),
+                    }
+                )
+            if "nextPageToken" not in listing or (
+                max_results is not None and len(blobs) >= max_results
+            ):
+                return blobs[:max_results]
+            params["pageToken"] = listing["nextPageToken"]
+
+    def _fetch_chunk(self, bucket, partial, index, progress):
+        start, end = partial.chunk_range(index)
+        url = (
+            f"{self.endpoint}/storage/v1/b/{quote(bucket, safe='')}/o/"
+            f"{quote(partial.blob['name'], safe='')}"
+        )
+        params = {"alt": "media"}
+        if partial.blob.get("generation"):
+            params["generation"] = partial.blob["generation"]
+        for attempt in range(self.retries):
+            try:
+                if end == start:
+                    data = b""
+                else:
+                    response = self._session().get(
+                        url,
+                        params=params,
+                        headers={"Range": f"bytes={start}-{end - 1}"},
+                        timeout=self.timeout,
+                    )
+                    response.raise_for_status()
+                    data = response.content
+                    if response.status_code == 200 and len(data) > (
+                        end - start
+                    ):
+                        # The server ignored the range.
+                        data = data[start:end]
+                partial.write_chunk(index, data)
+                progress.update(len(data))
+                return
+            except (requests.RequestException, DownloadError) as e:
+                if attempt + 1 == self.retries:
+                    raise DownloadError(
+                        f"Failed to download bytes {start}-{end} of "
+                        f"gs://{bucket}/{partial.blob['name']}: {e}"
+                    ) from e
+                time.sleep(min(2**attempt, 10) * 0.1)
+
+    def _is_up_to_date(self, blob, dest):
+        return (
+            os.path.isfile(dest)
+            and os.path.getsize(dest) == blob["size"]
+            and blob.get("md5") is not None
+            and file_md5(dest) == blob["md5"]
+        )
+
+    def download_blobs(self, bucket, blobs, dest_paths):
+        partials = []
+        for blob, dest in zip(blobs, dest_paths):
+            if self._is_up_to_date(blob, dest):
+                continue
+            os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+            partial = _PartialFile(dest, blob, self.chunk_size)
+            partial.open()
+            partials.append(partial)
+        if not partials:
+            return
+
+        total = sum(p.blob["size"] for p in partials)
+        resumed = sum(
+            sum(end - start for start, end in map(p.chunk_range, p.done))
+            for p in partials
+        )
+        with tqdm(
+            total=total,
+            initial=resumed,
+            unit="B",
+            unit_scale=True,
+            disable=not self.show_progress,
+        ) as progress, ThreadPoolExecutor(self.num_workers) as pool:
+            futures = [
+                pool.submit(self._fetch_chunk, bucket, p, i, progress)
+                for p in partials
+                for i in p.pending()
+            ]
+            errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            # The .part files are kept for the next attempt to resume.
+            raise errors[0]
+
+        for partial in partials:
+            md5 = partial.blob.get("md5")
+            if md5 is not None and file_md5(partial.path) != md5:
+                partial.discard()
+                raise DownloadError(
+                    f"Checksum mismatch for gs://{bucket}/"
+                    f"{partial.blob['name']}, the download was discarded."
+                )
+            partial.commit()
+
+    def download_prefix(self, gs_url, dest_dir):
+        bucket, prefix = split_gs_url(gs_url)
+        # Only the blobs directly under the prefix, as a directory.
+        blobs = [
+            blob
+            for blob in self.list_blobs(bucket, prefix.rstrip("/") + "/")
+            if "/" not in blob["name"][len(prefix.rstrip("/")) + 1 :]
+        ]
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_paths = [
+            os.path.join(dest_dir, blob["name"].split("/")[-1])
+            for blob in blobs
+        ]
+        self.download_blobs(bucket, blobs, dest_paths)
+        return dest_paths
+
+    def download_file(self, gs_url, dest_path):
+        bucket, name = split_gs_url(gs_url)
+        blobs = [b for b in self.list_blobs(bucket, name) if b["name"] == name]
+        if not blobs:
+            raise FileNotFoundError(f"{gs_url} not found.")
+        self.download_blobs(bucket, blobs, [dest_path])
+        return dest_path
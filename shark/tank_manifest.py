@@ -0,0 +1,172 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Sizes and hashes of all the artifacts under a shark_tank prefix.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from shark.tank_downloader import split_gs_url
+
+
+class TankManifest:
+    """
+    The size and md5 of every blob under a tank url, e.g.
+    gs://shark_tank/<prefix>, from one listing of the bucket.
+
+    ...
+
+    Checking whether the local artifacts of a model are up to date, or
+    which of them to download, is a lookup in the manifest instead of
+    network round trips per model.
+
+    Attributes
+    ----------
+    tank_url : str
+        gs:// url the manifest lists.
+    blobs : dict
+        {name relative to tank_url: {"size": int, "md5": str}}.
+    fetch_time : float
+        when the bucket was listed.
+
+    Methods
+    -------
+    fetch(tank_url, downloader):
+        Lists the bucket and returns its manifest.
+    load(path), save(path):
+        Reads or writes the manifest as JSON.
+    is_fresh(ttl):
+        Whether the manifest is less than `ttl` seconds old.
+    md5(name):
+        Returns the md5 of a blob, or None if it isn't in the tank.
+    model_blobs(model_dir_name):
+        Returns the blobs of a model directory, as TankDownloader takes
+        them.
+    """
+
+    def __init__(self, tank_url, blobs, fetch_time):
+        self.tank_url = tank_url.rstrip("/")
+        self.bucket, self.prefix = split_gs_url(self.tank_url)
+        self.blobs = blobs
+        self.fetch_time = fetch_time
+
+    @classmethod
+    def fetch(cls, tank_url, downloader):
+        bucket, prefix = split_gs_url(tank_url.rstrip("/"))
+        prefix = prefix + "/" if prefix else ""
+        blobs = {
+            blob["name"][len(prefix) :]: {
+                "size": blob["size"],
+                "md5": blob["md5"],
+            }
+            for blob in downloader.list_blobs(bucket, prefix)
+        }
+        return cls(tank_url, blobs, time.time())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["tank_url"], data["blobs"], data["fetch_time"])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "tank_url": self.tank_url,
+                    "fetch_time": self.fetch_time,
+                    "blobs": self.blobs,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+
+    def is_fresh(self, ttl):
+        return time.time() - self.fetch_time < ttl
+
+    def md5(self, name):
+        blob = self.blobs.get(name)
+        return None if blob is None else blob["md5"]
+
+    def model_blobs(self, model_dir_name):
+        dir_prefix = model_dir_name.rstrip("/") + "/"
+        return [
+            {
+                "name": f"{self.prefix}/{name}" if self.prefix else name,
+                "size": blob["size"],
+                "md5": blob["md5"],
+            }
+            for name, blob in sorted(self.blobs.items())
+            if name.startswith(dir_prefix)
+            and "/" not in name[len(dir_prefix) :]
+        ]
+
+
+def get_manifest_path(cache_dir, tank_url):
+    key = hashlib.sha256(tank_url.rstrip("/").encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, ".manifests", f"{key}.json")
+
+
+_manifests = {}
+_unreachable = set()
+_manifests_lock = threading.Lock()
+
+
+def get_tank_manifest(tank_url, cache_dir, ttl, downloader):
+    """
+    Returns the manifest of `tank_url`, listing the bucket at most once per
+    `ttl` seconds across processes: it is kept in memory and in
+    `cache_dir`. If the bucket can't be reached, falls back to a stale
+    cached manifest, or returns None when there is none, and doesn't try
+    again in this process.
+    """
+    tank_url = tank_url.rstrip("/")
+    with _manifests_lock:
+        manifest = _manifests.get(tank_url)
+        if manifest is not None and (
+            manifest.is_fresh(ttl) or tank_url in _unreachable
+        ):
+            return manifest
+        if tank_url in _unreachable:
+            return None
+
+        path = get_manifest_path(cache_dir, tank_url)
+        cached = manifest
+        if cached is None and os.path.isfile(path):
+            try:
+                cached = TankManifest.load(path)
+            except (ValueError, KeyError):
+                cached = None
+        if cached is not None and cached.is_fresh(ttl):
+            manifest = cached
+        else:
+            try:
+                manifest = TankManifest.fetch(tank_url, downloader)
+                manifest.save(path)
+            except requests.RequestException as e:
+                print(f"Could not list {tank_url}: {e}")
+                _unreachable.add(tank_url)
+                if cached is None:
+                    return None
+                print("Using the last known shark_tank manifest.")
+                manifest = cached
+        _manifests[tank_url] = manifest
+        return manifest
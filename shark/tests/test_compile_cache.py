@@ -0,0 +1,55 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+import tempfile
+
+from shark.iree_utils.compile_cache import VmfbCache, get_compile_cache_key
+
+
+class VmfbCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = VmfbCache(self.tmp_dir.name, max_size_bytes=10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key_depends_on_flags(self):
+        key_a = get_compile_cache_key(b"module", "llvm-cpu", ["--a"])
+        key_b = get_compile_cache_key(b"module", "llvm-cpu", ["--b"])
+        self.assertNotEqual(key_a, key_b)
+        self.assertEqual(
+            key_a, get_compile_cache_key("module", "llvm-cpu", ["--a"])
+        )
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get("k"))
+        self.cache.put("k", b"1234")
+        self.assertEqual(self.cache.get("k"), b"1234")
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["misses"], 1)
+
+    def test_lru_eviction(self):
+        self.cache.put("a", b"123456")
+        os.utime(self.cache.path_for("a"), (0, 0))
+        self.cache.put("b", b"123456")
+        self.assertFalse(os.path.exists(self.cache.path_for("a")))
+        self.assertTrue(os.path.exists(self.cache.path_for("b")))
+        self.assertEqual(self.cache.stats["evictions"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
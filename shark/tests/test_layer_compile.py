@@ -0,0 +1,150 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from shark.iree_utils.layer_compile import (
+    CompiledLayer,
+    externalize_constants,
+    get_weights_path,
+    save_compiled_layer,
+    structural_hash,
+)
+
+LAYER_MLIR = """module attributes {{torch.debug_module_name = "Layer"}} {{
+  func.func @forward(%arg0: tensor<4x8xf32>) -> tensor<4x8xf32> {{
+    %cst = arith.constant 0.000000e+00 : f32
+    %cst_0 = arith.constant dense<"0x{weight}"> : tensor<8x8xf32> loc(#loc1)
+    %cst_1 = arith.constant dense<1.000000e+00> : tensor<8xf32>
+    %cst_2 = arith.constant dense_resource<torch_tensor_8_f32> : tensor<8xf32>
+    %0 = tensor.empty() : tensor<4x8xf32>
+    %1 = linalg.fill ins(%cst : f32) outs(%0 : tensor<4x8xf32>) -> tensor<4x8xf32>
+    %2 = linalg.matmul ins(%arg0, %cst_0 : tensor<4x8xf32>, tensor<8x8xf32>) outs(%1 : tensor<4x8xf32>) -> tensor<4x8xf32>
+    return %2 : tensor<4x8xf32>
+  }}
+}}
+#loc1 = loc("{name}")
+
+{{-#
+  dialect_resources: {{
+    builtin: {{
+      torch_tensor_8_f32: "0x04000000{bias}",
+      other_blob: "0x0400000000000000"
+    }}
+  }}
+#-}}
+"""
+
+
+def make_layer(seed, name):
+    rng = np.random.default_rng(seed)
+    weight = rng.standard_normal((8, 8)).astype(np.float32)
+    bias = rng.standard_normal(8).astype(np.float32)
+    mlir = LAYER_MLIR.format(
+        weight=weight.tobytes().hex().upper(),
+        bias=bias.tobytes().hex().upper(),
+        name=name,
+    )
+    return mlir, weight, bias
+
+
+class ExternalizeConstantsTest(unittest.TestCase):
+    def test_weights_become_arguments(self):
+        mlir, weight, bias = make_layer(0, "layer_0")
+        stripped, weights = externalize_constants(mlir, min_bytes=16)
+        self.assertEqual(len(weights), 2)
+        np.testing.assert_array_equal(weights[0], weight)
+        np.testing.assert_array_equal(weights[1], bias)
+        self.assertIn(
+            "@forward(%arg0: tensor<4x8xf32>, %cst_0: tensor<8x8xf32>, "
+            "%cst_2: tensor<8xf32>)",
+            stripped,
+        )
+        self.assertNotIn(weight.tobytes().hex().upper(), stripped)
+        self.assertNotIn("torch_tensor_8_f32", stripped)
+        self.assertIn('other_blob: "0x0400000000000000"\n', stripped)
+        # The splat and the scalar stay in the module.
+        self.assertIn("dense<1.000000e+00> : tensor<8xf32>", stripped)
+        self.assertIn("%cst = arith.constant 0.000000e+00", stripped)
+
+    def test_min_bytes(self):
+        mlir, _, _ = make_layer(0, "layer_0")
+        stripped, weights = externalize_constants(mlir, min_bytes=64)
+        self.assertEqual(len(weights), 1)
+        self.assertIn("torch_tensor_8_f32", stripped)
+
+    def test_same_structure(self):
+        layer_0, _, _ = make_layer(0, "layer_0")
+        layer_1, _, _ = make_layer(1, "layer_1")
+        self.assertNotEqual(structural_hash(layer_0), structural_hash(layer_1))
+        stripped_0, _ = externalize_constants(layer_0, min_bytes=16)
+        stripped_1, _ = externalize_constants(layer_1, min_bytes=16)
+        self.assertEqual(
+            structural_hash(stripped_0), structural_hash(stripped_1)
+        )
+
+    def test_no_function(self):
+        mlir, _, _ = make_layer(0, "layer_0")
+        self.assertEqual(externalize_constants(mlir, "main"), (mlir, []))
+
+
+class SaveCompiledLayerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.vmfb_path = os.path.join(self.tmp_dir.name, "layer_0.vmfb")
+
+    def test_save(self):
+        weights = [np.arange(4, dtype=np.float32), np.ones((2, 2))]
+        save_compiled_layer(
+            self.vmfb_path, CompiledLayer(b"vmfb", weights, "hash")
+        )
+        with open(self.vmfb_path, "rb") as f:
+            self.assertEqual(f.read(), b"vmfb")
+        with np.load(get_weights_path(self.vmfb_path)) as saved:
+            np.testing.assert_array_equal(saved["arr_0"], weights[0])
+            np.testing.assert_array_equal(saved["arr_1"], weights[1])
+        self.assertEqual(
+            sorted(os.listdir(self.tmp_dir.name)),
+            ["layer_0.vmfb", "layer_0.weights.npz"],
+        )
+
+        # A layer without weights drops the ones of a previous save.
+        save_compiled_layer(self.vmfb_path, CompiledLayer(b"vmfb", [], "h"))
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["layer_0.vmfb"])
+
+    def test_interrupted_save(self):
+        # The .vmfb, which marks a layer as compiled, is only written once
+        # its weights are.
+        class Interrupted(Exception):
+            pass
+
+        class FailingWeight:
+            def __array__(self, *args, **kwargs):
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            save_compiled_layer(
+                self.vmfb_path,
+                CompiledLayer(b"vmfb", [FailingWeight()], "hash"),
+            )
+        self.assertFalse(os.path.exists(self.vmfb_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
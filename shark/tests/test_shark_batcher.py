@@ -0,0 +1,93 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import numpy as np
+
+from shark.shark_batcher import SharkBatcher
+
+
+class FakeModule:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.calls = 0
+
+    def __call__(self, function_name, inputs):
+        self.calls += 1
+        assert inputs[0].shape[0] == self.batch_size
+        return inputs[0] * 2
+
+
+class BadOutput:
+    def __array__(self, *args, **kwargs):
+        raise RuntimeError("bad output")
+
+
+class SharkBatcherTest(unittest.TestCase):
+    def test_batches_and_scatters(self):
+        modules = {bs: FakeModule(bs) for bs in (1, 2, 4)}
+        batcher = SharkBatcher(modules, max_latency_ms=200)
+        futures = [
+            batcher.submit((np.full((1, 3), i, dtype=np.float32),))
+            for i in range(3)
+        ]
+        results = [f.result() for f in futures]
+        batcher.close()
+        for i, result in enumerate(results):
+            np.testing.assert_array_equal(result, np.full((1, 3), 2 * i))
+        self.assertEqual(modules[4].calls, 1)
+        metrics = batcher.metrics()
+        self.assertEqual(metrics["batches"], 1)
+        self.assertEqual(metrics["padded_rows"], 1)
+        self.assertAlmostEqual(metrics["batch_fill"], 0.75)
+
+    def test_rejects_oversized_request(self):
+        batcher = SharkBatcher({1: FakeModule(1)})
+        with self.assertRaises(ValueError):
+            batcher.submit((np.zeros((2, 3)),))
+        batcher.close()
+
+    def test_batches_by_scalar_value(self):
+        calls = []
+
+        def scale(function_name, inputs):
+            calls.append(float(inputs[1]))
+            return inputs[0] * inputs[1]
+
+        batcher = SharkBatcher({4: scale}, max_latency_ms=200)
+        futures = [
+            batcher.submit(
+                (np.ones((1, 2), dtype=np.float32), np.float32(scale_value))
+            )
+            for scale_value in (2, 3, 2)
+        ]
+        results = [f.result() for f in futures]
+        batcher.close()
+        for result, scale_value in zip(results, (2, 3, 2)):
+            np.testing.assert_array_equal(result, np.full((1, 2), scale_value))
+        self.assertEqual(sorted(calls), [2.0, 3.0])
+
+    def test_output_error_fails_the_batch(self):
+        batcher = SharkBatcher(
+            {2: lambda function_name, inputs: BadOutput()}, max_latency_ms=200
+        )
+        futures = [batcher.submit((np.zeros((1, 3)),)) for _ in range(2)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+        batcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
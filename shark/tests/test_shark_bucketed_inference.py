@@ -0,0 +1,51 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import numpy as np
+
+from shark.shark_bucketed_inference import SharkBucketedInference
+
+
+class FakeBucketedInference(SharkBucketedInference):
+    def compile_bucket(self, bucket):
+        def _run(function_name, inputs, send_to_host=True):
+            assert inputs[0].shape[1] == bucket
+            return inputs[0] + inputs[1]
+
+        return _run
+
+
+class SharkBucketedInferenceTest(unittest.TestCase):
+    def test_smallest_bucket_and_padding(self):
+        module = FakeBucketedInference(
+            None, [64, 32, 128], dynamic_dims=(1, 1), pad_values=(7, 0)
+        )
+        ids = np.ones((1, 40), dtype=np.int64)
+        mask = np.ones((1, 40), dtype=np.int64)
+        out = module("forward", (ids, mask))
+        self.assertEqual(out.shape, (1, 64))
+        np.testing.assert_array_equal(out[0, :40], 2)
+        np.testing.assert_array_equal(out[0, 40:], 7)
+        self.assertEqual(list(module.modules), [64])
+        self.assertEqual(module.calls_per_bucket, {32: 0, 64: 1, 128: 0})
+
+    def test_too_long(self):
+        module = FakeBucketedInference(None, [32], dynamic_dims=(1, None))
+        with self.assertRaises(ValueError):
+            module("forward", (np.ones((1, 33)), np.ones(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
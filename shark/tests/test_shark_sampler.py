@@ -0,0 +1,49 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import torch
+
+from shark.shark_sampler import SharkSampler
+
+
+class SharkSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.logits = torch.tensor(
+            [[[0.0, 0.0, 0.0, 0.0], [1.0, 3.0, 2.0, -1.0]]]
+        )
+
+    def test_greedy(self):
+        sampler = SharkSampler(4)
+        self.assertEqual(sampler(self.logits), 1)
+        self.assertEqual(sampler(self.logits, index=1), 1)
+
+    def test_top_k_and_top_p(self):
+        sampler = SharkSampler(4, temperature=1.0, top_k=2, seed=0)
+        tokens = {sampler(self.logits) for _ in range(50)}
+        self.assertEqual(tokens, {1, 2})
+        sampler = SharkSampler(4, temperature=1.0, top_p=0.1, seed=0)
+        tokens = {sampler(self.logits) for _ in range(50)}
+        self.assertEqual(tokens, {1})
+
+    def test_repetition_penalty(self):
+        sampler = SharkSampler(4, repetition_penalty=10.0)
+        sampler.reset([1])
+        self.assertEqual(sampler(self.logits), 2)
+        # 2 is seen now as well.
+        self.assertEqual(sampler(self.logits), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
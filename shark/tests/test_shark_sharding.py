@@ -0,0 +1,143 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import types
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import iree.runtime as ireert
+import numpy as np
+
+from shark.iree_utils.device_tensor import SharkDeviceTensor
+from shark.shark_sharding import ShardedPipeline, plan_placement
+
+
+class FakeLayer:
+    # Stands in for a SharkInference layer: hidden * scale + mask, and the
+    # per layer input as its extra output.
+    def __init__(self, scale, config, device_idx, executor):
+        self.scale = scale
+        self.device_idx = device_idx
+        self.shark_runner = types.SimpleNamespace(iree_config=config)
+        self.executor = executor
+
+    def run(self, hidden, mask, *layer_inputs):
+        for x in (hidden, mask, *layer_inputs):
+            x.check(self.shark_runner.iree_config.device)
+        config = self.shark_runner.iree_config
+        out = hidden.to_host() * self.scale + mask.to_host()
+        return [
+            SharkDeviceTensor.from_host(config, out),
+            *(
+                SharkDeviceTensor.from_host(config, x.to_host() + 1)
+                for x in layer_inputs
+            ),
+        ]
+
+    def invoke_async(self, function_name, inputs, send_to_host=True):
+        return self.executor.submit(self.run, *inputs)
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        return self.run(*inputs)
+
+
+class PlanPlacementTest(unittest.TestCase):
+    def test_balances_latency(self):
+        self.assertEqual(plan_placement([1, 1, 1, 1], [0, 1]), [0, 0, 1, 1])
+        self.assertEqual(
+            plan_placement([4, 1, 1, 1, 1], [2, 3]), [2, 3, 3, 3, 3]
+        )
+
+    def test_memory(self):
+        self.assertEqual(
+            plan_placement(
+                [1, 1, 1, 1], [0, 1, 2], [3, 1, 1, 1], device_memory=3
+            ),
+            [0, 1, 1, 2],
+        )
+        with self.assertRaises(ValueError):
+            plan_placement([1, 1], [0], [2, 2], device_memory=3)
+
+
+class ShardedPipelineTest(unittest.TestCase):
+    def setUp(self):
+        configs = [ireert.Config("local-task"), ireert.Config("local-sync")]
+        self.executors = [ThreadPoolExecutor(1), ThreadPoolExecutor(1)]
+        placement = [0, 0, 1, 1]
+        self.layers = [
+            FakeLayer(i + 2, configs[d], d, self.executors[d])
+            for i, d in enumerate(placement)
+        ]
+        self.pipeline = ShardedPipeline(self.layers)
+        self.hidden = np.arange(8, dtype=np.float32).reshape(4, 2)
+        self.mask = np.ones((4, 2), dtype=np.float32)
+        self.cache = [np.full((4, 1), i, dtype=np.float32) for i in range(4)]
+        expected = self.hidden
+        for layer in self.layers:
+            expected = expected * layer.scale + self.mask
+        self.expected = expected
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+    def test_run(self):
+        hidden, extras = self.pipeline(
+            self.hidden, (self.mask,), [(c,) for c in self.cache]
+        )
+        np.testing.assert_allclose(hidden, self.expected)
+        for cache, extra in zip(self.cache, extras):
+            np.testing.assert_allclose(extra[0], cache + 1)
+        self.assertEqual(self.pipeline.placement, [0, 0, 1, 1])
+        # Only the activations crossing from device 0 to 1 are copied.
+        self.assertEqual(self.pipeline.metrics()["device_copies"], 1)
+
+    def test_micro_batches(self):
+        hidden, extras = self.pipeline(
+            self.hidden,
+            (self.mask,),
+            [(c,) for c in self.cache],
+            num_micro_batches=2,
+        )
+        np.testing.assert_allclose(hidden, self.expected)
+        np.testing.assert_allclose(extras[3][0], self.cache[3] + 1)
+        self.assertEqual(self.pipeline.metrics()["device_copies"], 2)
+
+    def test_profile(self):
+        latencies = self.pipeline.profile(
+            self.hidden, (self.mask,), [(c,) for c in self.cache]
+        )
+        self.assertEqual(len(latencies), 4)
+        self.assertEqual(len(plan_placement(latencies, [0, 1])), 4)
+
+    def test_before_layer(self):
+        calls = []
+
+        def before_layer(module):
+            calls.append((module.device_idx, threading.get_ident()))
+
+        pipeline = ShardedPipeline(self.layers, before_layer=before_layer)
+        hidden, _ = pipeline(
+            self.hidden, (self.mask,), [(c,) for c in self.cache]
+        )
+        np.testing.assert_allclose(hidden, self.expected)
+        # Called for every layer, on the thread running it.
+        self.assertEqual(
+            calls, [(d, threading.get_ident()) for d in [0, 0, 1, 1]]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
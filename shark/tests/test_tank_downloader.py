@@ -0,0 +1,224 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+from shark import tank_manifest
+from shark.tank_downloader import DownloadError, TankDownloader
+from shark.tank_manifest import get_tank_manifest
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    # Serves the list and ranged media requests of the GCS JSON API from
+    # server.blobs, a {name: bytes} dict.
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o(?:/(.+))?", url.path)
+        if match is None:
+            self.send_error(404)
+            return
+        if match.group(2) is None:
+            prefix = query.get("prefix", [""])[0]
+            server.listings += 1
+            items = [
+                {
+                    "name": name,
+                    "size": str(len(data)),
+                    "md5Hash": server.md5s.get(name, _md5(data)),
+                }
+                for name, data in sorted(server.blobs.items())
+                if name.startswith(prefix)
+            ]
+            self._send(200, json.dumps({"items": items}).encode())
+            return
+
+        name = unquote(match.group(2))
+        start, end = map(
+            int,
+            re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups(),
+        )
+        with server.lock:
+            server.ranges.append((name, start))
+            fail = server.failures.get((name, start), 0)
+            if fail:
+                server.failures[(name, start)] = fail - 1
+        if fail:
+            self.send_error(503)
+            return
+        self._send(206, server.blobs[name][start : end + 1])
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+class FakeGCSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGCSHandler)
+        self.server.blobs = {
+            "model/a.bin": os.urandom(1000),
+            "model/b.bin": os.urandom(250),
+            "model/sub/c.bin": b"ignored",
+            "model_BS2/a.bin": b"ignored",
+        }
+        self.server.md5s = {}
+        self.server.listings = 0
+        self.server.ranges = []
+        self.server.failures = {}
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp_dir.name, "model")
+        self.downloader = TankDownloader(
+            endpoint=f"http://127.0.0.1:{self.server.server_port}",
+            num_workers=4,
+            chunk_size=100,
+            show_progress=False,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+
+class TankDownloaderTest(FakeGCSTestCase):
+    def read(self, name):
+        with open(os.path.join(self.dest, name), "rb") as f:
+            return f.read()
+
+    def test_download_prefix(self):
+        self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertEqual(sorted(os.listdir(self.dest)), ["a.bin", "b.bin"])
+        self.assertEqual(self.read("a.bin"), self.server.blobs["model/a.bin"])
+        self.assertEqual(self.read("b.bin"), self.server.blobs["model/b.bin"])
+        self.assertEqual(len(self.server.ranges), 10 + 3)
+
+        # Verified files already in place are not downloaded again.
+        self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertEqual(len(self.server.ranges), 10 + 3)
+
+    def test_retry_failed_chunk(self):
+        self.server.failures[("model/a.bin", 300)] = 1
+        self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertEqual(self.read("a.bin"), self.server.blobs["model/a.bin"])
+        self.assertEqual(self.server.ranges.count(("model/a.bin", 300)), 2)
+
+    def test_resume_partial_download(self):
+        self.server.failures[("model/a.bin", 500)] = 3
+        with self.assertRaises(DownloadError):
+            self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "a.bin")))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, "a.bin.part")))
+
+        self.server.ranges.clear()
+        self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertEqual(self.read("a.bin"), self.server.blobs["model/a.bin"])
+        self.assertEqual(self.server.ranges, [("model/a.bin", 500)])
+        self.assertEqual(sorted(os.listdir(self.dest)), ["a.bin", "b.bin"])
+
+    def test_checksum_mismatch(self):
+        self.server.md5s["model/b.bin"] = _md5(b"something else")
+        with self.assertRaises(DownloadError):
+            self.downloader.download_prefix("gs://tank/model", self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "b.bin")))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "b.bin.part")))
+
+    def test_download_file(self):
+        path = os.path.join(self.tmp_dir.name, "upstream_b.bin")
+        self.downloader.download_file("gs://tank/model/b.bin", path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.blobs["model/b.bin"])
+        with self.assertRaises(FileNotFoundError):
+            self.downloader.download_file("gs://tank/model/x.bin", path)
+
+    def test_download_file_to_path(self):
+        path = Path(self.tmp_dir.name) / "upstream_b.bin"
+        self.assertEqual(
+            self.downloader.download_file("gs://tank/model/b.bin", path), path
+        )
+        self.assertEqual(path.read_bytes(), self.server.blobs["model/b.bin"])
+
+
+class TankManifestTest(FakeGCSTestCase):
+    def setUp(self):
+        super().setUp()
+        tank_manifest._manifests.clear()
+        tank_manifest._unreachable.clear()
+
+    def get_manifest(self, ttl=60):
+        return get_tank_manifest(
+            "gs://tank/", self.tmp_dir.name, ttl, self.downloader
+        )
+
+    def test_listed_once(self):
+        manifest = self.get_manifest()
+        self.assertEqual(
+            manifest.md5("model/b.bin"),
+            _md5(self.server.blobs["model/b.bin"]),
+        )
+        self.assertIsNone(manifest.md5("model/x.bin"))
+        self.assertEqual(
+            [blob["name"] for blob in manifest.model_blobs("model")],
+            ["model/a.bin", "model/b.bin"],
+        )
+        self.get_manifest()
+        self.assertEqual(self.server.listings, 1)
+
+        # Another process reads it from the cache dir.
+        tank_manifest._manifests.clear()
+        self.assertEqual(self.get_manifest().blobs, manifest.blobs)
+        self.assertEqual(self.server.listings, 1)
+
+        self.get_manifest(ttl=0)
+        self.assertEqual(self.server.listings, 2)
+
+    def test_unreachable(self):
+        manifest = self.get_manifest()
+        tank_manifest._manifests.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.get_manifest(ttl=0).blobs, manifest.blobs)
+
+        tank_manifest._manifests.clear()
+        tank_manifest._unreachable.clear()
+        os.remove(
+            tank_manifest.get_manifest_path(self.tmp_dir.name, "gs://tank")
+        )
+        self.assertIsNone(self.get_manifest())
+
+
+if __name__ == "__main__":
+    unittest.main()